@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+bench_import.py
+
+Reports the import time of exptools modules, measured with python -X importtime
+in a fresh interpreter per module, and the heavy backends each of them pulls in.
+Modules that should not need a display or audio stack fail the benchmark when
+they import one of the backends, or when they take longer than the budget.
+Numpy is needed everywhere, its import time is reported separately and not
+counted against the budget.
+
+usage: python benchmarks/bench_import.py [budget_ms]
+"""
+
+import os
+import subprocess
+import sys
+
+heavy_modules = ['psychopy', 'pygame', 'pygaze', 'pyaudio', 'pylink', 'pandas', 'scipy']
+
+# modules that must import without any heavy backend
+light_modules = ['exptools',
+                 'exptools.core.staircase',
+                 'exptools.core.quest',
+                 'exptools.core.events',
+                 'exptools.core.schedule',
+                 'exptools.core.saccade',
+                 'exptools.core.simulation',
+                 'exptools.utils.config']
+
+# modules whose import time is reported, but not checked
+other_modules = ['exptools.core.session',
+                 'exptools.core.trial']
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_times(module):
+    """
+    import module in a new interpreter. returns the cumulative import time of module in seconds
+    (None if it fails to import) and a dict of the cumulative times of all top-level packages imported.
+    """
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join([repository, os.environ.get('PYTHONPATH', '')]))
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+                             stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=environment,
+                             universal_newlines=True)
+    # lines are 'import time: self [us] | cumulative | imported package', nesting indented
+    packages = {}
+    total = None
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        packages[name.strip()] = int(cumulative) * 1e-6
+        if name.strip() == module:
+            total = int(cumulative) * 1e-6
+    if process.returncode != 0:
+        total = None
+    return total, packages
+
+
+def main(budget_ms=50.0):
+    failures = []
+    print('%-30s %10s %10s  %s' % ('module', 'ms', 'numpy ms', 'heavy backends imported'))
+    for module in light_modules + other_modules:
+        total, packages = import_times(module)
+        heavy = [name for name in heavy_modules if name in packages]
+        numpy_time = packages.get('numpy', 0.0)
+        if total is None:
+            print('%-30s %10s %10s  %s' % (module, 'failed', '', ', '.join(heavy)))
+        else:
+            total -= numpy_time
+            print('%-30s %10.1f %10.1f  %s' % (module, total * 1e3, numpy_time * 1e3, ', '.join(heavy)))
+        if module in light_modules:
+            if total is None:
+                failures.append('%s does not import' % module)
+            elif total * 1e3 > budget_ms:
+                failures.append('%s takes %.1f ms to import' % (module, total * 1e3))
+            if heavy:
+                failures.append('%s imports %s' % (module, ', '.join(heavy)))
+    for failure in failures:
+        print('FAIL: %s' % failure)
+    return len(failures) == 0
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main(*[float(a) for a in sys.argv[1:]]) else 1)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+bench_saccade.py
+
+Compares the per-sample cost of the online velocity saccade detection that
+EyelinkSession.detect_saccade used up to version 0.3.1, which recomputes the
+median over all samples so far, with the streaming SaccadeDetector and the
+vectorized offline detect_saccades.
+
+usage: python benchmarks/bench_saccade.py [nr_samples]
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from exptools.core.saccade import SaccadeDetector, detect_saccades
+
+
+def simulated_gaze(nr_samples, sample_rate=1000, seed=0):
+    """fixation noise followed by a single saccade in the last 50 ms"""
+    rng = np.random.RandomState(seed)
+    positions = rng.normal(0, 0.5, (nr_samples, 2))
+    onset = nr_samples - 50
+    positions[onset:onset + 20, 0] += np.linspace(0, 200, 20)
+    positions[onset + 20:, 0] += 200
+    times = np.arange(nr_samples) / float(sample_rate)
+    return times, positions
+
+
+def legacy_detect(positions, threshold=6.0):
+    """the velocity branch of the original detect_saccade, fed from an array instead of eye_pos"""
+    nr_total = positions.shape[0]
+    sample_array = np.zeros((nr_total, 2), dtype=np.float32)
+    velocity_array = np.zeros((nr_total, 2), dtype=np.float32)
+    sample_array[0, :] = positions[0]
+    velocity_array[0, :] = 0.001, 0.001
+    for nr_samples in range(1, nr_total):
+        sample_array[nr_samples][:] = positions[nr_samples]
+        velocity_array[nr_samples][:] = sample_array[nr_samples][:] - sample_array[nr_samples-1][:]
+        if nr_samples > 3:
+            med_scaled_velocity = velocity_array[:nr_samples]/np.mean(np.sqrt(((velocity_array[:nr_samples] - np.median(velocity_array[:nr_samples], axis = 0))**2)), axis = 0)
+            if np.linalg.norm(med_scaled_velocity[-1]) > threshold:
+                return nr_samples
+    return None
+
+
+def streaming_detect(times, positions):
+    detector = SaccadeDetector(sample_rate=1000)
+    for i in range(times.shape[0]):
+        if detector.add_sample(times[i], positions[i]) is not None:
+            return i
+    return None
+
+
+def timed(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+
+def main(nr_samples=2000):
+    times, positions = simulated_gaze(nr_samples)
+
+    results = [('legacy detect_saccade', timed(legacy_detect, positions)),
+               ('SaccadeDetector.add_sample', timed(streaming_detect, times, positions)),
+               ('detect_saccades (offline)', timed(detect_saccades, positions))]
+
+    print('%d samples' % nr_samples)
+    for name, duration in results:
+        print('%-30s %10.3f ms total %10.2f us/sample' % (name, duration * 1e3, duration / nr_samples * 1e6))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
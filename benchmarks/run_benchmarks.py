@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+run_benchmarks.py
+
+Benchmarks of the hot paths of a session: the trial loop on a headless screen,
+check_phase_time with many short phases, event logging, Session.close versus
+the number of trials, staircase updates and saccade detection, both by
+EyelinkSession.detect_saccade and by the detect_saccade of before the streaming
+SaccadeDetector. Every benchmark is repeated, in a directory of its own, and the
+best result is kept, to reduce the noise of other load on the machine. Results
+are written to a JSON file; with --compare, they are checked against a stored
+baseline, and the script exits with status 1 when a result is worse than the
+baseline by more than the tolerance. Benchmarks whose dependencies are not
+installed are skipped.
+
+usage: python benchmarks/run_benchmarks.py [--output results.json] [--compare baseline.json]
+                                           [--tolerance 0.2] [--repeat 3] [--only name ...]
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository)
+sys.path.insert(0, os.path.join(repository, 'benchmarks'))
+
+# name: (function, unit, higher is better)
+benchmarks = {}
+
+
+def benchmark(name, unit, higher_is_better=False):
+    def register(function):
+        benchmarks[name] = (function, unit, higher_is_better)
+        return function
+    return register
+
+
+def headless_session(name, **kwargs):
+    from exptools.core.session import Session
+
+    # sessions name their output files by the second, so every session gets its own subject
+    return Session(name, 1, engine='headless', **kwargs)
+
+
+@benchmark('trial_run_frames_per_second', 'frames/s', higher_is_better=True)
+def trial_run(nr_trials=20):
+    from exptools.core.trial import Trial
+
+    session = headless_session('trial_run')
+    start = time.time()
+    for i in range(nr_trials):
+        trial = Trial(parameters={'i': i}, phase_durations=[0.5, 0.5, 1.0], session=session)
+        trial.ID = i
+        trial.run()
+    duration = time.time() - start
+    session.close()
+    return session.screen.nr_flips / duration
+
+
+@benchmark('check_phase_time_us', 'us/call')
+def check_phase_time(nr_phases=2000):
+    from exptools.core.trial import Trial
+
+    session = headless_session('check_phase_time')
+    # phases of a single frame, so every call phase-forwards
+    trial = Trial(parameters={}, phase_durations=[1.0 / session.refresh_rate] * nr_phases, session=session)
+    trial.ID = 0
+    trial.start_time = session.clock.getTime()
+    trial.event_start = len(session.event_log)
+    nr_calls = 0
+    start = time.time()
+    while trial.phase < nr_phases - 1:
+        session.screen.flip()
+        trial.check_phase_time()
+        nr_calls += 1
+    duration = time.time() - start
+    session.close()
+    return duration / nr_calls * 1e6
+
+
+@benchmark('event_log_events_per_second', 'events/s', higher_is_better=True)
+def event_log(nr_events=200000):
+    from exptools.core.events import EventLog, KEY
+
+    log = EventLog()
+    start = time.time()
+    for i in range(nr_events):
+        log.append(i // 100, i % 4, KEY, i * 0.001, key='space')
+    return nr_events / (time.time() - start)
+
+
+def session_close(nr_trials):
+    from exptools.core.trial import Trial
+
+    session = headless_session('session_close_%d' % nr_trials)
+    for i in range(nr_trials):
+        trial = Trial(parameters={'i': i, 'condition': i % 4}, phase_durations=[0.0, 0.0], session=session)
+        trial.ID = i
+        trial.run()
+    start = time.time()
+    session.close()
+    return (time.time() - start) * 1e3
+
+
+for _nr_trials in [100, 1000, 5000]:
+    benchmark('session_close_%d_trials_ms' % _nr_trials, 'ms')(lambda n=_nr_trials: session_close(n))
+
+
+@benchmark('staircase_answer_us', 'us/answer')
+def staircase(nr_answers=5000):
+    from exptools.core.staircase import TwoUpOneDownStaircase
+
+    staircase = TwoUpOneDownStaircase(1.0, 0.1, nr_reversals=nr_answers, max_nr_trials=nr_answers * 2)
+    answers = np.random.RandomState(0).rand(nr_answers) < 0.7
+    start = time.time()
+    for answer in answers:
+        staircase.answer(answer)
+    return (time.time() - start) / nr_answers * 1e6
+
+
+@benchmark('staircase_bank_answer_us', 'us/answer')
+def staircase_bank(nr_tracks=32, nr_answers=5000):
+    from exptools.core.staircase import StaircaseBank
+
+    bank = StaircaseBank(np.ones(nr_tracks), 0.1, nr_up=2, nr_reversals=nr_answers, max_nr_trials=nr_answers * 2, seed=0)
+    answers = np.random.RandomState(0).rand(nr_answers) < 0.7
+    start = time.time()
+    for answer in answers:
+        bank.answer(bank.next_track(), answer)
+    return (time.time() - start) / nr_answers * 1e6
+
+
+@benchmark('quest_plus_answer_us', 'us/answer')
+def quest_plus(nr_answers=200):
+    from exptools.core.quest import QuestPlusStaircase
+
+    quest = QuestPlusStaircase(np.linspace(-1, 1, 101), np.linspace(-1, 1, 81), slopes=np.linspace(2, 20, 10),
+                               max_nr_trials=nr_answers)
+    answers = np.random.RandomState(0).rand(nr_answers) < 0.7
+    start = time.time()
+    for answer in answers:
+        quest.answer(answer)
+    return (time.time() - start) / nr_answers * 1e6
+
+
+@benchmark('saccade_detector_us_per_sample', 'us/sample')
+def saccade_detector(nr_samples=20000):
+    from exptools.core.saccade import SaccadeDetector
+
+    rng = np.random.RandomState(0)
+    positions = rng.normal(0, 0.5, (nr_samples, 2))
+    times = np.arange(nr_samples) * 0.001
+    detector = SaccadeDetector(sample_rate=1000)
+    start = time.time()
+    for i in range(nr_samples):
+        detector.add_sample(times[i], positions[i])
+    return (time.time() - start) / nr_samples * 1e6
+
+
+@benchmark('detect_saccade_us_per_sample', 'us/sample')
+def detect_saccade(nr_samples=2000):
+    from exptools.core.session import EyelinkSession
+    from exptools.core.simulation import SimulatedTracker
+    from bench_saccade import simulated_gaze
+
+    class GazeTracker(SimulatedTracker):
+        """a simulated tracker whose every sample is the next one of positions"""
+        def __init__(self, clock, positions):
+            super(GazeTracker, self).__init__(clock)
+            self.positions = positions
+            self.nr_samples = 0
+
+        def sample(self):
+            position = self.positions[min(self.nr_samples, self.positions.shape[0] - 1)]
+            self.nr_samples += 1
+            return position[0], position[1]
+
+    times, positions = simulated_gaze(nr_samples)
+    session = EyelinkSession('detect_saccade', 1, engine='headless')
+    session.tracker = GazeTracker(session.clock, positions)
+    start = time.time()
+    session.detect_saccade(algorithm_type='velocity', max_time=10.0)
+    duration = time.time() - start
+    nr_polled = session.tracker.nr_samples
+    session.close()
+    return duration / nr_polled * 1e6
+
+
+@benchmark('legacy_detect_saccade_us_per_sample', 'us/sample')
+def legacy_detect_saccade(nr_samples=2000):
+    # the velocity detection of detect_saccade before SaccadeDetector, see bench_saccade.py
+    from bench_saccade import simulated_gaze, legacy_detect
+
+    times, positions = simulated_gaze(nr_samples)
+    start = time.time()
+    legacy_detect(positions)
+    return (time.time() - start) / nr_samples * 1e6
+
+
+def in_new_directory(function):
+    """
+    run function in a new temporary directory. Sessions write their output to ./data, 
+    in files named by the second, so repeats in one directory would append to each other's files.
+    """
+    working_directory = os.getcwd()
+    directory = tempfile.mkdtemp()
+    os.chdir(directory)
+    try:
+        return function()
+    finally:
+        os.chdir(working_directory)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def run(names, repeat=3):
+    results = {}
+    for name in names:
+        function, unit, higher_is_better = benchmarks[name]
+        try:
+            values = [in_new_directory(function) for i in range(repeat)]
+        except ImportError as error:
+            print('%-36s skipped: %s' % (name, error))
+            continue
+        value = max(values) if higher_is_better else min(values)
+        results[name] = {'value': value, 'unit': unit, 'higher_is_better': higher_is_better}
+        print('%-36s %14.3f %s' % (name, value, unit))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """print results relative to baseline, returns the names of the benchmarks that regressed"""
+    regressions = []
+    print('\n%-36s %14s %14s %8s' % ('benchmark', 'baseline', 'now', 'change'))
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        old, new = baseline[name]['value'], result['value']
+        change = new / old - 1.0
+        worse = -change if result['higher_is_better'] else change
+        flag = ''
+        if worse > tolerance:
+            regressions.append(name)
+            flag = 'REGRESSION'
+        print('%-36s %14.3f %14.3f %+7.1f%% %s' % (name, old, new, change * 100, flag))
+    return regressions
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='exptools benchmarks')
+    parser.add_argument('--output', default='benchmark_results.json', help='file to write the results to')
+    parser.add_argument('--compare', help='baseline results file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative slowdown counted as a regression')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs of every benchmark, the best is kept')
+    parser.add_argument('--only', nargs='+', choices=sorted(benchmarks), help='benchmarks to run')
+    arguments = parser.parse_args(arguments)
+
+    results = run(arguments.only or sorted(benchmarks), arguments.repeat)
+    with open(arguments.output, 'w') as f:
+        json.dump({'python': platform.python_version(),
+                   'numpy': np.__version__,
+                   'platform': platform.platform(),
+                   'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'results': results}, f, indent=2, sort_keys=True)
+
+    if arguments.compare is not None:
+        with open(arguments.compare) as f:
+            baseline = json.load(f)['results']
+        return len(compare(results, baseline, arguments.tolerance)) == 0
+    return True
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
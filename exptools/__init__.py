@@ -1,8 +1,17 @@
 from __future__ import absolute_import
 
-from .utils.config import ExpToolsConfig
-config = ExpToolsConfig()
+import importlib
 
-from .core import session, trial 
+# the configuration and the session and trial modules (with their display backends) are loaded
+# on first use, so that e.g. the staircases or analysis tools can be imported on their own
+_submodules = {'session': '.core.session', 'trial': '.core.trial', 'core': '.core', 'utils': '.utils'}
 
 
+def __getattr__(name):
+    if name == 'config':
+        from .utils.config import ExpToolsConfig
+        globals()['config'] = ExpToolsConfig()
+        return globals()['config']
+    if name in _submodules:
+        return importlib.import_module(_submodules[name], __name__)
+    raise AttributeError('module %s has no attribute %s' % (__name__, name))
@@ -0,0 +1 @@
+from .outputs import SessionData, load_session, load_sessions, read_session, parse_legacy_events
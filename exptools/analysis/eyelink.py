@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+eyelink.py
+
+Reading EyeLink recordings converted to ASCII (edf2asc). The .asc file is
+streamed in chunks: sample lines are parsed per chunk and appended to binary
+files on disk, which are memory-mapped afterwards, so recordings larger than
+memory can be read. Fixations, saccades, blinks and MSG lines are kept as
+small tables. The trial and phase messages exptools sends to the tracker are
+aligned to the samples with searchsorted, and the resulting per-trial segments
+are stored with the samples in a cache directory that later reads reuse.
+"""
+
+import io
+import os
+import re
+import json
+
+import numpy as np
+
+from ..core.dispatch import offset_marker
+from .outputs import legacy_event_pattern
+
+cache_version = 2
+
+# the offset prefix of the message dispatcher, '%d %s' of a non-negative offset in ms
+_offset_pattern = re.compile(r'(0|[1-9][0-9]*) (.*)$', re.DOTALL)
+
+fixation_dtype = np.dtype([('eye', 'U1'), ('start', np.float64), ('end', np.float64), ('duration', np.float64),
+                           ('x', np.float64), ('y', np.float64), ('pupil', np.float64)])
+saccade_dtype = np.dtype([('eye', 'U1'), ('start', np.float64), ('end', np.float64), ('duration', np.float64),
+                          ('start_x', np.float64), ('start_y', np.float64), ('end_x', np.float64), ('end_y', np.float64),
+                          ('amplitude', np.float64), ('peak_velocity', np.float64)])
+blink_dtype = np.dtype([('eye', 'U1'), ('start', np.float64), ('end', np.float64), ('duration', np.float64)])
+segment_dtype = np.dtype([('trial', np.int64), ('phase', np.int64), ('start', np.float64), ('end', np.float64),
+                          ('first_sample', np.int64), ('last_sample', np.int64)])
+
+_event_dtypes = {'EFIX': fixation_dtype, 'ESACC': saccade_dtype, 'EBLINK': blink_dtype}
+
+
+def _number(value):
+    try:
+        return float(value)
+    except ValueError:
+        # missing values are written as '.'
+        return np.nan
+
+
+def parse_message(line, offsets=False):
+    """
+    (time, text) of a MSG line. With offsets, in recordings of sessions whose message dispatcher
+    stamps offsets (they contain core.dispatch.offset_marker), a number before the text is the 
+    offset in ms of a message that was sent after a delay; it is subtracted from the time.
+    """
+    fields = line.rstrip('\r\n').split(None, 2)
+    time = float(fields[1])
+    text = fields[2] if len(fields) > 2 else ''
+    if offsets:
+        match = _offset_pattern.match(text)
+        if match is not None:
+            time -= int(match.group(1))
+            text = match.group(2)
+    return time, text
+
+
+def _sample_columns(samples_line):
+    """sample column names from the SAMPLES line that edf2asc writes before the samples"""
+    fields = samples_line.split()
+    eyes = [eye for eye in ['LEFT', 'RIGHT'] if eye in fields]
+    if len(eyes) == 2:
+        return ['x_left', 'y_left', 'pupil_left', 'x_right', 'y_right', 'pupil_right']
+    eye = eyes[0].lower() if eyes else 'left'
+    return ['x_%s' % eye, 'y_%s' % eye, 'pupil_%s' % eye]
+
+
+class _SampleWriter(object):
+    """parses chunks of sample lines and appends them to the time and value files"""
+    def __init__(self, directory):
+        self._times = open(os.path.join(directory, 'times.bin.tmp'), 'wb')
+        self._values = open(os.path.join(directory, 'samples.bin.tmp'), 'wb')
+        self.nr_samples = 0
+
+    def write(self, lines, nr_columns):
+        import pandas as pd
+
+        if not lines:
+            return
+        table = pd.read_csv(io.StringIO(''.join(lines)), sep=r'\s+', header=None, usecols=range(1 + nr_columns),
+                            na_values=['.'], engine='c').values
+        self._times.write(np.ascontiguousarray(table[:, 0], dtype=np.float64).tobytes())
+        self._values.write(np.ascontiguousarray(table[:, 1:], dtype=np.float32).tobytes())
+        self.nr_samples += table.shape[0]
+
+    def close(self):
+        self._times.close()
+        self._values.close()
+
+
+def _segments(messages, times):
+    """
+    the trial phase segments of a recording: the phase start messages of exptools (the trial start
+    for phase 0) up to the next phase or the trial stop, and their sample index ranges in times.
+    """
+    import pandas as pd
+
+    parsed = pd.Series(messages['text'].tolist(), dtype=object).str.extract(legacy_event_pattern)
+    keep = (parsed['boundary'].notnull() | parsed['phase'].notnull()).values
+    if not keep.any():
+        return np.zeros(0, dtype=segment_dtype)
+    trial = pd.to_numeric(parsed['trial'][keep], errors='coerce').values
+    phase = pd.to_numeric(parsed['phase'][keep]).fillna(0).values
+    stopped = (parsed['boundary'][keep] == 'stopped').values
+    message_times = messages['time'][keep]
+
+    starts = ~stopped
+    segments = np.zeros(starts.sum(), dtype=segment_dtype)
+    segments['trial'] = trial[starts]
+    segments['phase'] = phase[starts]
+    segments['start'] = message_times[starts]
+    # a segment ends at the next boundary message, the last one at the end of the recording
+    following = np.flatnonzero(starts) + 1
+    ends = np.append(message_times, times[-1] + 1 if times.shape[0] > 0 else np.inf)
+    segments['end'] = ends[following]
+    segments['first_sample'] = np.searchsorted(times, segments['start'], side='left')
+    segments['last_sample'] = np.searchsorted(times, segments['end'], side='left')
+    return segments
+
+
+class AscRecording(object):
+    """
+    AscRecording holds a parsed recording: memory-mapped sample times and samples (float32, one
+    column per name in sample_columns), fixations, saccades and blinks as structured arrays,
+    messages, and the trial phase segments exptools' messages define.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.sample_columns = self.meta['sample_columns']
+        nr_samples = self.meta['nr_samples']
+        if nr_samples > 0:
+            self.times = np.memmap(os.path.join(directory, 'times.bin'), dtype=np.float64, mode='r', shape=(nr_samples,))
+            self.samples = np.memmap(os.path.join(directory, 'samples.bin'), dtype=np.float32, mode='r',
+                                     shape=(nr_samples, len(self.sample_columns)))
+        else:
+            self.times = np.zeros(0)
+            self.samples = np.zeros((0, len(self.sample_columns)), dtype=np.float32)
+        events = np.load(os.path.join(directory, 'events.npz'))
+        self.fixations = events['fixations']
+        self.saccades = events['saccades']
+        self.blinks = events['blinks']
+        self.messages = events['messages']
+        self.segments = events['segments']
+
+    def samples_between(self, start, end):
+        """times and samples from start up to end (tracker time), as views on the memory-mapped files"""
+        first, last = np.searchsorted(self.times, [start, end], side='left')
+        return self.times[first:last], self.samples[first:last]
+
+    def trial_samples(self, trial, phase=None):
+        """times and samples of a trial, or of one phase of it"""
+        segments = self.segments[self.segments['trial'] == trial]
+        if phase is not None:
+            segments = segments[segments['phase'] == phase]
+        if segments.shape[0] == 0:
+            raise KeyError('no segment for trial %s phase %s' % (trial, phase))
+        first, last = segments['first_sample'].min(), segments['last_sample'].max()
+        return self.times[first:last], self.samples[first:last]
+
+    def sample_labels(self):
+        """the trial and phase of every sample, -1 outside trials"""
+        trials = np.full(self.times.shape[0], -1, dtype=np.int64)
+        phases = np.full(self.times.shape[0], -1, dtype=np.int64)
+        for segment in self.segments:
+            trials[segment['first_sample']:segment['last_sample']] = segment['trial']
+            phases[segment['first_sample']:segment['last_sample']] = segment['phase']
+        return trials, phases
+
+
+def _source_stamp(file_name):
+    stat = os.stat(file_name)
+    return [cache_version, stat.st_size, stat.st_mtime]
+
+
+def read_asc(file_name, cache_dir=None, chunk_size=100000):
+    """
+    read an .asc file into an AscRecording stored in cache_dir (by default file_name + '.cache').
+    If the cache was made from the same file, it is used without parsing. Samples are parsed
+    chunk_size lines at a time.
+    """
+    if cache_dir is None:
+        cache_dir = file_name + '.cache'
+    meta_file = os.path.join(cache_dir, 'meta.json')
+    if os.path.exists(meta_file):
+        with open(meta_file) as f:
+            if json.load(f).get('source') == _source_stamp(file_name):
+                return AscRecording(cache_dir)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    sample_columns = _sample_columns('')
+    sample_lines = []
+    events = dict((name, []) for name in _event_dtypes)
+    messages = []
+    # messages have offset prefixes from the offset marker on
+    offsets = False
+    writer = _SampleWriter(cache_dir)
+    with open(file_name) as f:
+        for line in f:
+            if line[:1].isdigit():
+                sample_lines.append(line)
+                if len(sample_lines) == chunk_size:
+                    writer.write(sample_lines, len(sample_columns))
+                    sample_lines = []
+                continue
+            kind = line.split(None, 1)[0] if line.strip() else ''
+            if kind == 'MSG':
+                message = parse_message(line, offsets)
+                if message[1] == offset_marker:
+                    offsets = True
+                messages.append(message)
+            elif kind in _event_dtypes:
+                fields = line.split()[1:]
+                events[kind].append(tuple([fields[0]] + [_number(value) for value in fields[1:len(_event_dtypes[kind])]]))
+            elif kind == 'SAMPLES':
+                # a new recording block, whose samples may have other columns
+                columns = _sample_columns(line)
+                if columns != sample_columns:
+                    if writer.nr_samples > 0 or sample_lines:
+                        raise ValueError('%s has recording blocks with different eyes, which is not supported' % file_name)
+                    sample_columns = columns
+    writer.write(sample_lines, len(sample_columns))
+    writer.close()
+    for name in ['times.bin', 'samples.bin']:
+        os.rename(os.path.join(cache_dir, name + '.tmp'), os.path.join(cache_dir, name))
+
+    message_array = np.array(messages, dtype=[('time', np.float64),
+                                              ('text', 'U%d' % max([1] + [len(text) for time, text in messages]))])
+    if writer.nr_samples > 0:
+        times = np.memmap(os.path.join(cache_dir, 'times.bin'), dtype=np.float64, mode='r', shape=(writer.nr_samples,))
+    else:
+        times = np.zeros(0)
+    np.savez(os.path.join(cache_dir, 'events.npz'),
+             fixations=np.array(events['EFIX'], dtype=fixation_dtype),
+             saccades=np.array(events['ESACC'], dtype=saccade_dtype),
+             blinks=np.array(events['EBLINK'], dtype=blink_dtype),
+             messages=message_array,
+             segments=_segments(message_array, times))
+    # the meta file is written last, a cache without it is incomplete and parsed again
+    with open(meta_file, 'w') as f:
+        json.dump({'source': _source_stamp(file_name), 'nr_samples': writer.nr_samples,
+                   'sample_columns': sample_columns}, f)
+    return AscRecording(cache_dir)
+
+
+def test_read_asc():
+    import tempfile
+
+    lines = ['** CONVERTED FROM test.edf\n',
+             'MSG\t1000 DISPLAY_COORDS 0 0 1919 1079\n',
+             'START\t1000 \tLEFT\tSAMPLES\tEVENTS\n',
+             'SAMPLES\tGAZE\tLEFT\tRATE\t1000.00\tTRACKING\tCR\tFILTER\t2\n']
+    for time in range(1000, 3000):
+        # messages that start with a number are only taken as offsets after the marker
+        if time == 1100:
+            lines.append('MSG\t1100 3 targets shown\n')
+        if time == 1200:
+            lines.append('MSG\t1200 %s\n' % offset_marker)
+        if time == 1500:
+            lines.append('MSG\t1503 3 trial 0 started at 0.5\n')
+        if time == 2000:
+            lines.append('MSG\t2000 trial 0 phase 1 started at 1.0\n')
+            lines.append('SFIX L   2000\n')
+        if time == 2500:
+            lines.append('MSG\t2500 trial 0 stopped at 1.5\n')
+            lines.append('EFIX L   2000\t2499\t500\t  960.0\t  540.0\t   1000\n')
+            lines.append('EBLINK L 2600\t2700\t101\n')
+        if 2600 <= time <= 2700:
+            lines.append('%d\t   .\t   .\t    0.0\t...\n' % time)
+        else:
+            lines.append('%d\t  960.0\t  540.0\t 1000.0\t...\n' % time)
+    lines.append('END\t3000 \tSAMPLES\tEVENTS\tRES\t  38.0\t  38.0\n')
+
+    directory = tempfile.mkdtemp()
+    file_name = os.path.join(directory, 'test.asc')
+    with open(file_name, 'w') as f:
+        f.writelines(lines)
+
+    recording = read_asc(file_name, chunk_size=256)
+    assert(recording.times.shape[0] == 2000 and recording.sample_columns == ['x_left', 'y_left', 'pupil_left'])
+    assert(np.isnan(recording.samples[1650, 0]))
+    assert(recording.fixations['duration'][0] == 500 and recording.blinks.shape[0] == 1)
+    # the offset in the first trial message is subtracted
+    assert(list(recording.segments['start']) == [1500, 2000])
+    assert(tuple(recording.messages[1]) == (1100, '3 targets shown'))
+    assert(parse_message('MSG\t1300 3 targets shown') == (1300, '3 targets shown'))
+    assert(parse_message('MSG\t1300 3 targets shown', offsets=True) == (1297, 'targets shown'))
+    assert(parse_message('MSG\t1300 -3 targets', offsets=True) == (1300, '-3 targets'))
+    times, samples = recording.trial_samples(0, phase=1)
+    assert(times[0] == 2000 and times[-1] == 2499)
+    trials, phases = recording.sample_labels()
+    assert((phases == 0).sum() == 500 and (trials == -1).sum() == 1000)
+    # the second read comes from the cache
+    assert(read_asc(file_name).times.shape[0] == 2000)
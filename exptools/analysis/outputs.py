@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+outputs.py
+
+Loading session outputs into tidy tables. A session is read from its streamed
+_trials.jsonl file or, for older sessions, from the legacy _outputDict.pkl,
+whose eventArray strings are parsed with one vectorized regular expression.
+SessionData turns the events into tables of phases (onsets and durations),
+responses (with reaction times relative to their phase and trial onsets) and
+trials (parameters with onsets). Many sessions are parsed in parallel
+processes, and parsed sessions can be cached as Parquet files.
+"""
+
+import os
+import json
+import hashlib
+import pickle as pkl
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from ..core.events import event_codes, TRIAL_START, PHASE_START, KEY, TRIAL_STOP
+from ..core.output import read_trial_records, record_event_rows
+
+output_suffixes = ['_trials.jsonl', '_outputDict.pkl', '.tsv']
+
+# the legacy eventArray strings, as rendered by core.events.render_event
+legacy_event_pattern = (r'^trial (?P<trial>\S+) (?:(?P<boundary>started|stopped)|phase (?P<phase>\d+) started'
+                        r'|event (?P<key>.*)) at (?P<time>\S+)$')
+
+event_columns = ['session', 'trial', 'phase', 'event', 'key', 'time']
+
+# caches written by older versions have other keys
+cache_version = 2
+
+# parquet caches store object columns of strings under object_column_prefix, so that they are read back
+# as object columns, and object columns with other values as json, under json_column_prefix
+object_column_prefix = 'object:'
+json_column_prefix = 'json:'
+
+
+def session_base(path):
+    """the output_file of a session, from any of its output files or the output_file itself"""
+    for suffix in output_suffixes:
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+    return path
+
+
+def _numeric(values):
+    """convert string trial ids to numbers when they all are"""
+    import pandas as pd
+
+    numbers = pd.to_numeric(values, errors='coerce')
+    if numbers.notnull().all():
+        if (numbers == np.round(numbers)).all():
+            return numbers.astype(np.int64)
+        return numbers
+    return values
+
+
+def parse_legacy_events(event_array, session=''):
+    """
+    parse a legacy eventArray (a list of lists of event strings, one list per trial) into an events table.
+    Legacy key events do not record their phase, it is taken from the last phase start before them.
+    The entry column holds the index of the eventArray entry of every event.
+    """
+    import pandas as pd
+
+    strings = pd.Series([event for trial_events in event_array for event in trial_events], dtype=object)
+    entry = np.repeat(np.arange(len(event_array)), [len(trial_events) for trial_events in event_array])
+    parsed = strings.str.extract(legacy_event_pattern)
+
+    event = np.where(parsed['boundary'] == 'started', event_codes[TRIAL_START],
+                     np.where(parsed['boundary'] == 'stopped', event_codes[TRIAL_STOP],
+                              np.where(parsed['phase'].notnull(), event_codes[PHASE_START], event_codes[KEY])))
+    events = pd.DataFrame({'session': session,
+                           'trial': _numeric(parsed['trial']),
+                           'phase': pd.to_numeric(parsed['phase']),
+                           'event': event,
+                           'key': parsed['key'].fillna(''),
+                           'time': pd.to_numeric(parsed['time'], errors='coerce'),
+                           'entry': entry},
+                          columns=event_columns + ['entry'])
+    events = events[parsed['time'].notnull().values]
+    events.loc[events['event'] == event_codes[TRIAL_START], 'phase'] = 0
+    events['phase'] = events.groupby('entry')['phase'].ffill().fillna(0).astype(np.int64)
+    return events
+
+
+def _read_legacy_output(file_name):
+    """the last outputDict in file_name; Session.close appends one for every call"""
+    output_dict = None
+    with open(file_name, 'rb') as f:
+        while True:
+            try:
+                output_dict = pkl.load(f)
+            except EOFError:
+                break
+            except UnicodeDecodeError:
+                # pickles written by python 2
+                f.seek(0)
+                output_dict = pkl.load(f, encoding='latin1')
+                break
+    return output_dict
+
+
+def read_session(path):
+    """read the events and parameters of a single session as two DataFrames"""
+    import pandas as pd
+
+    base = session_base(path)
+    session = os.path.split(base)[-1]
+    if os.path.exists(base + '_trials.jsonl'):
+        records = list(read_trial_records(base + '_trials.jsonl'))
+        if len(records) > 0:
+            rows = np.concatenate([record_event_rows(record) for record in records])
+        else:
+            rows = np.zeros(0, dtype=[('trial', int), ('phase', int), ('code', int), ('key', object), ('time', float)])
+        events = pd.DataFrame({'session': session,
+                               'trial': rows['trial'],
+                               'phase': rows['phase'].astype(np.int64),
+                               'event': [event_codes[code] for code in rows['code']],
+                               'key': rows['key'].astype(str),
+                               'time': rows['time']},
+                              columns=event_columns)
+        parameters = pd.DataFrame.from_records([record['parameters'] for record in records])
+        parameters.insert(0, 'trial', [record['trial'] for record in records])
+
+    elif os.path.exists(base + '_outputDict.pkl'):
+        output_dict = _read_legacy_output(base + '_outputDict.pkl')
+        events = parse_legacy_events(output_dict['eventArray'], session)
+        # parameterArray entries belong to the eventArray entries with the same index
+        entry_trials = events.groupby('entry')['trial'].first()
+        parameters = pd.DataFrame.from_records(output_dict['parameterArray'])
+        parameters.insert(0, 'trial', entry_trials.reindex(np.arange(parameters.shape[0])).values)
+        events = events.drop('entry', axis=1)
+
+    elif os.path.exists(base + '.tsv'):
+        events = pd.DataFrame(columns=event_columns)
+        parameters = pd.read_csv(base + '.tsv', sep='\t', index_col=0)
+        parameters.insert(0, 'trial', np.arange(parameters.shape[0]))
+    else:
+        raise IOError('no session output found for %s' % path)
+
+    parameters.insert(0, 'session', session)
+    return events.reset_index(drop=True), parameters
+
+
+class SessionData(object):
+    """
+    SessionData holds the events and trial parameters of one or more sessions,
+    and derives the phase, response and trial tables from them.
+    """
+    def __init__(self, events, parameters):
+        self.events = events
+        self.parameters = parameters
+
+    def phases(self):
+        """onset and duration of every phase; a phase lasts until the next phase or the end of its trial"""
+        starts = self.events[self.events['event'].isin([event_codes[TRIAL_START], event_codes[PHASE_START]])]
+        # the trial start is the onset of phase 0
+        starts = starts.drop_duplicates(['session', 'trial', 'phase'], keep='last')
+        phases = starts[['session', 'trial', 'phase', 'time']].rename(columns={'time': 'onset'})
+        phases = phases.sort_values(['session', 'trial', 'onset']).reset_index(drop=True)
+
+        stops = self.events[self.events['event'] == event_codes[TRIAL_STOP]]
+        stops = stops.groupby(['session', 'trial'])['time'].last().rename('trial_stop')
+        phases = phases.join(stops, on=['session', 'trial'])
+        next_onset = phases.groupby(['session', 'trial'])['onset'].shift(-1)
+        phases['offset'] = next_onset.fillna(phases['trial_stop'])
+        phases['duration'] = phases['offset'] - phases['onset']
+        return phases.drop('trial_stop', axis=1)
+
+    def responses(self):
+        """key events, with reaction times relative to the onset of their phase and of their trial"""
+        keys = self.events[self.events['event'] == event_codes[KEY]]
+        phases = self.phases()
+        responses = keys[['session', 'trial', 'phase', 'key', 'time']].merge(
+            phases[['session', 'trial', 'phase', 'onset']], on=['session', 'trial', 'phase'], how='left')
+        trial_onsets = phases[phases['phase'] == 0].set_index(['session', 'trial'])['onset'].rename('trial_onset')
+        responses = responses.join(trial_onsets, on=['session', 'trial'])
+        responses['rt'] = responses['time'] - responses['onset']
+        responses['trial_rt'] = responses['time'] - responses['trial_onset']
+        return responses.rename(columns={'onset': 'phase_onset'})
+
+    def trials(self):
+        """trial parameters with the onset, end and number of responses of every trial"""
+        events = self.events
+        onsets = events[events['event'] == event_codes[TRIAL_START]].groupby(['session', 'trial'])['time'].first()
+        stops = events[events['event'] == event_codes[TRIAL_STOP]].groupby(['session', 'trial'])['time'].last()
+        nr_responses = events[events['event'] == event_codes[KEY]].groupby(['session', 'trial']).size()
+        trials = self.parameters.join(onsets.rename('onset'), on=['session', 'trial'])
+        trials = trials.join(stops.rename('stop'), on=['session', 'trial'])
+        trials = trials.join(nr_responses.rename('nr_responses'), on=['session', 'trial'])
+        trials['nr_responses'] = trials['nr_responses'].fillna(0).astype(np.int64)
+        return trials
+
+
+def _cache_key(base):
+    sha1 = hashlib.sha1(('%d %s' % (cache_version, os.path.abspath(base))).encode('utf-8'))
+    for suffix in output_suffixes:
+        if os.path.exists(base + suffix):
+            stat = os.stat(base + suffix)
+            sha1.update(('%s %d %f' % (suffix, stat.st_size, stat.st_mtime)).encode('utf-8'))
+    return sha1.hexdigest()
+
+
+def _cache_format():
+    """parquet if an engine for it is installed, pickled DataFrames otherwise"""
+    for engine in ['pyarrow', 'fastparquet']:
+        try:
+            __import__(engine)
+            return 'parquet'
+        except ImportError:
+            continue
+    return 'pkl'
+
+
+def _parquet_value(value):
+    return None if value is None else json.dumps(value, default=str)
+
+
+def _json_value(value):
+    return None if value is None else json.loads(value)
+
+
+def _write_table(table, file_name, extension):
+    if extension == 'parquet':
+        # parquet needs string column names and columns of a single type
+        table = table.copy()
+        table.columns = [str(column) for column in table.columns]
+        for column in table.columns:
+            if table[column].dtype != object:
+                continue
+            if table[column].map(lambda value: value is None or isinstance(value, str)).all():
+                table = table.rename(columns={column: object_column_prefix + column})
+            else:
+                table[column] = table[column].map(_parquet_value)
+                table = table.rename(columns={column: json_column_prefix + column})
+        table.to_parquet(file_name)
+    else:
+        table.to_pickle(file_name)
+
+
+def _read_table(file_name):
+    import pandas as pd
+
+    if file_name.endswith('.parquet'):
+        table = pd.read_parquet(file_name)
+        for column in table.columns:
+            if column.startswith(object_column_prefix):
+                table[column] = table[column].astype(object).where(table[column].notna(), None)
+                table = table.rename(columns={column: column[len(object_column_prefix):]})
+            elif column.startswith(json_column_prefix):
+                table[column] = table[column].astype(object).where(table[column].notna(), None).map(_json_value)
+                table = table.rename(columns={column: column[len(json_column_prefix):]})
+        return table
+    return pd.read_pickle(file_name)
+
+
+def _load_cached(arguments):
+    """read a session through the cache in cache_dir; a module-level function so it can run in a process pool"""
+    path, cache_dir = arguments
+    if cache_dir is None:
+        return read_session(path)
+    base = session_base(path)
+    key = _cache_key(base)
+    extension = _cache_format()
+    cache_files = [os.path.join(cache_dir, '%s_%s.%s' % (key, table, extension)) for table in ['events', 'parameters']]
+    if all(os.path.exists(cache_file) for cache_file in cache_files):
+        return tuple(_read_table(cache_file) for cache_file in cache_files)
+    tables = read_session(path)
+    for table, cache_file in zip(tables, cache_files):
+        # write to a temporary file first, so an interrupted write never leaves a broken cache entry
+        _write_table(table, cache_file + '.tmp', extension)
+        os.rename(cache_file + '.tmp', cache_file)
+    return tables
+
+
+def load_session(path, cache_dir=None):
+    """load a single session, from its output_file or any of its output files"""
+    if cache_dir is not None and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    return SessionData(*_load_cached((path, cache_dir)))
+
+
+def load_sessions(paths, cache_dir=None, max_workers=None):
+    """
+    load many sessions into one SessionData, parsing them in max_workers processes
+    (by default one per cpu). Every output file of a session may be given, each session is read once.
+    """
+    import pandas as pd
+
+    if cache_dir is not None and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    bases = []
+    for path in paths:
+        if session_base(path) not in bases:
+            bases.append(session_base(path))
+    if len(bases) == 1 or max_workers == 1:
+        tables = [_load_cached((base, cache_dir)) for base in bases]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            tables = list(executor.map(_load_cached, [(base, cache_dir) for base in bases]))
+    if len(tables) == 0:
+        return SessionData(pd.DataFrame(columns=event_columns), pd.DataFrame(columns=['session', 'trial']))
+    return SessionData(pd.concat([events for events, parameters in tables], ignore_index=True),
+                       pd.concat([parameters for events, parameters in tables], ignore_index=True, sort=False))
+
+
+def test_session_outputs():
+    import tempfile
+    import pandas as pd
+    from ..core.events import EventLog, render_events
+    from ..core.output import TrialWriter
+
+    directory = tempfile.mkdtemp()
+    new_session = os.path.join(directory, 'ab_1_new')
+    old_session = os.path.join(directory, 'ab_1_old')
+
+    writer = TrialWriter(new_session + '_trials.jsonl')
+    legacy = {'parameterArray': [], 'eventArray': []}
+    log = EventLog()
+    for trial in range(3):
+        start = trial * 2.0
+        log.append(trial, 0, TRIAL_START, start)
+        log.append(trial, 1, PHASE_START, start + 0.5)
+        log.append(trial, 1, KEY, start + 0.8, key='space')
+        log.append(trial, 1, TRIAL_STOP, start + 1.5)
+        parameters = {'contrast': trial * 0.1, 'label': 'trial %d' % trial if trial else None,
+                      'positions': [trial, -trial] if trial < 2 else None}
+        writer.write(trial, parameters, log.rows())
+        legacy['parameterArray'].append(parameters)
+        legacy['eventArray'].append(render_events(log.rows()))
+        log.clear()
+    writer.close()
+    with open(old_session + '_outputDict.pkl', 'wb') as f:
+        pkl.dump(legacy, f)
+
+    data = load_sessions([new_session + '_trials.jsonl', old_session], cache_dir=os.path.join(directory, 'cache'))
+    responses = data.responses()
+    assert(np.allclose(responses['rt'], 0.3) and np.allclose(responses['trial_rt'], 0.8))
+    phases = data.phases()
+    new_phases = phases[phases['session'] == 'ab_1_new']
+    assert(np.allclose(new_phases['duration'], [0.5, 1.0] * 3))
+    trials = data.trials()
+    assert(trials.shape[0] == 6 and (trials['nr_responses'] == 1).all())
+    # the second load comes from the cache
+    cached = load_sessions([new_session, old_session], cache_dir=os.path.join(directory, 'cache'), max_workers=1)
+    assert(cached.events.shape == data.events.shape)
+    # and gives the same tables as a fresh load, also in object columns that are not strings
+    pd.testing.assert_frame_equal(cached.events, data.events)
+    pd.testing.assert_frame_equal(cached.parameters, data.parameters)
+    assert(cached.parameters['positions'][1] == [1, -1])
@@ -1,3 +1,16 @@
-from . import session
-from session import Session, MRISession
-from trial import Trial, MRITrial
+import importlib
+
+# classes are imported from their modules on first use, see exptools/__init__.py
+_exports = {'Session': 'session',
+            'MRISession': 'session',
+            'EyelinkSession': 'session',
+            'StarStimSession': 'session',
+            'SoundSession': 'session',
+            'Trial': 'trial',
+            'MRITrial': 'trial'}
+
+
+def __getattr__(name):
+    if name in _exports:
+        return getattr(importlib.import_module('.' + _exports[name], __name__), name)
+    raise AttributeError('module %s has no attribute %s' % (__name__, name))
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+bids.py
+
+BIDS events files, written while the session runs. Every trial phase becomes a
+row with its onset and duration, and every response a row of zero duration.
+Onsets are relative to the first MRI trigger. A row is appended to the
+events.tsv file as soon as it is complete, so the file exists even when a run
+is aborted; at close the rows are sorted by onset and the JSON sidecar that
+describes the columns is written. Existing events files are never overwritten. In a session, rows are written by the
+background thread of the session's TrialWriter, not in the frame loop.
+Files are named sub-<label>[_ses-<label>]_task-<label>_run-<index>_events.tsv.
+"""
+
+import os
+import re
+import json
+from collections import deque
+
+import numpy as np
+
+columns = ['onset', 'duration', 'trial_type', 'trial', 'phase', 'response', 'response_time']
+
+column_descriptions = {
+    'onset': {'Description': 'onset of the event relative to the first MRI trigger', 'Units': 's'},
+    'duration': {'Description': 'duration of the event, 0 for responses', 'Units': 's'},
+    'trial_type': {'Description': 'trial phase, as named by Trial.bids_trial_type, or response'},
+    'trial': {'Description': 'trial ID'},
+    'phase': {'Description': 'phase of the trial'},
+    'response': {'Description': 'key that was pressed, n/a for phases'},
+    'response_time': {'Description': 'time of the response relative to the onset of its phase', 'Units': 's'},
+}
+
+
+def bids_label(label):
+    """label with everything but letters and digits removed, as BIDS entity labels are"""
+    label = re.sub('[^a-zA-Z0-9]', '', str(label))
+    if not label:
+        raise ValueError('a BIDS label needs letters or digits')
+    return label
+
+
+def bids_file_name(subject, task, run=None, session=None, suffix='events', extension='.tsv'):
+    """the BIDS file name sub-<subject>[_ses-<session>]_task-<task>[_run-<run>]_<suffix><extension>"""
+    entities = ['sub-%s' % bids_label(subject)]
+    if session is not None:
+        entities.append('ses-%s' % bids_label(session))
+    entities.append('task-%s' % bids_label(task))
+    if run is not None:
+        entities.append('run-%d' % int(run))
+    return '_'.join(entities + [suffix]) + extension
+
+
+def _format(value):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return 'n/a'
+    if isinstance(value, float):
+        return '%.4f' % value
+    return str(value)
+
+
+class BIDSEventWriter(object):
+    """
+    BIDSEventWriter builds the events.tsv file file_name from phase starts, trial stops, responses
+    and MRI triggers. Rows completed before the first trigger wait until it arrives, as their onsets
+    are relative to it. Responses with a key in ignore_keys, like the trigger key, are not events.
+    With a writer, a TrialWriter, rows are written on its thread, so that adding them never 
+    waits on the disk. An existing file_name, e.g. of an earlier run with the same name, is never
+    overwritten: FileExistsError is raised instead.
+    """
+    def __init__(self, file_name, ignore_keys=(), reference_time=None, writer=None):
+        self.file_name = file_name
+        self.writer = writer
+        self.sidecar_file_name = os.path.splitext(file_name)[0] + '.json'
+        self.ignore_keys = set(ignore_keys)
+        self.reference_time = reference_time
+        self.nr_rows = 0
+        self._pending = deque()
+        self._open_phase = None
+        try:
+            self._file = open(self.file_name, 'x')
+        except FileExistsError:
+            raise FileExistsError('%s exists already, give this run another run or session label to keep both' 
+                                  % self.file_name)
+        self._file.write('\t'.join(columns) + '\n')
+        self._file.flush()
+
+    def trigger(self, time):
+        """register an MRI trigger; the first sets the time that onsets are relative to"""
+        if self.reference_time is None:
+            self.reference_time = time
+            while self._pending:
+                self._write(self._pending.popleft())
+
+    def phase_started(self, trial, phase, time, trial_type):
+        """start a phase row; this ends the previous phase"""
+        self._close_phase(time)
+        self._open_phase = (time, trial_type, trial, phase)
+
+    def trial_stopped(self, time):
+        self._close_phase(time)
+
+    def response(self, trial, phase, key, time):
+        if key in self.ignore_keys:
+            return
+        response_time = None
+        if self._open_phase is not None and self._open_phase[2] == trial:
+            response_time = time - self._open_phase[0]
+        self._add((time, 0.0, 'response', trial, phase, key, response_time))
+
+    def _close_phase(self, time):
+        if self._open_phase is not None:
+            onset, trial_type, trial, phase = self._open_phase
+            self._open_phase = None
+            self._add((onset, time - onset, trial_type, trial, phase, None, None))
+
+    def _add(self, row):
+        if self.reference_time is None:
+            self._pending.append(row)
+        else:
+            self._write(row)
+
+    def _write(self, row):
+        row = (row[0] - self.reference_time,) + row[1:]
+        self.nr_rows += 1
+        if self.writer is not None and not self.writer.closed:
+            self.writer.call(self._write_row, row)
+        else:
+            self._write_row(row)
+
+    def _write_row(self, row):
+        self._file.write('\t'.join(_format(value) for value in row) + '\n')
+        self._file.flush()
+
+    def close(self, time, fallback_reference_time=0.0):
+        """
+        end an unfinished phase at time, and write the sorted events file and the sidecar.
+        Without any trigger, onsets are relative to fallback_reference_time.
+        """
+        import pandas as pd
+
+        self._close_phase(time)
+        if self.reference_time is None:
+            descriptions = dict(column_descriptions,
+                                onset={'Description': 'onset of the event relative to the start of the session, '
+                                                      'no MRI trigger was received', 'Units': 's'})
+            self.trigger(fallback_reference_time)
+        else:
+            descriptions = column_descriptions
+        if self.writer is not None and not self.writer.closed:
+            self.writer.flush()
+        self._file.close()
+
+        events = pd.read_csv(self.file_name, sep='\t', na_values='n/a', keep_default_na=False,
+                             dtype={'trial_type': str, 'response': str})
+        events = events.sort_values('onset', kind='mergesort')
+        events.to_csv(self.file_name, sep='\t', index=False, na_rep='n/a', float_format='%.4f')
+        with open(self.sidecar_file_name, 'w') as f:
+            json.dump(descriptions, f, indent=2, sort_keys=True)
+
+
+def test_bids_event_writer():
+    import tempfile
+    from .output import TrialWriter
+
+    assert(bids_file_name('G.d.H', 'orientation-task', run='2') == 'sub-GdH_task-orientationtask_run-2_events.tsv')
+    assert(bids_file_name('01', 'rest', session=1, suffix='events', extension='.json') == 'sub-01_ses-1_task-rest_events.json')
+
+    directory = tempfile.mkdtemp()
+    file_name = os.path.join(directory, bids_file_name('01', 'test', run=1))
+    trial_writer = TrialWriter(os.path.join(directory, 'trials.jsonl'))
+    writer = BIDSEventWriter(file_name, ignore_keys=['t'], writer=trial_writer)
+    writer.phase_started(0, 0, 9.0, 'fixation')
+    writer.trigger(10.0)
+    writer.trigger(12.0)
+    writer.phase_started(0, 1, 10.5, 'stimulus')
+    writer.response(0, 1, 't', 12.0)
+    writer.response(0, 1, 'space', 11.0)
+    # an aborted run: the stimulus phase is never stopped, but the finished rows are on disk
+    trial_writer.flush()
+    with open(file_name) as f:
+        assert(len(f.readlines()) == 3)
+    writer.close(12.5)
+    trial_writer.close()
+
+    with open(file_name) as f:
+        lines = [line.rstrip('\n').split('\t') for line in f]
+    assert(lines[0] == columns)
+    assert([line[0] for line in lines[1:]] == ['-1.0000', '0.5000', '1.0000'])
+    assert(lines[2][:3] == ['0.5000', '2.0000', 'stimulus'] and lines[1][5] == 'n/a')
+    assert(lines[3][5:] == ['space', '0.5000'])
+    assert(os.path.exists(file_name[:-len('.tsv')] + '.json'))
+
+    # a repeated run with the same name leaves the earlier events in place
+    try:
+        BIDSEventWriter(file_name)
+        assert(False)
+    except FileExistsError:
+        pass
+    with open(file_name) as f:
+        assert(len(f.readlines()) == 4)
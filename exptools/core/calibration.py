@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+calibration.py
+
+Calibration and validation target layouts for the EyeLink. A layout is a set of
+unit coordinates in EyeLink order, HV5, HV9, HV13 or a custom grid, that is
+scaled to the screen, or to one half of it in split-screen setups, as an array
+of pixel coordinates. The tracker commands for a calibration are formatted once
+per screen size and layout, and sent to the tracker in a single pass.
+"""
+
+import functools
+
+import numpy as np
+
+# unit coordinates, x to the right and y down as in EyeLink screen coordinates, in the order
+# EyeLink expects them. HV9 on screen:    HV13 on screen:
+#   5 1 6                                   5  1  6
+#   3 0 4                                     9 10
+#   7 2 8                                   3  0  4
+#                                            11 12
+#                                           7  2  8
+layouts = {
+    'HV5': ((0, 0), (0, -1), (0, 1), (-1, 0), (1, 0)),
+}
+layouts['HV9'] = layouts['HV5'] + ((-1, -1), (1, -1), (-1, 1), (1, 1))
+layouts['HV13'] = layouts['HV9'] + ((-0.5, -0.5), (0.5, -0.5), (-0.5, 0.5), (0.5, 0.5))
+
+class CalibrationLayout(object):
+    """
+    CalibrationLayout places the points of layout, a name in layouts or a sequence of unit
+    coordinates in EyeLink order, on the screen. The points span either extent times the screen
+    height (in both directions), or the screen up to margin pixels from its edges. With screen_half
+    'L' or 'R' they are placed on that half of the screen only. offset (x, y) shifts them in
+    pixels, and corner_eccentricity pulls the four corner points towards the center.
+    """
+    def __init__(self, layout='HV9', extent=None, margin=None, screen_half=None, offset=(0, 0), corner_eccentricity=1.0):
+        if (extent is None) == (margin is None):
+            raise ValueError('a calibration layout needs either an extent or a margin')
+        if screen_half not in (None, 'L', 'R'):
+            raise ValueError('screen_half should be None, \'L\' or \'R\', not %r' % (screen_half,))
+        if isinstance(layout, str):
+            self.name = layout
+            self.unit_points = layouts[layout]
+        else:
+            self.name = 'custom'
+            self.unit_points = tuple((float(x), float(y)) for x, y in layout)
+        self.extent = extent
+        self.margin = margin
+        self.screen_half = screen_half
+        self.offset = tuple(offset)
+        self.corner_eccentricity = corner_eccentricity
+
+    @classmethod
+    def from_points(cls, points, size):
+        """a custom layout of (n, 2) pixel coordinates on a screen of size, as older scripts gave them"""
+        half_size = np.array(size, dtype=float) / 2.0
+        return cls((np.asarray(points, dtype=float) - half_size) / half_size, margin=0)
+
+    def _key(self):
+        return (self.unit_points, self.extent, self.margin, self.screen_half, self.offset, self.corner_eccentricity)
+
+    def __eq__(self, other):
+        return isinstance(other, CalibrationLayout) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return 'CalibrationLayout(%s, %d points)' % (self.name, len(self.unit_points))
+
+    @property
+    def calibration_type(self):
+        return 'HV%d' % len(self.unit_points)
+
+    def area(self, size):
+        """left, top, width and height in pixels of the part of the screen the points are placed on"""
+        if self.screen_half is None:
+            return 0, 0, size[0], size[1]
+        return (0 if self.screen_half == 'L' else size[0] / 2.0), 0, size[0] / 2.0, size[1]
+
+    def points(self, size):
+        """the points as an (n, 2) integer array of pixel coordinates on a screen of size (width, height)"""
+        left, top, width, height = self.area(size)
+        unit = np.array(self.unit_points, dtype=float)
+        corners = (np.abs(unit) == 1).all(axis=1)
+        unit[corners] *= self.corner_eccentricity
+        if self.extent is not None:
+            half_span = np.array([self.extent * height / 2.0] * 2)
+        else:
+            half_span = np.array([width / 2.0 - self.margin, height / 2.0 - self.margin])
+        center = np.array([left + width / 2.0, top + height / 2.0]) + self.offset
+        points = np.round(center + unit * half_span).astype(int)
+
+        outside = ~((points[:, 0] >= left) & (points[:, 0] <= left + width) &
+                    (points[:, 1] >= top) & (points[:, 1] <= top + height))
+        if outside.any():
+            raise ValueError('%r has points outside of the screen area %s: %s'
+                             % (self, (left, top, width, height), points[outside].tolist()))
+        return points
+
+
+def format_points(points):
+    """points in the format of the calibration_targets command, 'x1,y1 x2,y2 ... xn,yn'"""
+    return ' '.join('%d,%d' % (x, y) for x, y in points)
+
+
+def parse_points(targets):
+    """points in the format of the calibration_targets command as an (n, 2) array"""
+    return np.array([[float(value) for value in point.split(',')] for point in targets.split()])
+
+
+@functools.lru_cache(maxsize=64)
+def _calibration_commands(calibration, validation, size, randomize_order, repeat_first_target, point_indices):
+    calibration_points = calibration.points(size)
+    validation_points = validation.points(size)
+    if len(validation_points) != len(calibration_points):
+        raise ValueError('calibration and validation layouts have different numbers of points')
+    n_points = len(calibration_points)
+    if point_indices is None:
+        # point_indices: '0, 1, ... n'
+        point_indices = ', '.join('%d' % pi for pi in range(n_points))
+    n_samples = n_points + 1 if repeat_first_target else n_points
+    return ('calibration_type = %s' % calibration.calibration_type,
+            'generate_default_targets = NO',
+            'randomize_calibration_order %d' % randomize_order,
+            'randomize_validation_order %d' % randomize_order,
+            'cal_repeat_first_target  %d' % repeat_first_target,
+            'val_repeat_first_target  %d' % repeat_first_target,
+            'calibration_samples=%d' % n_samples,
+            'calibration_sequence=%s' % point_indices,
+            'calibration_targets = %s' % format_points(calibration_points),
+            'validation_samples=%d' % n_samples,
+            'validation_sequence=%s' % point_indices,
+            'validation_targets = %s' % format_points(validation_points))
+
+
+def calibration_commands(calibration, size, validation=None, randomize_order=False, repeat_first_target=True,
+                         point_indices=None):
+    """
+    the tracker commands that set up a calibration with the calibration layout, and validation
+    with the validation layout (by default the calibration layout), on a screen of size. The
+    points are shown in the order of point_indices, '0, 1, ... n' by default. The commands are
+    formatted once for every screen size and pair of layouts, later calls reuse them.
+    """
+    if validation is None:
+        validation = calibration
+    return _calibration_commands(calibration, validation, (int(size[0]), int(size[1])),
+                                 int(randomize_order), int(repeat_first_target), point_indices)
+
+
+def send_commands(tracker, commands):
+    """send commands to the tracker in one pass, in order"""
+    send_command = tracker.send_command
+    for command in commands:
+        send_command(command)
+
+
+def test_calibration_layouts():
+    size = (1920, 1080)
+    nine = CalibrationLayout('HV9', extent=0.7).points(size)
+    assert(nine.shape == (9, 2))
+    # EyeLink order: center, up, down, left, right, then the corners
+    assert(nine[0].tolist() == [960, 540] and nine[1].tolist() == [960, 162] and nine[2].tolist() == [960, 918])
+    assert(nine[3, 0] < nine[0, 0] < nine[4, 0] and nine[5].tolist() == [nine[3, 0], nine[1, 1]])
+    thirteen = CalibrationLayout('HV13', extent=0.7).points(size)
+    assert((thirteen[:9] == nine).all() and thirteen[9].tolist() == [771, 351])
+
+    right = CalibrationLayout('HV9', margin=60, screen_half='R').points(size)
+    assert(right[:, 0].min() == 960 + 60 and right[:, 0].max() == 1920 - 60 and right[0].tolist() == [1440, 540])
+
+    custom = CalibrationLayout([(0, 0), (-1, 0), (1, 0)], extent=0.5, offset=(100, 0))
+    assert(custom.calibration_type == 'HV3' and custom.points(size)[:, 0].tolist() == [1060, 790, 1330])
+    try:
+        CalibrationLayout('HV5', extent=1.2).points(size)
+        assert(False)
+    except ValueError:
+        pass
+
+    points = parse_points(format_points(nine))
+    assert((points == nine).all() and (CalibrationLayout.from_points(points, size).points(size) == nine).all())
+    # targets on the screen edges are on the screen
+    edges = CalibrationLayout.from_points([(0, 0), (1920, 1080)], size)
+    assert(edges.points(size).tolist() == [[0, 0], [1920, 1080]] and edges.calibration_type == 'HV2')
+
+    calibration = CalibrationLayout('HV9', extent=0.7, corner_eccentricity=0.5)
+    commands = calibration_commands(calibration, size, CalibrationLayout('HV9', extent=0.7 * 0.75))
+    assert(commands[0] == 'calibration_type = HV9' and 'calibration_samples=10' in commands)
+    assert(commands[8] == 'calibration_targets = %s' % format_points(calibration.points(size)))
+    # a re-calibration with equal layouts reuses the formatted commands
+    assert(calibration_commands(CalibrationLayout('HV9', extent=0.7, corner_eccentricity=0.5), size,
+                                CalibrationLayout('HV9', extent=0.7 * 0.75)) is commands)
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+design.py
+
+Columnar design files. A design directory (name.design) holds one .npy file per
+parameter plus phase_durations.npy and phase_onsets.npy. Columns are memory-mapped
+on loading, so only the columns and rows a session uses are read from disk.
+Designs can also be read from .npz files, from Parquet and Feather files through
+pyarrow, and from CSV files through pandas; these readers are also only given
+the columns and rows that are needed.
+
+Legacy pickled input can be converted with convert_legacy_design. Pickles can
+run arbitrary code when they are loaded, so they are read with an unpickler
+that only accepts containers, numpy arrays and pandas frames, and a warning
+recommends converting them.
+"""
+
+import os
+import pickle as pkl
+import warnings
+
+import numpy as np
+
+from .schedule import TrialSchedule
+
+design_extensions = ['.design', '.npz', '.parquet', '.feather', '.pkl', '.csv']
+
+_phase_files = ['phase_durations', 'phase_onsets']
+
+
+def _phase_columns(names):
+    """the 'phase_<i>_duration' columns among names, in phase order"""
+    phase_columns = [name for name in names if name.startswith('phase_') and name.endswith('_duration')]
+    return sorted(phase_columns, key=lambda name: int(name.split('_')[1]))
+
+
+def _storable(column):
+    column = np.asarray(column)
+    if column.dtype == object:
+        # np.save would pickle object arrays, store them as fixed-width strings instead
+        column = column.astype(str)
+    return column
+
+
+def save_design(schedule, path):
+    """save a TrialSchedule as a design directory at path"""
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for name, column in schedule.parameters.items():
+        if name in _phase_files:
+            raise ValueError('parameter name %s is reserved for phase timings' % name)
+        np.save(os.path.join(path, name + '.npy'), _storable(column), allow_pickle=False)
+    np.save(os.path.join(path, 'phase_durations.npy'), schedule.phase_durations)
+    np.save(os.path.join(path, 'phase_onsets.npy'), np.asarray(schedule.phase_onsets))
+
+
+def _select(schedule_arrays, rows):
+    if rows is None:
+        return schedule_arrays
+    return [column[rows] for column in schedule_arrays]
+
+
+def load_design(path, columns=None, rows=None):
+    """
+    load a design as a TrialSchedule. columns limits the parameters that are read,
+    rows (a slice or index array) the trials. Design directories are memory-mapped,
+    a slice of rows stays a view on the file.
+    """
+    extension = os.path.splitext(path)[1]
+    if extension == '.design' or (os.path.isdir(path) and extension == ''):
+        names = [os.path.splitext(f)[0] for f in sorted(os.listdir(path)) if f.endswith('.npy')]
+        if columns is None:
+            columns = [name for name in names if name not in _phase_files]
+        arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in list(columns) + _phase_files]
+        arrays = _select(arrays, rows)
+        return TrialSchedule(dict(zip(columns, arrays[:-2])), arrays[-2], arrays[-1])
+
+    elif extension == '.npz':
+        # npz members can not be memory-mapped, but only the requested ones are read
+        npz = np.load(path, allow_pickle=False)
+        if columns is None:
+            columns = [name for name in npz.files if name not in _phase_files]
+        arrays = _select([npz[name] for name in columns] + [npz['phase_durations']], rows)
+        onsets = None
+        if 'phase_onsets' in npz.files:
+            onsets = _select([npz['phase_onsets']], rows)[0]
+        return TrialSchedule(dict(zip(columns, arrays[:-1])), arrays[-1], onsets)
+
+    elif extension in ['.parquet', '.feather']:
+        data_frame = _read_arrow(path, extension, columns, rows)
+        return TrialSchedule.from_dataframe(data_frame, _phase_columns(data_frame.columns))
+
+    elif extension == '.csv':
+        data_frame = _read_csv(path, columns, rows)
+        return TrialSchedule.from_dataframe(data_frame, _phase_columns(data_frame.columns))
+
+    elif extension == '.pkl':
+        return legacy_to_schedule(load_pickle(path))
+
+    raise ValueError('unknown design file format: %s' % path)
+
+
+def _with_phase_columns(columns, all_columns):
+    """the requested columns plus the phase duration columns, None for all columns"""
+    if columns is None:
+        return None
+    return list(columns) + _phase_columns(all_columns)
+
+
+def _read_arrow(path, extension, columns, rows):
+    """
+    read columns and rows of a parquet or feather file into a DataFrame. Of parquet files only 
+    the row groups that hold the rows are read; feather files are memory-mapped, and only 
+    the pages of the selected columns and rows are touched when they are converted.
+    """
+    import pyarrow as pa
+
+    if extension == '.parquet':
+        import pyarrow.parquet as pq
+
+        parquet = pq.ParquetFile(path, memory_map=True)
+        columns = _with_phase_columns(columns, parquet.schema_arrow.names)
+        if rows is None:
+            return parquet.read(columns=columns).to_pandas()
+        indices = np.arange(parquet.metadata.num_rows)[rows]
+        group_sizes = [parquet.metadata.row_group(i).num_rows for i in range(parquet.num_row_groups)]
+        group_starts = np.cumsum([0] + group_sizes)
+        index_groups = np.searchsorted(group_starts, indices, side='right') - 1
+        groups = np.unique(index_groups)
+        # where every selected group starts in the table of selected groups
+        table_starts = dict(zip(groups, np.cumsum([0] + [group_sizes[group] for group in groups])))
+        table = parquet.read_row_groups(groups.tolist(), columns=columns)
+        local = indices - group_starts[index_groups] + np.array([table_starts[group] for group in index_groups], dtype=int)
+        return table.take(pa.array(local)).to_pandas()
+
+    table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+    columns = _with_phase_columns(columns, table.schema.names)
+    if columns is not None:
+        table = table.select(columns)
+    if rows is not None:
+        table = table.take(pa.array(np.arange(table.num_rows)[rows]))
+    return table.to_pandas()
+
+
+def _read_csv(path, columns, rows):
+    """read columns and rows of a csv file; a contiguous slice of rows is read without parsing the others"""
+    import pandas as pd
+
+    usecols = _with_phase_columns(columns, pd.read_csv(path, nrows=0).columns)
+    if isinstance(rows, slice) and rows.step in (None, 1) and (rows.start or 0) >= 0 and \
+            (rows.stop is None or rows.stop >= 0):
+        start = rows.start or 0
+        nrows = None if rows.stop is None else max(0, rows.stop - start)
+        return pd.read_csv(path, usecols=usecols, skiprows=range(1, start + 1), nrows=nrows)
+    data_frame = pd.read_csv(path, usecols=usecols)
+    if rows is not None:
+        data_frame = data_frame.iloc[rows]
+    return data_frame
+
+
+# the globals that legacy design pickles may refer to: containers, numpy arrays and pandas frames
+_safe_builtins = set(['list', 'dict', 'tuple', 'set', 'frozenset', 'int', 'float', 'complex', 'bool', 
+                      'str', 'bytes', 'bytearray', 'unicode', 'long', 'slice', 'range', 'object'])
+_safe_globals = {'collections': set(['OrderedDict']),
+                 'copy_reg': set(['_reconstructor']),
+                 'copyreg': set(['_reconstructor']),
+                 'datetime': set(['datetime', 'date', 'time', 'timedelta', 'timezone']),
+                 'numpy': set(['ndarray', 'dtype', 'float64', 'float32', 'int64', 'int32', 'bool_']),
+                 'pandas': set(['DataFrame', 'Series', 'Index', 'RangeIndex', 'MultiIndex', 'Categorical', 
+                                'CategoricalDtype', 'StringDtype']),
+                 # the string columns of pandas frames can be backed by arrow arrays
+                 'pyarrow.lib': set(['_restore_array', 'py_buffer', 'type_for_alias'])}
+_safe_module_prefixes = ('numpy.core.multiarray', 'numpy._core.multiarray', 'numpy.core.numeric', 
+                         'numpy._core.numeric', 'pandas.core.frame', 'pandas.core.series', 'pandas.core.indexes', 
+                         'pandas.core.internals', 'pandas.core.arrays', 'pandas.core.dtypes', 'pandas.arrays', 
+                         'pandas._libs')
+
+
+class _DesignUnpickler(pkl.Unpickler):
+    """an unpickler that refuses every global that is not needed for containers, arrays and frames"""
+    def find_class(self, module, name):
+        if module in ('builtins', '__builtin__'):
+            allowed = name in _safe_builtins
+        elif module in _safe_globals:
+            allowed = name in _safe_globals[module]
+        else:
+            allowed = module.startswith(_safe_module_prefixes)
+        if not allowed:
+            raise pkl.UnpicklingError('%s.%s is not allowed in design pickles' % (module, name))
+        return super(_DesignUnpickler, self).find_class(module, name)
+
+
+def load_pickle(path):
+    """
+    load a legacy design pickle with an unpickler that only accepts containers, numpy 
+    arrays and pandas frames, and warn that the design should be converted.
+    """
+    warnings.warn('%s is a pickled design, which is slow to load and unsafe with files from others; '
+                  'convert it with exptools.core.design.convert_legacy_design' % path)
+    with open(path, 'rb') as f:
+        try:
+            return _DesignUnpickler(f).load()
+        except UnicodeDecodeError:
+            # pickles written by python 2
+            f.seek(0)
+            return _DesignUnpickler(f, encoding='latin1').load()
+
+
+def legacy_to_schedule(input_data):
+    """
+    convert the contents of a legacy input pickle to a TrialSchedule. Supported layouts are
+    a (parameters, timings) pair of arrays, a pandas DataFrame with 'phase_<i>_duration'
+    columns, a list of parameter dicts and a 2-d array whose rows are trials.
+    Layouts without timings get zero phases.
+    """
+    if isinstance(input_data, TrialSchedule):
+        return input_data
+    if hasattr(input_data, 'columns'):
+        return TrialSchedule.from_dataframe(input_data, _phase_columns(input_data.columns))
+    if isinstance(input_data, (list, tuple)) and len(input_data) == 2 and not isinstance(input_data[0], dict):
+        parameters, timings = input_data
+        if hasattr(parameters, 'columns'):
+            parameter_dict = dict((name, parameters[name].values) for name in parameters.columns)
+        else:
+            parameters = np.asarray(parameters)
+            if parameters.ndim == 1:
+                parameters = parameters[:, np.newaxis]
+            parameter_dict = dict(('parameter_%d' % i, parameters[:, i]) for i in range(parameters.shape[1]))
+        return TrialSchedule(parameter_dict, np.asarray(timings, dtype=np.float64))
+    if len(input_data) > 0 and isinstance(input_data[0], dict):
+        return TrialSchedule.from_records(input_data, np.zeros((len(input_data), 0)))
+    input_data = np.asarray(input_data)
+    if input_data.ndim == 1:
+        input_data = input_data[:, np.newaxis]
+    return TrialSchedule(dict(('parameter_%d' % i, input_data[:, i]) for i in range(input_data.shape[1])),
+                         np.zeros((input_data.shape[0], 0)))
+
+
+def convert_legacy_design(pickle_path, output_path=None):
+    """convert a legacy input pickle to a design directory, by default next to it with a .design extension"""
+    if output_path is None:
+        output_path = os.path.splitext(pickle_path)[0] + '.design'
+    schedule = legacy_to_schedule(load_pickle(pickle_path))
+    save_design(schedule, output_path)
+    return output_path
+
+
+def find_design_file(base_name):
+    """the first existing file base_name + extension, in the order of design_extensions"""
+    for extension in design_extensions:
+        if os.path.exists(base_name + extension):
+            return base_name + extension
+    return None
+
+
+def test_design_round_trip():
+    import tempfile
+    import pandas as pd
+
+    directory = tempfile.mkdtemp()
+    nr_trials = 20
+    schedule = TrialSchedule({'orientation': np.tile([0, 45, 90, 135], nr_trials // 4),
+                              'contrast': np.linspace(0, 1, nr_trials),
+                              'image': np.array(['face_%d.png' % i for i in range(nr_trials)])},
+                             np.tile([0.5, 0.2, 1.0], (nr_trials, 1)))
+
+    save_design(schedule, os.path.join(directory, 'run.design'))
+    np.savez(os.path.join(directory, 'run.npz'), phase_durations=schedule.phase_durations, **schedule.parameters)
+    schedule.to_dataframe().to_csv(os.path.join(directory, 'run.csv'), index=False)
+    extensions = ['.design', '.npz', '.csv']
+    try:
+        schedule.to_dataframe().to_parquet(os.path.join(directory, 'run.parquet'), row_group_size=6)
+        schedule.to_dataframe().to_feather(os.path.join(directory, 'run.feather'))
+        extensions += ['.parquet', '.feather']
+    except ImportError:
+        pass
+
+    for extension in extensions:
+        path = os.path.join(directory, 'run' + extension)
+        loaded = load_design(path)
+        assert(loaded.validate() and len(loaded) == nr_trials)
+        assert(np.allclose(loaded.phase_durations, schedule.phase_durations))
+        assert((loaded.parameters['image'] == schedule.parameters['image']).all())
+        for rows in [slice(5, 13), np.array([19, 0, 7, 12])]:
+            part = load_design(path, columns=['contrast'], rows=rows)
+            assert(list(part.parameters) == ['contrast'] and part.nr_phases == 3)
+            assert(np.allclose(part.parameters['contrast'], schedule.parameters['contrast'][rows]))
+            assert(np.allclose(part.phase_onsets, schedule.phase_onsets[rows]))
+
+    # legacy pickles of arrays and frames load, pickles that call other functions do not
+    pickle_path = os.path.join(directory, 'legacy.pkl')
+    with open(pickle_path, 'wb') as f:
+        pkl.dump([schedule.to_dataframe(), np.zeros(3)], f)
+    with warnings.catch_warnings(record=True):
+        warnings.simplefilter('always')
+        assert(isinstance(load_pickle(pickle_path)[0], pd.DataFrame))
+
+    class Exploit(object):
+        def __reduce__(self):
+            return (os.system, ('echo unsafe',))
+    with open(pickle_path, 'wb') as f:
+        pkl.dump(Exploit(), f)
+    try:
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter('always')
+            load_pickle(pickle_path)
+        assert(False)
+    except pkl.UnpicklingError:
+        pass
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+dispatch.py
+
+Asynchronous dispatch of outbound messages (eyetracker messages and commands,
+EEG triggers) so that the frame loop never blocks on hardware I/O.
+
+Messages reach the tracker later than the event they describe. With
+stamp_offsets, the dispatcher prefixes the messages that ask for it with that
+delay in ms, 'offset text', the EyeLink convention for message time offsets
+that Data Viewer applies. This changes the text of the messages, so it is
+opt-in, and a session that enables it first sends offset_marker to the tracker
+so that parsers know to strip the prefixes (see analysis.eyelink).
+"""
+
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import time as time_module
+import numpy as np
+
+# sent to the tracker by sessions whose dispatcher stamps message offsets
+offset_marker = 'exptools message offsets in ms'
+
+
+class MessageDispatcher(object):
+    """
+    MessageDispatcher sends messages from a worker thread. Messages are put on a queue 
+    together with the clock time at which they were enqueued; the worker sends them no 
+    faster than one per min_interval seconds, so as not to flood the eyelink buffer. 
+    The time between enqueueing and sending is recorded for every message. The queue holds 
+    at most maxsize messages, so a stalled link cannot grow it without limit; messages that 
+    do not fit are dropped and counted in nr_dropped rather than blocking the caller.
+    """
+    def __init__(self, clock, maxsize=10000, min_interval=0.001, latency_capacity=8192, stamp_offsets=False):
+        self.clock = clock
+        self.min_interval = min_interval
+        self.stamp_offsets = stamp_offsets
+        self._queue = queue.Queue(maxsize=maxsize)
+
+        # latencies are kept in a ring buffer of the last latency_capacity messages
+        self._latencies = np.zeros(latency_capacity, dtype=np.float64)
+        self.nr_sent = 0
+        self.nr_errors = 0
+        self.nr_dropped = 0
+        self.last_error = None
+
+        self._thread = threading.Thread(target=self._run, name='MessageDispatcher')
+        self._thread.daemon = True
+        self._thread.start()
+        self.closed = False
+
+    def put(self, send, message, *args, **kwargs):
+        """
+        queue message for sending with send(message). If args are given, the message
+        is formatted as message % args here, so later changes to mutable args do not
+        change it. With stamp_offset=True, and stamp_offsets enabled on the dispatcher,
+        the message is prefixed with its queueing delay in ms, which eyelink interprets
+        as an offset to subtract from the message timestamp. This never blocks.
+        """
+        stamp_offset = kwargs.pop('stamp_offset', False) and self.stamp_offsets
+        if args:
+            message = message % args
+        try:
+            self._queue.put_nowait((send, message, stamp_offset, self.clock.getTime()))
+        except queue.Full:
+            self.nr_dropped += 1
+
+    def _run(self):
+        last_send_time = -np.inf
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            send, message, stamp_offset, enqueue_time = item
+
+            wait = last_send_time + self.min_interval - self.clock.getTime()
+            if wait > 0:
+                time_module.sleep(wait)
+
+            send_time = self.clock.getTime()
+            if stamp_offset:
+                # always stamped, also with a 0 ms offset, so stamped messages can be recognized
+                message = '%d %s' % (int(round((send_time - enqueue_time) * 1000)), message)
+            try:
+                send(message)
+            except Exception as e:
+                self.nr_errors += 1
+                self.last_error = e
+            last_send_time = self.clock.getTime()
+
+            self._latencies[self.nr_sent % self._latencies.shape[0]] = last_send_time - enqueue_time
+            self.nr_sent += 1
+            self._queue.task_done()
+
+    def flush(self):
+        """wait until all queued messages have been sent"""
+        self._queue.join()
+
+    def close(self):
+        """send all queued messages and stop the worker thread"""
+        if self.closed:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self.closed = True
+
+    def latencies(self):
+        """send latencies in seconds of the most recent messages, oldest first"""
+        n = min(self.nr_sent, self._latencies.shape[0])
+        if self.nr_sent <= self._latencies.shape[0]:
+            return self._latencies[:n].copy()
+        start = self.nr_sent % self._latencies.shape[0]
+        return np.roll(self._latencies, -start)
+
+    def latency_summary(self):
+        """summary statistics of the send latencies, in seconds"""
+        latencies = self.latencies()
+        if latencies.shape[0] == 0:
+            return {'nr_sent': 0}
+        return {'nr_sent': self.nr_sent,
+                'nr_errors': self.nr_errors,
+                'nr_dropped': self.nr_dropped,
+                'mean': latencies.mean(),
+                'median': np.median(latencies),
+                'p95': np.percentile(latencies, 95),
+                'max': latencies.max()}
+
+
+def test_message_dispatcher():
+    class WallClock(object):
+        def __init__(self):
+            self.start = time_module.time()
+        def getTime(self):
+            return time_module.time() - self.start
+
+    sent = []
+    dispatcher = MessageDispatcher(WallClock(), min_interval=0)
+    # bounded by default
+    assert(0 < dispatcher._queue.maxsize < np.inf)
+    position = [1, 2]
+    dispatcher.put(sent.append, 'position %s', position)
+    # the message was formatted when it was put, not when it is sent
+    position.append(3)
+    dispatcher.put(sent.append, 'trial %s started', 0, stamp_offset=True)
+    dispatcher.close()
+    assert(sent == ['position [1, 2]', 'trial 0 started'])
+
+    sent = []
+    dispatcher = MessageDispatcher(WallClock(), min_interval=0, stamp_offsets=True)
+    dispatcher.put(sent.append, '3 targets shown', stamp_offset=True)
+    dispatcher.put(sent.append, 'unstamped')
+    dispatcher.close()
+    assert(sent[0].split(' ', 1)[1] == '3 targets shown' and sent[0].split(' ', 1)[0].isdigit())
+    assert(sent[1] == 'unstamped')
+
+    # a full queue drops messages instead of blocking the frame loop
+    import threading
+    release = threading.Event()
+    sent = []
+    def slow_send(message):
+        release.wait()
+        sent.append(message)
+    dispatcher = MessageDispatcher(WallClock(), maxsize=2, min_interval=0)
+    for i in range(10):
+        dispatcher.put(slow_send, 'message %d', i)
+    release.set()
+    dispatcher.close()
+    assert(dispatcher.nr_dropped > 0 and len(sent) + dispatcher.nr_dropped == 10)
+    assert(sent[0] == 'message 0' and dispatcher.latency_summary()['nr_dropped'] == dispatcher.nr_dropped)
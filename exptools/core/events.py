@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+events.py
+
+Columnar, preallocated store for trial events. Trials write fixed-width rows
+(trial id, phase, event code, key, timestamp) into NumPy columns instead of
+building strings in the frame loop; the legacy
+'trial N phase P started at T' strings are only rendered on export.
+Message events hold free text that trials add themselves in the key column,
+which is widened when a longer key or message arrives.
+"""
+
+import numpy as np
+
+TRIAL_START = 0
+PHASE_START = 1
+KEY = 2
+TRIAL_STOP = 3
+MESSAGE = 4
+
+event_codes = {TRIAL_START: 'trial_start',
+               PHASE_START: 'phase_start',
+               KEY: 'key',
+               TRIAL_STOP: 'trial_stop',
+               MESSAGE: 'message'}
+
+
+def make_event_dtype(key_width=16):
+    """the dtype of event rows whose key column holds up to key_width characters"""
+    return np.dtype([('trial', np.int32),
+                     ('phase', np.int16),
+                     ('code', np.int8),
+                     ('key', 'U%d' % key_width),
+                     ('time', np.float64)])
+
+
+event_dtype = make_event_dtype()
+
+
+class EventLog(object):
+    """
+    EventLog keeps trial events in preallocated NumPy columns.
+    When the buffer fills up its capacity is doubled, so appending is amortized O(1)
+    and does not allocate per event. Keys longer than the key column are not truncated,
+    the column is widened instead.
+    """
+    def __init__(self, capacity=4096):
+        self.capacity = int(capacity)
+        self.trial = np.zeros(self.capacity, dtype=np.int32)
+        self.phase = np.zeros(self.capacity, dtype=np.int16)
+        self.code = np.zeros(self.capacity, dtype=np.int8)
+        self.key = np.zeros(self.capacity, dtype='U16')
+        self.time = np.zeros(self.capacity, dtype=np.float64)
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def _grow(self):
+        self.capacity *= 2
+        for column in ['trial', 'phase', 'code', 'key', 'time']:
+            old = getattr(self, column)
+            new = np.zeros(self.capacity, dtype=old.dtype)
+            new[:self.n] = old[:self.n]
+            setattr(self, column, new)
+
+    @property
+    def key_width(self):
+        return self.key.dtype.itemsize // np.dtype('U1').itemsize
+
+    def _widen(self, width):
+        self.key = self.key.astype('U%d' % max(width, 2 * self.key_width))
+
+    def append(self, trial, phase, code, time, key=''):
+        """append one event row, returns its index"""
+        if self.n == self.capacity:
+            self._grow()
+        if len(key) > self.key_width:
+            self._widen(len(key))
+        i = self.n
+        self.trial[i] = trial
+        self.phase[i] = phase
+        self.code[i] = code
+        if key:
+            self.key[i] = key
+        self.time[i] = time
+        self.n += 1
+        return i
+
+    def rows(self, start=0, stop=None):
+        """return the events between start and stop as a structured array (a copy)"""
+        if stop is None:
+            stop = self.n
+        out = np.empty(stop - start, dtype=make_event_dtype(self.key_width))
+        for column in ['trial', 'phase', 'code', 'key', 'time']:
+            out[column] = getattr(self, column)[start:stop]
+        return out
+
+    def clear(self):
+        # only the keys of used rows have to be reset, append leaves empty keys unwritten
+        self.key[:self.n] = ''
+        self.n = 0
+
+    def render(self, start=0, stop=None):
+        """render events between start and stop in the legacy eventArray string format"""
+        return render_events(self.rows(start, stop))
+
+
+def render_event(trial, phase, code, key, time):
+    """render a single event in the legacy string format"""
+    if code == TRIAL_START:
+        return 'trial ' + str(trial) + ' started at ' + str(time)
+    elif code == PHASE_START:
+        return 'trial ' + str(trial) + ' phase ' + str(phase) + ' started at ' + str(time)
+    elif code == KEY:
+        return 'trial ' + str(trial) + ' event ' + str(key) + ' at ' + str(time)
+    elif code == TRIAL_STOP:
+        return 'trial ' + str(trial) + ' stopped at ' + str(time)
+    elif code == MESSAGE:
+        return key
+
+
+def render_events(rows):
+    """render a structured array of events as legacy strings.
+    trial stop rows are not part of the legacy eventArray and are skipped."""
+    return [render_event(int(r['trial']), int(r['phase']), int(r['code']), str(r['key']), float(r['time']))
+            for r in rows if r['code'] != TRIAL_STOP]
+
+
+def test_event_log():
+    log = EventLog(capacity=2)
+    log.append(3, 0, TRIAL_START, 0.5)
+    log.append(3, 1, PHASE_START, 1.25)
+    log.append(3, 1, KEY, 1.5, key='space')
+    log.append(3, 1, TRIAL_STOP, 2.0)
+    assert(len(log) == 4)
+    assert(log.render() == ['trial 3 started at 0.5',
+                            'trial 3 phase 1 started at 1.25',
+                            'trial 3 event space at 1.5'])
+    # long keys and messages widen the key column instead of being truncated
+    log.append(4, 0, MESSAGE, 2.5, key='a message that is longer than sixteen characters')
+    log.append(4, 0, KEY, 2.75, key='num_multiply_long_key_name')
+    assert(log.render(4) == ['a message that is longer than sixteen characters',
+                             'trial 4 event num_multiply_long_key_name at 2.75'])
+    assert(log.rows()['key'][2] == 'space')
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+gaze.py
+
+Buffered gaze sample acquisition. A GazeStream drains every sample its source
+provides from a background thread into a timestamped ring buffer, so that
+saccade and fixation checks can work on complete data instead of busy-polling
+the latest sample. Sources exist for the eyelink (through pylink), the pygame
+mouse and a simulated tracker.
+"""
+
+import threading
+import time as time_module
+
+import numpy as np
+
+
+class GazeBuffer(object):
+    """
+    GazeBuffer is a ring buffer of the last capacity gaze samples, with timestamps on the session clock.
+    Samples are added from one thread and can be read from others.
+    """
+    def __init__(self, capacity=60000):
+        self.capacity = int(capacity)
+        self.times = np.zeros(self.capacity, dtype=np.float64)
+        self.positions = np.zeros((self.capacity, 2), dtype=np.float32)
+        self.nr_samples = 0
+        self._condition = threading.Condition()
+
+    def extend(self, times, positions):
+        n = times.shape[0]
+        if n == 0:
+            return
+        with self._condition:
+            if n > self.capacity:
+                # only the last capacity samples fit, the others count as overwritten
+                times, positions = times[-self.capacity:], positions[-self.capacity:]
+                self.nr_samples += n - self.capacity
+                n = self.capacity
+            indices = (self.nr_samples + np.arange(n)) % self.capacity
+            self.times[indices] = times
+            self.positions[indices] = positions
+            self.nr_samples += n
+            self._condition.notify_all()
+
+    def _ordered(self, nr):
+        """the last nr samples in chronological order, as copies"""
+        nr = min(nr, self.nr_samples, self.capacity)
+        indices = (self.nr_samples - nr + np.arange(nr)) % self.capacity
+        return self.times[indices], self.positions[indices]
+
+    def latest(self, nr=1):
+        """the latest nr samples, as (times, positions) arrays"""
+        with self._condition:
+            return self._ordered(nr)
+
+    def samples_since(self, time):
+        """all buffered samples with a timestamp later than time, as (times, positions) arrays"""
+        with self._condition:
+            times, positions = self._ordered(self.capacity)
+            first = np.searchsorted(times, time, side='right')
+            return times[first:], positions[first:]
+
+    def last_time(self):
+        with self._condition:
+            if self.nr_samples == 0:
+                return -np.inf
+            return self.times[(self.nr_samples - 1) % self.capacity]
+
+    def wait_for_samples(self, time, timeout=None):
+        """block until a sample later than time has arrived, or timeout seconds have passed"""
+        with self._condition:
+            if self.nr_samples > 0 and self.times[(self.nr_samples - 1) % self.capacity] > time:
+                return True
+            self._condition.wait(timeout)
+            return self.nr_samples > 0 and self.times[(self.nr_samples - 1) % self.capacity] > time
+
+
+class MouseSource(object):
+    """
+    the mouse position as gaze, in the coordinates of EyelinkSession.eye_pos. SDL events may only be
+    handled on the main thread, so read() does not pump them: the position follows the mouse as the
+    frame loop handles events, e.g. when it reads the keyboard.
+    """
+    def __init__(self, clock, screen_height):
+        self.clock = clock
+        self.screen_height = screen_height
+        self._last = None
+
+    def read(self):
+        import pygame
+        x, y = pygame.mouse.get_pos()
+        position = (x, self.screen_height - y)
+        if position == self._last:
+            return np.zeros(0), np.zeros((0, 2))
+        self._last = position
+        return np.array([self.clock.getTime()]), np.array([position], dtype=np.float32)
+
+
+class TrackerSource(object):
+    """
+    drains all samples from the eyelink link queue through pylink.
+    Tracker timestamps are converted to the session clock using the tracker's current time.
+    """
+    def __init__(self, clock):
+        import pylink
+        self.pylink = pylink
+        self.clock = clock
+        self.eyelink = pylink.getEYELINK()
+
+    def read(self):
+        times, positions = [], []
+        data_type = self.eyelink.getNextData()
+        while data_type:
+            if data_type == self.pylink.SAMPLE_TYPE:
+                sample = self.eyelink.getFloatData()
+                if sample.isRightSample():
+                    gaze = sample.getRightEye().getGaze()
+                elif sample.isLeftSample():
+                    gaze = sample.getLeftEye().getGaze()
+                else:
+                    gaze = None
+                if gaze is not None:
+                    times.append(sample.getTime())
+                    positions.append(gaze)
+            data_type = self.eyelink.getNextData()
+        if not times:
+            return np.zeros(0), np.zeros((0, 2))
+        # tracker time is in ms
+        now, tracker_now = self.clock.getTime(), self.eyelink.trackerTime()
+        times = now - (tracker_now - np.array(times, dtype=np.float64)) / 1000.0
+        return times, np.array(positions, dtype=np.float32)
+
+
+class SimulatedSource(object):
+    """
+    a simulated tracker that samples at sample_rate on clock: fixation at fixation_position
+    with gaussian noise of noise pixels, plus saccades given as (onset_time, (dx, dy), duration) tuples.
+    """
+    def __init__(self, clock, sample_rate=1000, fixation_position=(0, 0), noise=0.5, saccades=(), seed=None):
+        self.clock = clock
+        self.sample_rate = float(sample_rate)
+        self.fixation_position = np.array(fixation_position, dtype=np.float64)
+        self.noise = noise
+        self.saccades = list(saccades)
+        self._rng = np.random.RandomState(seed)
+        self._next_sample = int(np.floor(self.clock.getTime() * self.sample_rate)) + 1
+
+    def positions_at(self, times):
+        positions = np.tile(self.fixation_position, (times.shape[0], 1))
+        for onset, amplitude, duration in self.saccades:
+            progress = np.clip((times - onset) / duration, 0.0, 1.0)
+            positions += progress[:, np.newaxis] * np.asarray(amplitude, dtype=np.float64)
+        return positions + self._rng.normal(0, self.noise, positions.shape)
+
+    def read(self):
+        last_sample = int(np.floor(self.clock.getTime() * self.sample_rate))
+        if last_sample < self._next_sample:
+            return np.zeros(0), np.zeros((0, 2))
+        times = np.arange(self._next_sample, last_sample + 1) / self.sample_rate
+        self._next_sample = last_sample + 1
+        return times, self.positions_at(times).astype(np.float32)
+
+
+class GazeStream(object):
+    """
+    GazeStream reads all samples from source every poll_interval seconds in a background thread,
+    and keeps the last buffer_duration seconds of samples in a GazeBuffer.
+    """
+    def __init__(self, source, sample_rate=1000, buffer_duration=60.0, poll_interval=0.001):
+        self.source = source
+        self.poll_interval = poll_interval
+        self.buffer = GazeBuffer(capacity=int(buffer_duration * sample_rate))
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='GazeStream')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def poll(self):
+        """read the samples that have arrived from the source into the buffer"""
+        times, positions = self.source.read()
+        self.buffer.extend(times, positions)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self.poll()
+            time_module.sleep(self.poll_interval)
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def samples_since(self, time):
+        return self.buffer.samples_since(time)
+
+    def latest(self, nr=1):
+        return self.buffer.latest(nr)
+
+    def wait_for_samples(self, time, timeout=None):
+        return self.buffer.wait_for_samples(time, timeout)
+
+
+def test_gaze_stream_simulated():
+    from .simulation import VirtualClock
+
+    clock = VirtualClock()
+    source = SimulatedSource(clock, sample_rate=1000, fixation_position=(100, 100), seed=0)
+    stream = GazeStream(source, sample_rate=1000, buffer_duration=1.0)
+    # irregular, slow polling of the source
+    for interval in [0.0005, 0.013, 0.05, 0.0366]:
+        clock.advance(interval)
+        stream.poll()
+
+    times, positions = stream.samples_since(0.0)
+    # no samples are missed, however slow the polling is
+    assert(np.allclose(np.diff(times), 0.001))
+    assert(times.shape[0] == 100)
+    assert(stream.latest(10)[1].shape == (10, 2))
+    assert(np.abs(positions.mean(axis=0) - 100).max() < 1)
+
+    # more samples than fit in the buffer at once: only the last second is kept
+    clock.advance(2.5)
+    stream.poll()
+    times, positions = stream.samples_since(0.0)
+    assert(times.shape[0] == 1000 and clock.getTime() - times[-1] < 0.001)
+    assert(stream.buffer.nr_samples == 2600)
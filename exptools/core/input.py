@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+input.py
+
+Input polling independent of the frame loop. An InputPoller reads its devices
+every millisecond in a background thread and queues (key, time) events, which
+the frame loop takes out with get_events. Devices that timestamp key presses
+themselves, like the psychtoolbox keyboard, keep their timestamps; other events
+are stamped when the poller receives them. Either way, response times are no
+longer rounded to the frame on which they are processed.
+"""
+
+import time as time_module
+import threading
+from collections import deque
+
+
+class KeyboardDevice(object):
+    """
+    keyboards, and button boxes or MRI trigger interfaces that act as keyboards, through
+    psychopy.hardware.keyboard, which timestamps key presses on clock as they happen.
+    """
+    def __init__(self, clock, key_list=None):
+        from psychopy.hardware import keyboard
+
+        self.key_list = key_list
+        self.keyboard = keyboard.Keyboard(clock=clock)
+        self.keyboard.start()
+
+    def poll(self):
+        return [(key.name, key.tDown) for key in self.keyboard.getKeys(keyList=self.key_list, waitRelease=False)]
+
+    def close(self):
+        self.keyboard.stop()
+
+
+class SimulatedDevice(object):
+    """
+    presses the keys of a ScriptedKeyboard once its clock passes their time. The events keep their
+    scripted times, as a timestamping keyboard would, so headless sessions record the same key 
+    times with and without input polling.
+    """
+    def __init__(self, keyboard):
+        self.keyboard = keyboard
+
+    def poll(self):
+        return [(key, float(key_time)) for key, key_time in self.keyboard.getKeys(timeStamped=True)]
+
+    def close(self):
+        pass
+
+
+class InputPoller(object):
+    """
+    InputPoller polls devices every poll_interval seconds in a background thread. Events are appended
+    to a deque, whose appends and pops are atomic, so the poller and the frame loop never wait on a lock.
+    """
+    def __init__(self, clock, devices, poll_interval=0.001):
+        self.clock = clock
+        self.devices = list(devices)
+        self.poll_interval = poll_interval
+        self._events = deque()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='InputPoller')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def poll(self):
+        """read all devices once, timestamping events that have no time of their own"""
+        for device in self.devices:
+            for key, key_time in device.poll():
+                if key_time is None:
+                    key_time = self.clock.getTime()
+                self._events.append((key, key_time))
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self.poll()
+            time_module.sleep(self.poll_interval)
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+        for device in self.devices:
+            device.close()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def get_events(self):
+        """all (key, time) events since the last call, in order of arrival"""
+        events = []
+        while self._events:
+            events.append(self._events.popleft())
+        return events
+
+
+def test_input_poller():
+    from .simulation import ScriptedKeyboard
+
+    class WallClock(object):
+        def __init__(self):
+            self.start = time_module.time()
+        def getTime(self):
+            return time_module.time() - self.start
+
+    clock = WallClock()
+    poller = InputPoller(clock, [SimulatedDevice(ScriptedKeyboard(clock, [(0.0123, 'b'), (0.0456, 't')]))])
+    poller.start()
+    # slow frames: key presses keep their own times
+    time_module.sleep(0.05)
+    events = poller.get_events()
+    time_module.sleep(0.05)
+    events += poller.get_events()
+    poller.stop()
+
+    assert([key for key, key_time in events] == ['b', 't'])
+    assert(events == [('b', 0.0123), ('t', 0.0456)])
+
+    # untimed devices are stamped when the poller reads them
+    class UntimedDevice(object):
+        def poll(self):
+            return [('space', None)]
+        def close(self):
+            pass
+    poller = InputPoller(clock, [UntimedDevice()])
+    before = clock.getTime()
+    poller.poll()
+    key, key_time = poller.get_events()[0]
+    assert(key == 'space' and before <= key_time <= clock.getTime())
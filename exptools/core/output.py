@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+output.py
+
+Append-only, line-delimited trial output. Every finished trial is written as one
+JSON record by a background thread and flushed to disk straight away, so the
+data of a crashed session can be recovered. At the end of the session the log is
+compacted into the legacy outputDict pickle and parameter tsv.
+"""
+
+import json
+import threading
+import pickle as pkl
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+from .events import make_event_dtype, render_events
+
+
+def _to_builtin(value):
+    """json fallback for numpy scalars and arrays"""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+
+class TrialWriter(object):
+    """
+    TrialWriter appends one JSON line per trial to file_name from a background thread.
+    write() only puts the record on a queue, so it does not block the caller on disk I/O.
+    Other output, like BIDS events, can be written on the same thread with call().
+    An error in the writer thread is raised again by the next write() or call(), or by close().
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self._file = open(self.file_name, 'a')
+        self._queue = queue.Queue()
+        self.error = None
+        self._thread = threading.Thread(target=self._run, name='TrialWriter')
+        self._thread.daemon = True
+        self._thread.start()
+        self.closed = False
+
+    def write(self, trial, parameters, event_rows):
+        """
+        queue a finished trial; event_rows is a structured array from EventLog.rows. parameters 
+        is copied, so the trial can change its dict while the record waits to be written.
+        """
+        self.call(self._write_record, trial, dict(parameters), event_rows)
+
+    def call(self, function, *args):
+        """run function(*args) on the writer thread, after everything that was queued before it"""
+        if self.error is not None:
+            raise self.error
+        self._queue.put((function, args))
+
+    def flush(self):
+        """wait until everything that was queued so far has been written"""
+        done = threading.Event()
+        self.call(done.set)
+        while not done.wait(0.1):
+            if not self._thread.is_alive():
+                break
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        try:
+            self._write_records()
+        except Exception as error:
+            self.error = error
+
+    def _write_records(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            function, args = item
+            function(*args)
+
+    def _write_record(self, trial, parameters, event_rows):
+        line = json.dumps({'trial': trial,
+                           'parameters': parameters,
+                           'events': {'phase': event_rows['phase'].tolist(),
+                                      'code': event_rows['code'].tolist(),
+                                      'key': event_rows['key'].tolist(),
+                                      'time': event_rows['time'].tolist()}},
+                          default=_to_builtin)
+        self._file.write(line + '\n')
+        self._file.flush()
+
+    def close(self):
+        """write all queued trials and close the file"""
+        if self.closed:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+        self.closed = True
+        if self.error is not None:
+            raise self.error
+
+
+def read_trial_records(file_name):
+    """
+    iterate over the trial records in a TrialWriter file. A truncated last line,
+    as left behind by a crash during writing, is skipped.
+    """
+    with open(file_name) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            yield record
+
+
+def record_event_rows(record):
+    """convert the events of a trial record back to a structured event array"""
+    events = record['events']
+    key_width = max([16] + [len(key) for key in events['key']])
+    rows = np.zeros(len(events['time']), dtype=make_event_dtype(key_width))
+    rows['trial'] = record['trial']
+    for column in ['phase', 'code', 'key', 'time']:
+        rows[column] = events[column]
+    return rows
+
+
+def compact_trial_records(file_name, output_file, outputDict=None):
+    """
+    compact a TrialWriter file into the legacy outputs: output_file + '_outputDict.pkl'
+    with parameterArray and eventArray, and output_file + '.tsv' with the parameters.
+    Entries that are already present in outputDict are appended after the streamed trials.
+    """
+    import pandas as pd
+
+    if outputDict is None:
+        outputDict = {'parameterArray': [], 'eventArray': []}
+    outputDict = dict(outputDict)
+
+    parameters, events = [], []
+    for record in read_trial_records(file_name):
+        parameters.append(record['parameters'])
+        events.append(render_events(record_event_rows(record)))
+    outputDict['parameterArray'] = parameters + list(outputDict.get('parameterArray', []))
+    outputDict['eventArray'] = events + list(outputDict.get('eventArray', []))
+
+    parsopf = open(output_file + '_outputDict.pkl', 'ab')
+    pkl.dump(outputDict, parsopf)
+    parsopf.close()
+    # also output parameters as tsv
+    opd = pd.DataFrame.from_records(outputDict['parameterArray'])
+    opd.to_csv(path_or_buf=output_file + '.tsv', sep='\t', encoding='utf-8')
+    return outputDict
+
+
+def test_trial_writer():
+    import os
+    import tempfile
+    from .events import EventLog, TRIAL_START, KEY, TRIAL_STOP
+
+    file_name = os.path.join(tempfile.mkdtemp(), 'test_trials.jsonl')
+    writer = TrialWriter(file_name)
+    log = EventLog()
+    for trial in range(3):
+        parameters = {'trial': trial, 'array': np.arange(2)}
+        log.append(trial, 0, TRIAL_START, trial * 1.0)
+        log.append(trial, 0, KEY, trial + 0.5, key='space')
+        log.append(trial, 0, TRIAL_STOP, trial + 0.75)
+        writer.write(trial, parameters, log.rows())
+        # changing the parameters after the trial was handed over does not change its record
+        parameters['trial'] = -1
+        log.clear()
+    writer.close()
+
+    records = list(read_trial_records(file_name))
+    assert([record['parameters']['trial'] for record in records] == [0, 1, 2])
+    assert(records[2]['parameters']['array'] == [0, 1] and records[1]['events']['key'] == ['', 'space', ''])
+    rows = record_event_rows(records[1])
+    assert(rows['trial'].tolist() == [1, 1, 1] and rows['time'].tolist() == [1.0, 1.5, 1.75])
+    assert(render_events(rows) == ['trial 1 started at 1.0', 'trial 1 event space at 1.5'])
+
+    # a crash while writing leaves a truncated last line, which is skipped
+    with open(file_name, 'a') as f:
+        f.write('{"trial": 3, "param')
+    assert(len(list(read_trial_records(file_name))) == 3)
+
+    # other output is written on the writer thread, in order with the trials
+    lines = []
+    writer = TrialWriter(file_name + '.2')
+    writer.write(3, {}, log.rows())
+    writer.call(lines.append, 'after trial 3')
+    writer.flush()
+    assert(lines == ['after trial 3'] and len(list(read_trial_records(file_name + '.2'))) == 1)
+    writer.close()
+
+    # errors in the writer thread are raised on close
+    writer = TrialWriter(file_name)
+    writer._file.close()
+    writer.write(4, {}, log.rows())
+    try:
+        writer.close()
+        assert(False)
+    except ValueError:
+        pass
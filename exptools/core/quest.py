@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+quest.py
+
+A QUEST+ style Bayesian adaptive procedure (Watson, 2017). The probability of a
+correct answer is tabulated once for every stimulus intensity and every
+combination of psychometric function parameters. After each answer the posterior
+over the parameters is multiplied by the matching table row, and the next
+intensity is the one that minimizes the expected entropy of the posterior.
+Both steps are a few matrix-vector products, and the tables can be cached on disk.
+"""
+
+import os
+import hashlib
+import tempfile
+
+import numpy as np
+
+
+def logistic(intensity, threshold, slope, guess_rate, lapse_rate):
+    """probability of a correct answer for a logistic psychometric function"""
+    return guess_rate + (1.0 - guess_rate - lapse_rate) / (1.0 + np.exp(-slope * (intensity - threshold)))
+
+
+def weibull(intensity, threshold, slope, guess_rate, lapse_rate):
+    """probability of a correct answer for a weibull psychometric function of (positive) intensity"""
+    return guess_rate + (1.0 - guess_rate - lapse_rate) * (1.0 - np.exp(-(intensity / threshold) ** slope))
+
+
+def _table_key(psychometric, arrays):
+    sha1 = hashlib.sha1(('%s.%s' % (psychometric.__module__, psychometric.__name__)).encode('utf-8'))
+    for array in arrays:
+        sha1.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+        sha1.update(b'|')
+    return sha1.hexdigest()
+
+
+class QuestPlusStaircase(object):
+    """
+    QuestPlusStaircase chooses intensities from stimulus_domain, and estimates the thresholds,
+    slopes, guess_rates and lapse_rates of psychometric(intensity, threshold, slope, guess_rate, lapse_rate).
+    prior is an array with one value per parameter combination, in the order of
+    np.meshgrid(thresholds, slopes, guess_rates, lapse_rates, indexing='ij'); it is flat by default.
+    With cache_dir, likelihood tables are stored there under a hash of the grids.
+    """
+    def __init__(self, stimulus_domain, thresholds, slopes=(3.5,), guess_rates=(0.5,), lapse_rates=(0.01,),
+                 prior=None, psychometric=logistic, max_nr_trials=40, cache_dir=None):
+        self.stimulus_domain = np.asarray(stimulus_domain, dtype=np.float64)
+        grids = [np.asarray(values, dtype=np.float64) for values in [thresholds, slopes, guess_rates, lapse_rates]]
+        self.parameter_names = ['threshold', 'slope', 'guess_rate', 'lapse_rate']
+        self.parameter_values = np.array([grid.ravel() for grid in np.meshgrid(*grids, indexing='ij')])
+        self.max_nr_trials = max_nr_trials
+
+        self.likelihoods, self.likelihood_entropies = self._tables(psychometric, grids, cache_dir)
+
+        if prior is None:
+            prior = np.ones(self.parameter_values.shape[1])
+        self.posterior = np.asarray(prior, dtype=np.float64).ravel() / np.sum(prior)
+
+        self.test_values = []
+        self.past_answers = []
+        self.nr_trials = 0
+        self._next_index()
+
+    def _tables(self, psychometric, grids, cache_dir):
+        """
+        the (2, nr_stimuli, nr_parameters) tables of the likelihood of an incorrect / correct answer,
+        and of likelihood * log(likelihood)
+        """
+        cache_file = None
+        if cache_dir is not None:
+            cache_file = os.path.join(cache_dir, 'quest_%s.npz' % _table_key(psychometric, [self.stimulus_domain] + grids))
+            if os.path.exists(cache_file):
+                tables = np.load(cache_file)
+                return tables['likelihoods'], tables['likelihood_entropies']
+
+        p_correct = psychometric(self.stimulus_domain[:, np.newaxis], *self.parameter_values[:, np.newaxis, :])
+        likelihoods = np.array([1.0 - p_correct, p_correct])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            likelihood_entropies = np.where(likelihoods > 0, likelihoods * np.log(likelihoods), 0.0)
+
+        if cache_file is not None:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            # write to a temporary file of our own first, so an interrupted write never leaves a broken
+            # table, and staircases computing the same table at the same time never share a file
+            handle, temporary_file = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+            try:
+                with os.fdopen(handle, 'wb') as f:
+                    np.savez(f, likelihoods=likelihoods, likelihood_entropies=likelihood_entropies)
+                os.replace(temporary_file, cache_file)
+            except BaseException:
+                os.remove(temporary_file)
+                raise
+        return likelihoods, likelihood_entropies
+
+    def expected_entropies(self):
+        """the expected entropy of the posterior after presenting each intensity of stimulus_domain"""
+        posterior = self.posterior
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_posterior = np.where(posterior > 0, np.log(posterior), 0.0)
+        # per answer r and intensity x, with A = L[r, x] * posterior and p = sum(A):
+        # H(posterior | r, x) = log(p) - sum(A * (log(L[r, x]) + log(posterior))) / p
+        p_answer = self.likelihoods.dot(posterior)
+        weighted = self.likelihood_entropies.dot(posterior) + self.likelihoods.dot(posterior * log_posterior)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            p_log_p = np.where(p_answer > 0, p_answer * np.log(p_answer), 0.0)
+        return (p_log_p - weighted).sum(axis=0)
+
+    def _next_index(self):
+        self.stimulus_index = np.argmin(self.expected_entropies())
+
+    def get_intensity(self):
+        return self.stimulus_domain[self.stimulus_index]
+
+    def answer(self, correct, intensity=None):
+        """
+        register an answer to the last intensity from get_intensity(), or to the nearest
+        intensity in stimulus_domain if intensity is given. returns whether to continue.
+        """
+        if intensity is None:
+            index = self.stimulus_index
+        else:
+            index = np.argmin(np.abs(self.stimulus_domain - intensity))
+        self.test_values.append(self.stimulus_domain[index])
+        self.past_answers.append(correct)
+        self.nr_trials += 1
+
+        self.posterior *= self.likelihoods[int(bool(correct)), index]
+        self.posterior /= self.posterior.sum()
+        self._next_index()
+        return self.nr_trials < self.max_nr_trials
+
+    def marginal(self, parameter):
+        """the marginal posterior of parameter over its grid values, as (values, probabilities)"""
+        row = self.parameter_names.index(parameter)
+        values, inverse = np.unique(self.parameter_values[row], return_inverse=True)
+        return values, np.bincount(inverse, weights=self.posterior, minlength=values.shape[0])
+
+    def estimates(self):
+        """posterior mean of all parameters, as a dict"""
+        return dict(zip(self.parameter_names, self.parameter_values.dot(self.posterior)))
+
+    def threshold(self):
+        return self.estimates()['threshold']
+
+
+def test_quest_plus():
+    import tempfile
+
+    true_threshold = 0.3
+    domain = np.linspace(-1, 1, 101)
+    quest = QuestPlusStaircase(domain, np.linspace(-1, 1, 81), slopes=np.linspace(2, 20, 10), max_nr_trials=200)
+    rng = np.random.RandomState(0)
+    carry_on = True
+    while carry_on:
+        p = logistic(quest.get_intensity(), true_threshold, 10.0, 0.5, 0.01)
+        carry_on = quest.answer(rng.rand() < p)
+    # the time per answer is measured by quest_plus_answer_us in benchmarks/run_benchmarks.py
+    assert(quest.nr_trials == 200)
+    assert(abs(quest.threshold() - true_threshold) < 0.1)
+
+    cache_dir = tempfile.mkdtemp()
+    first = QuestPlusStaircase(domain, [0.0, 0.5], cache_dir=cache_dir)
+    second = QuestPlusStaircase(domain, [0.0, 0.5], cache_dir=cache_dir)
+    assert(len(os.listdir(cache_dir)) == 1)
+    assert(np.allclose(first.likelihoods, second.likelihoods))
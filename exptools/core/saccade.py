@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+saccade.py
+
+Velocity-based saccade detection after Engbert & Mergenthaler (2006), PNAS 103(18):7192-7197.
+Velocities are thresholded at threshold times a median-based estimate of their standard deviation,
+sqrt(median(v**2) - median(v)**2), separately for x and y.
+
+SaccadeDetector works online on streaming samples and keeps the median estimates over a
+sliding window of n samples in sorted lists. Finding a sample's place is O(log n), inserting
+and removing it are O(n) memmoves, which for windows of a few thousand samples cost less than
+a pure-Python heap or skiplist would. detect_saccades does the same on a whole recorded
+array with NumPy.
+"""
+
+import bisect
+from collections import deque
+
+import numpy as np
+
+
+class RunningMedian(object):
+    """median over a sliding window of the last window values, kept in a sorted list"""
+    def __init__(self, window):
+        self.window = int(window)
+        self._values = deque()
+        self._sorted = []
+
+    def __len__(self):
+        return len(self._values)
+
+    def add(self, value):
+        self._values.append(value)
+        bisect.insort(self._sorted, value)
+        if len(self._values) > self.window:
+            old = self._values.popleft()
+            del self._sorted[bisect.bisect_left(self._sorted, old)]
+
+    def median(self):
+        n = len(self._sorted)
+        if n % 2:
+            return self._sorted[n // 2]
+        return 0.5 * (self._sorted[n // 2 - 1] + self._sorted[n // 2])
+
+
+def _velocities(positions, sample_rate):
+    """
+    5-point moving-average velocities of an (n, 2) position array, as in engbert & mergenthaler.
+    returns an (n - 4, 2) array; row i is the velocity at sample i + 2.
+    """
+    return (positions[4:] + positions[3:-1] - positions[1:-3] - positions[:-4]) * (sample_rate / 6.0)
+
+
+class SaccadeDetector(object):
+    """
+    SaccadeDetector detects the onset of a saccade in a stream of gaze samples.
+
+    threshold is the velocity threshold in units of the median-based standard deviation (lambda),
+    a saccade has to stay above threshold for at least min_duration seconds.
+    If direction (an x, y vector) is given, the detector is primed for saccades in that direction:
+    only velocities within direction_tolerance radians of it count as saccadic.
+    Velocities are available two samples after they occur, so onsets are reported with that delay.
+    """
+    def __init__(self,
+                 sample_rate=1000,
+                 threshold=6.0,
+                 min_duration=0.006,
+                 window=1.0,
+                 direction=None,
+                 direction_tolerance=np.pi / 4,
+                 min_samples_for_statistics=20,
+                 min_sd=1e-6):
+        self.sample_rate = float(sample_rate)
+        self.threshold = threshold
+        self.min_nr_samples = max(1, int(round(min_duration * self.sample_rate)))
+        self.window = max(min_samples_for_statistics, int(round(window * self.sample_rate)))
+        self.min_samples_for_statistics = min_samples_for_statistics
+        self.min_sd = min_sd
+
+        if direction is not None:
+            direction = np.asarray(direction, dtype=np.float64)
+            direction = direction / np.linalg.norm(direction)
+        self.direction = direction
+        self.min_direction_cosine = np.cos(direction_tolerance)
+
+        self.reset()
+
+    def reset(self):
+        self._positions = np.zeros((5, 2), dtype=np.float64)
+        self._times = np.zeros(5, dtype=np.float64)
+        self.nr_samples = 0
+
+        self._median_v = [RunningMedian(self.window), RunningMedian(self.window)]
+        self._median_v2 = [RunningMedian(self.window), RunningMedian(self.window)]
+
+        self._run_length = 0
+        self._run_onset = None
+        self.onset_time = None
+
+    @property
+    def detected(self):
+        return self.onset_time is not None
+
+    def sd(self):
+        """current median-based standard deviation estimates of the x and y velocities"""
+        return np.array([np.sqrt(max(self._median_v2[i].median() - self._median_v[i].median() ** 2, 0.0))
+                         for i in range(2)]).clip(min=self.min_sd)
+
+    def _is_saccadic(self, velocity, sd):
+        scaled = velocity / (self.threshold * sd)
+        if scaled[0] * scaled[0] + scaled[1] * scaled[1] <= 1.0:
+            return False
+        if self.direction is not None:
+            speed = np.sqrt(velocity[0] * velocity[0] + velocity[1] * velocity[1])
+            if np.dot(velocity, self.direction) < self.min_direction_cosine * speed:
+                return False
+        return True
+
+    def add_sample(self, time, position):
+        """add one sample; returns the saccade onset time once a saccade is detected, else None"""
+        return self.add_samples(np.array([time], dtype=np.float64),
+                                np.asarray(position, dtype=np.float64).reshape((1, 2)))
+
+    def add_samples(self, times, positions):
+        """
+        add a batch of samples, times an (n,) array and positions an (n, 2) array.
+        returns the saccade onset time once a saccade is detected, else None.
+        """
+        if self.detected:
+            return self.onset_time
+        times = np.asarray(times, dtype=np.float64)
+        positions = np.asarray(positions, dtype=np.float64).reshape((-1, 2))
+
+        # prepend the last 4 samples of the previous batch so velocities are continuous across batches
+        nr_previous = min(self.nr_samples, 4)
+        all_positions = np.concatenate([self._positions[5 - nr_previous:], positions])
+        all_times = np.concatenate([self._times[5 - nr_previous:], times])
+        self.nr_samples += times.shape[0]
+        keep = min(all_times.shape[0], 5)
+        self._positions[5 - keep:] = all_positions[-keep:]
+        self._times[5 - keep:] = all_times[-keep:]
+
+        if all_positions.shape[0] < 5:
+            return None
+        # with the previous 4 samples prepended, all of these velocities are new
+        velocities = _velocities(all_positions, self.sample_rate)
+        velocity_times = all_times[2:-2]
+
+        for velocity, time in zip(velocities, velocity_times):
+            if len(self._median_v[0]) >= self.min_samples_for_statistics and self._is_saccadic(velocity, self.sd()):
+                if self._run_length == 0:
+                    self._run_onset = time
+                self._run_length += 1
+                if self._run_length >= self.min_nr_samples:
+                    self.onset_time = self._run_onset
+                    return self.onset_time
+            else:
+                self._run_length = 0
+                # only fixational samples go into the noise estimate
+                for i in range(2):
+                    self._median_v[i].add(velocity[i])
+                    self._median_v2[i].add(velocity[i] * velocity[i])
+        return None
+
+
+def detect_saccades(positions, sample_rate=1000, threshold=6.0, min_duration=0.006, min_sd=1e-6):
+    """
+    detect all saccades in an (n, 2) array of gaze positions in one vectorized pass.
+    returns an (k, 2) integer array of saccade start and end (exclusive) sample indices.
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    if positions.shape[0] < 5:
+        return np.zeros((0, 2), dtype=int)
+    velocities = _velocities(positions, sample_rate)
+    sd = np.sqrt(np.median(velocities ** 2, axis=0) - np.median(velocities, axis=0) ** 2).clip(min=min_sd)
+    saccadic = (((velocities / (threshold * sd)) ** 2).sum(axis=1) > 1.0).astype(np.int8)
+
+    edges = np.diff(np.concatenate([[0], saccadic, [0]]))
+    starts = np.nonzero(edges == 1)[0]
+    ends = np.nonzero(edges == -1)[0]
+    long_enough = (ends - starts) >= max(1, int(round(min_duration * sample_rate)))
+    # velocity i belongs to sample i + 2
+    return np.array([starts[long_enough], ends[long_enough]]).T + 2
+
+
+def test_saccade_detector():
+    sample_rate = 1000
+    rng = np.random.RandomState(0)
+    positions = rng.normal(0, 0.5, (600, 2))
+    # a 20 ms, 200 pixel rightward saccade starting at sample 400
+    positions[400:420, 0] += np.linspace(0, 200, 20)
+    positions[420:, 0] += 200
+    times = np.arange(600) / float(sample_rate)
+
+    saccades = detect_saccades(positions, sample_rate)
+    assert(saccades.shape[0] == 1)
+    assert(abs(saccades[0, 0] - 400) < 5)
+
+    detector = SaccadeDetector(sample_rate=sample_rate)
+    onset = None
+    for i in range(0, 600, 50):
+        onset = detector.add_samples(times[i:i+50], positions[i:i+50])
+        if onset is not None:
+            break
+    assert(abs(onset - 0.4) < 0.005)
+
+    detector = SaccadeDetector(sample_rate=sample_rate, direction=[-1, 0])
+    assert(detector.add_samples(times, positions) is None)
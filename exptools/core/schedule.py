@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+schedule.py
+
+Columnar trial schedules. A TrialSchedule keeps a whole design as NumPy arrays:
+one array per parameter, an (nr_trials, nr_phases) array of phase durations and
+the cumulative phase onsets derived from it. Trials are handed out as
+lightweight views, and schedules can be validated, shuffled, counterbalanced
+and split into runs without building per-trial objects.
+"""
+
+import numpy as np
+
+
+class TrialView(object):
+    """a single trial of a TrialSchedule; parameters are only turned into a dict when asked for"""
+    __slots__ = ['schedule', 'index']
+
+    def __init__(self, schedule, index):
+        self.schedule = schedule
+        self.index = index
+
+    @property
+    def parameters(self):
+        parameters = {}
+        for name, column in self.schedule.parameters.items():
+            value = column[self.index]
+            parameters[name] = value.item() if isinstance(value, np.generic) else value
+        return parameters
+
+    @property
+    def phase_durations(self):
+        return self.schedule.phase_durations[self.index]
+
+    @property
+    def phase_onsets(self):
+        return self.schedule.phase_onsets[self.index]
+
+    def __repr__(self):
+        return 'TrialView(%d, %s)' % (self.index, self.parameters)
+
+
+class TrialSchedule(object):
+    """
+    TrialSchedule holds a design of nr_trials trials.
+    parameters is a dict of equally long 1-d arrays, one per trial parameter,
+    phase_durations an (nr_trials, nr_phases) array. phase_onsets holds the
+    cumulative phase end times within each trial, as Trial.phase_times does.
+    """
+    def __init__(self, parameters, phase_durations, phase_onsets=None):
+        self.parameters = dict((name, np.asarray(column)) for name, column in parameters.items())
+        self.phase_durations = np.atleast_2d(np.asarray(phase_durations, dtype=np.float64))
+        if phase_onsets is None:
+            phase_onsets = np.cumsum(self.phase_durations, axis=1)
+        self.phase_onsets = phase_onsets
+
+    @classmethod
+    def from_records(cls, records, phase_durations):
+        """build a schedule from a list of parameter dicts and per-trial (or shared) phase durations"""
+        names = []
+        for record in records:
+            for name in record:
+                if name not in names:
+                    names.append(name)
+        parameters = dict((name, np.array([record.get(name) for record in records])) for name in names)
+        phase_durations = np.asarray(phase_durations, dtype=np.float64)
+        if phase_durations.ndim == 1:
+            phase_durations = np.tile(phase_durations, (len(records), 1))
+        return cls(parameters, phase_durations)
+
+    @classmethod
+    def from_dataframe(cls, data_frame, phase_columns):
+        """build a schedule from a pandas DataFrame, phase_columns are the columns with phase durations"""
+        parameters = dict((name, data_frame[name].values) for name in data_frame.columns if name not in phase_columns)
+        return cls(parameters, data_frame[list(phase_columns)].values)
+
+    def __len__(self):
+        return self.phase_durations.shape[0]
+
+    @property
+    def nr_phases(self):
+        return self.phase_durations.shape[1]
+
+    def __getitem__(self, index):
+        """an integer gives a TrialView, a slice or index array a new TrialSchedule"""
+        if isinstance(index, (int, np.integer)):
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError('trial index %d out of range for %d trials' % (index, len(self)))
+            return TrialView(self, index)
+        return TrialSchedule(dict((name, column[index]) for name, column in self.parameters.items()),
+                             self.phase_durations[index],
+                             self.phase_onsets[index])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield TrialView(self, index)
+
+    def validate(self):
+        """raise a ValueError if the schedule is inconsistent"""
+        if self.phase_durations.ndim != 2:
+            raise ValueError('phase_durations should be an (nr_trials, nr_phases) array')
+        if not np.isfinite(self.phase_durations).all():
+            raise ValueError('phase_durations contains non-finite values')
+        for name, column in self.parameters.items():
+            if column.shape[0] != len(self):
+                raise ValueError('parameter %s has %d values for %d trials' % (name, column.shape[0], len(self)))
+        return True
+
+    def shuffle(self, seed=None):
+        """return a copy of the schedule in random trial order"""
+        return self[np.random.RandomState(seed).permutation(len(self))]
+
+    def counterbalance(self, column, seed=None):
+        """
+        return a copy of the schedule ordered in blocks that each contain every level of column
+        once, in random order within the block. Levels that occur less often run out in later blocks.
+        """
+        rng = np.random.RandomState(seed)
+        levels, level_index = np.unique(self.parameters[column], return_inverse=True)
+        block = np.zeros(len(self), dtype=int)
+        for level in range(levels.shape[0]):
+            members = np.nonzero(level_index == level)[0]
+            block[rng.permutation(members)] = np.arange(members.shape[0])
+        order = np.lexsort((rng.rand(len(self)), block))
+        return self[order]
+
+    def split(self, nr_runs):
+        """split the schedule into nr_runs consecutive, nearly equally long schedules"""
+        return [self[indices] for indices in np.array_split(np.arange(len(self)), nr_runs)]
+
+    def to_dataframe(self):
+        import pandas as pd
+
+        data = dict(self.parameters)
+        for phase in range(self.nr_phases):
+            data['phase_%d_duration' % phase] = self.phase_durations[:, phase]
+        return pd.DataFrame(data)
+
+
+def test_trial_schedule():
+    nr_trials = 10000
+    schedule = TrialSchedule({'orientation': np.tile([0, 45, 90, 135], nr_trials // 4),
+                              'contrast': np.linspace(0, 1, nr_trials)},
+                             np.tile([0.5, 0.2, 1.0], (nr_trials, 1)))
+    assert(schedule.validate())
+    assert(len(schedule) == nr_trials)
+    assert(np.allclose(schedule[3].phase_onsets, [0.5, 0.7, 1.7]))
+    assert(schedule[5].parameters['orientation'] == 45)
+
+    balanced = schedule.counterbalance('orientation', seed=0)
+    assert(sorted(balanced.parameters['orientation'][:4]) == [0, 45, 90, 135])
+    runs = balanced.split(4)
+    assert(sum(len(run) for run in runs) == nr_trials)
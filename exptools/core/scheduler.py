@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+scheduler.py
+
+Absolute-time phase scheduling. In the default, relative mode, Trial.check_phase_time
+starts every phase when the previous one has lasted long enough, measured from the
+frame on which it started, so frame overshoot accumulates over phases and trials.
+A PhaseScheduler instead plans all trial and phase onsets on one session timeline,
+and switches each phase on the frame whose flip is closest to its planned onset.
+A trial that starts late, after instructions, a wait for the scanner or a pause, is
+planned from its actual start, so that its phases are not all due at once.
+"""
+
+import numpy as np
+
+
+class PhaseScheduler(object):
+    """
+    PhaseScheduler keeps the planned session timeline and the flip times of the screen.
+    Trials are planned back to back from start_time on, unless a trial is given an explicit onset.
+    A trial that starts more than late_tolerance seconds (by default one frame) after its planned
+    onset is planned from its start instead; the planned and actual starts are kept in late_starts.
+    For every phase, the planned onset and the flip time at which it was first shown are recorded.
+    """
+    def __init__(self, clock, refresh_rate=60.0, start_time=None, late_tolerance=None):
+        self.clock = clock
+        self.frame_interval = 1.0 / refresh_rate
+        if late_tolerance is None:
+            late_tolerance = self.frame_interval
+        self.late_tolerance = late_tolerance
+        self.last_flip_time = None
+        self.records = []
+        self.late_starts = []
+        self._pending = []
+        self.reset(start_time)
+
+    def reset(self, start_time=None):
+        """
+        (re)start the timeline at start_time, by default now; e.g. at the first MRI trigger.
+        The phases recorded so far are kept.
+        """
+        if start_time is None:
+            start_time = self.clock.getTime()
+        self.start_time = start_time
+        self.next_trial_onset = start_time
+
+    def start_trial(self, phase_durations, onset=None, start_time=None):
+        """
+        plan a trial that starts at start_time, by default now. returns the planned onsets of 
+        all phases on the session timeline, with the planned end of the trial as last element.
+        """
+        if onset is None:
+            onset = self.next_trial_onset
+        if start_time is None:
+            start_time = self.clock.getTime()
+        if start_time - onset > self.late_tolerance:
+            self.late_starts.append((onset, start_time))
+            onset = start_time
+        planned_onsets = onset + np.concatenate([[0.0], np.cumsum(phase_durations)])
+        self.next_trial_onset = planned_onsets[-1]
+        return planned_onsets
+
+    def flip(self, flip_time):
+        """register a screen flip; phases started since the previous flip were first shown at flip_time"""
+        self.last_flip_time = flip_time
+        for record in self._pending:
+            record[3] = flip_time
+            self.records.append(tuple(record))
+        self._pending = []
+
+    def next_flip_time(self, time):
+        """predicted time of the first flip after time"""
+        if self.last_flip_time is None:
+            return time
+        nr_frames = np.floor((time - self.last_flip_time) / self.frame_interval) + 1
+        return self.last_flip_time + max(nr_frames, 1) * self.frame_interval
+
+    def due(self, target_time, time):
+        """
+        whether an event planned at target_time should be drawn on the coming frame:
+        true if the coming flip is closer to target_time than the one after it.
+        """
+        return target_time <= self.next_flip_time(time) + 0.5 * self.frame_interval
+
+    def phase_started(self, trial, phase, planned_onset):
+        """record the start of a phase; its achieved onset is filled in at the next flip"""
+        self._pending.append([trial, phase, planned_onset, np.nan])
+
+    def report(self):
+        """planned and achieved onsets of all phases, and their difference, as a DataFrame"""
+        import pandas as pd
+
+        report = pd.DataFrame.from_records(self.records, columns=['trial', 'phase', 'planned_onset', 'achieved_onset'])
+        report['onset_error'] = report['achieved_onset'] - report['planned_onset']
+        return report
+
+    def write(self, output_file):
+        self.report().to_csv(path_or_buf=output_file + '_phase_timing.tsv', sep='\t', encoding='utf-8')
+
+
+def test_phase_scheduler():
+    class FrameClock(object):
+        time = 0.0
+        def getTime(self):
+            return self.time
+
+    clock = FrameClock()
+    scheduler = PhaseScheduler(clock, refresh_rate=100.0, start_time=0.0)
+    planned = scheduler.start_trial([0.104, 0.2])
+    assert(np.allclose(planned, [0.0, 0.104, 0.304]))
+    assert(np.allclose(scheduler.start_trial([0.5]), [0.304, 0.804]))
+
+    scheduler.flip(0.1)
+    # the flip at 0.11 is closer to 0.104 than the one at 0.12
+    assert(scheduler.due(0.104, 0.101))
+    assert(not scheduler.due(0.118, 0.101))
+    scheduler.phase_started(1, 1, 0.104)
+    scheduler.flip(0.11)
+    assert(np.isclose(scheduler.records[0][3] - scheduler.records[0][2], 0.006))
+
+    # a pause after the second trial: the third is planned from its start, not from 0.804
+    clock.time = 2.5
+    planned = scheduler.start_trial([0.104, 0.2])
+    assert(np.allclose(planned, [2.5, 2.604, 2.804]) and scheduler.late_starts == [(0.804, 2.5)])
+    assert(not scheduler.due(planned[1], 2.5))
+    # a trial that starts within a frame of its onset keeps its plan
+    assert(np.allclose(scheduler.start_trial([0.5], start_time=2.81), [2.804, 3.304]))
+    # after a reset, trials are planned from the new start
+    scheduler.reset(10.0)
+    assert(np.allclose(scheduler.start_trial([0.5], start_time=10.0), [10.0, 10.5]))
+    assert(len(scheduler.records) == 1)
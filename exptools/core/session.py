@@ -10,23 +10,44 @@ Created by Tomas HJ Knapen on 2009-11-26.
 Copyright (c) 2009 TK. All rights reserved.
 """
 
-from psychopy import visual, core, event, misc, logging
-import pygame
-#from pygame.locals import *
-from scipy.io import wavfile
 import datetime
+import logging as stdlib_logging
 import os
+import sys
+import socket
 import pickle as pkl
-import pandas as pd
 
-import pyaudio, wave
 import numpy as np
 
-import pygaze
-from pygaze import libscreen 
-from pygaze import eyetracker
-
 from .. import config
+from ..utils.lazy import lazy_import
+from ..utils.geometry import ScreenGeometry, LuminanceTable, rgb_to_255
+from .events import EventLog
+from .output import TrialWriter, compact_trial_records
+from .dispatch import MessageDispatcher, offset_marker
+from .timing import FrameTimer
+from .saccade import SaccadeDetector
+from .gaze import GazeStream, MouseSource, TrackerSource
+from .stimuli import StimulusCache
+from .schedule import TrialSchedule
+from .design import find_design_file, load_design, load_pickle
+from .scheduler import PhaseScheduler
+from .bids import BIDSEventWriter, bids_file_name
+from .calibration import CalibrationLayout, calibration_commands, format_points, parse_points, send_commands
+from .triggers import TriggerTimeline, TRIGGER_DOUBLE, TRIGGER_AFTER_MISSED
+from .sound import SoundEngine, SoundLibrary, read_sound
+from .input import InputPoller, KeyboardDevice, SimulatedDevice
+from .simulation import VirtualClock, NullScreen, ScriptedKeyboard, SimulatedTracker, SimulatedStarStimSocket
+
+# the display, input and eye tracking backends are only imported when a session first uses them
+visual = lazy_import('psychopy.visual')
+core = lazy_import('psychopy.core')
+event = lazy_import('psychopy.event')
+logging = lazy_import('psychopy.logging')
+pygame = lazy_import('pygame')
+pygaze = lazy_import('pygaze')
+libscreen = lazy_import('pygaze.libscreen')
+eyetracker = lazy_import('pygaze.eyetracker')
 
 
 class Session(object):
@@ -36,27 +57,76 @@ class Session(object):
         self.subject_initials = subject_initials
         self.index_number = index_number
         
-        self.clock = core.Clock()
+        # the 'headless' engine simulates screen, keyboard and hardware on a virtual clock
+        self.engine = kwargs.pop('engine', 'pygaze')
+        # opt-in: prefix tracker messages with their dispatch delay in ms, see core.dispatch
+        message_offsets = kwargs.pop('message_offsets', False)
+        if self.engine == 'headless':
+            # log through the standard library, so that headless sessions run without psychopy
+            self.logging = stdlib_logging.getLogger('exptools')
+            self.clock = VirtualClock()
+            self.keyboard = ScriptedKeyboard(self.clock, kwargs.pop('key_script', []))
+            # there is no hardware buffer to protect
+            self.dispatcher = MessageDispatcher(self.clock, min_interval=0, stamp_offsets=message_offsets)
+        else:
+            self.logging = logging
+            self.clock = core.Clock()
+            self.keyboard = None
+            # outbound tracker messages and triggers are sent from a background thread
+            self.dispatcher = MessageDispatcher(self.clock, stamp_offsets=message_offsets)
         
         self.outputDict = {'parameterArray': [], 'eventArray' : []}
+        self.event_log = EventLog()
         self.events = []
         self.stopped = False
-        self.logging = logging
+        self.sound_engine = None
+        # a BIDSEventWriter, if this session writes a BIDS events file
+        self.bids_events = None
 
         self.create_output_filename()
-
-        engine = kwargs.pop('engine', 'pygaze')
-        self.create_screen(engine=engine, **kwargs)
+        self.trial_writer = TrialWriter(self.output_file + '_trials.jsonl')
+
+        # opt-in per-frame timing of the trial loop
+        frame_timing = kwargs.pop('frame_timing', False)
+        self.refresh_rate = refresh_rate = kwargs.pop('refresh_rate', 60.0)
+        # 'relative' phase timing measures each phase from the frame it started on,
+        # 'absolute' plans all phases on a single session timeline
+        phase_timing = kwargs.pop('phase_timing', 'relative')
+        # memory budget for prebuilt stimuli, in MB, and optionally a maximum number of cached stimulus sets
+        self.stimulus_cache = StimulusCache(memory_budget=kwargs.pop('stimulus_cache_size', 256) * 1024 ** 2, 
+                                            max_entries=kwargs.pop('stimulus_cache_entries', None))
+        # opt-in polling of the keyboard in a background thread, instead of once per frame
+        input_polling = kwargs.pop('input_polling', False)
+        self.input = None
+
+        self.create_screen(engine=self.engine, **kwargs)
+
+        if input_polling:
+            self.start_input()
+
+        if frame_timing:
+            self.frame_timer = FrameTimer(refresh_rate=refresh_rate)
+        else:
+            self.frame_timer = None
 
         self.start_time = self.clock.getTime()
+
+        if phase_timing == 'absolute':
+            self.phase_scheduler = PhaseScheduler(self.clock, refresh_rate=refresh_rate, start_time=self.start_time)
+        elif phase_timing == 'relative':
+            self.phase_scheduler = None
+        else:
+            raise ValueError('phase_timing should be relative or absolute, not %s' % phase_timing)
     
-    def create_screen(self, engine='pygaze', **kwargs):
+    def create_screen(self, engine=None, **kwargs):
+        if engine is None:
+            engine = self.engine
 
          #Set arguments from config file or kwargs
         for argument in ['size', 'full_screen', 'background_color', 'gamma_scale',
                          'physical_screen_size', 'physical_screen_distance',
                          'max_lums', 'wait_blanking', 'screen_nr', 'mouse_visible']:
-            value = kwargs.pop(argument, config.get('screen', argument))
+            value = kwargs.pop(argument, getattr(config.screen, argument))
             setattr(self, argument, value)
 
         if engine == 'pygaze':
@@ -64,7 +134,7 @@ class Session(object):
             self.display = libscreen.Display(disptype='psychopy', 
                                              dispsize=self.size, 
                                              fgc=(255,0,0), 
-                                             bgc=list((255*bgl for bgl in self.background_color)), 
+                                             bgc=rgb_to_255(self.background_color).tolist(), 
                                              screennr=int(self.screen_nr),
                                              mousevisible=self.mouse_visible,
                                              fullscr=self.full_screen, 
@@ -83,26 +153,63 @@ class Session(object):
                                         waitBlanking=self.wait_blanking, 
                                         useFBO=True,
                                         winType='pyglet')
+        elif engine == 'headless':
+            self.screen = NullScreen(self.clock, 
+                                     size=self.size, 
+                                     refresh_rate=self.refresh_rate, 
+                                     background_color=self.background_color)
 
         self.screen.setMouseVisible(self.mouse_visible)
-        event.Mouse(visible=self.mouse_visible, win=self.screen)
+        if engine != 'headless':
+            event.Mouse(visible=self.mouse_visible, win=self.screen)
 
         self.screen.setColor(self.background_color)
         
         self.screen.background_color = self.background_color
         self.screen_pix_size = self.size
 
-        self.screen_height_degrees = 2.0 * 180.0/np.pi * np.arctan((self.physical_screen_size[1]/2.0)/self.physical_screen_distance)
-
-        self.pixels_per_degree = (self.size[1]) / self.screen_height_degrees
+        # vectorized deg, pix and cm conversions, and luminance lookup tables of the screen
+        self.geometry = ScreenGeometry(self.size, self.physical_screen_size, self.physical_screen_distance)
+        self.luminance_table = LuminanceTable(self.gamma_scale, self.max_lums)
 
-        self.centimeters_per_degree = self.physical_screen_size[1] / self.screen_height_degrees
-        self.pixels_per_centimeter = self.pixels_per_degree / self.centimeters_per_degree
+        self.screen_height_degrees = self.geometry.screen_height_degrees
+        self.pixels_per_degree = self.geometry.pixels_per_degree
+        self.centimeters_per_degree = self.geometry.centimeters_per_degree
+        self.pixels_per_centimeter = self.geometry.pixels_per_centimeter
 
         self.screen.flip()
 
     def stop(self):
         self.stopped = True
+
+    def start_input(self, devices=None, poll_interval=0.001):
+        """
+        poll devices (by default the keyboard, or the scripted keyboard in headless sessions)
+        every poll_interval seconds in a background thread. On the virtual clock of a headless 
+        session, which runs much faster than the thread, devices are polled every frame instead.
+        """
+        if devices is None:
+            if self.keyboard is not None:
+                devices = [SimulatedDevice(self.keyboard)]
+            else:
+                devices = [KeyboardDevice(self.clock)]
+        self.input = InputPoller(self.clock, devices, poll_interval=poll_interval)
+        if self.engine != 'headless':
+            self.input.start()
+        return self.input
+
+    def get_keys(self):
+        """
+        (key, time) pairs of the keys pressed since the last call, from the input poller if it runs, 
+        the scripted keyboard in headless sessions, or psychopy's event queue.
+        """
+        if self.input is not None:
+            if not self.input.running:
+                self.input.poll()
+            return self.input.get_events()
+        if self.keyboard is not None:
+            return self.keyboard.getKeys(timeStamped=True)
+        return event.getKeys(timeStamped=self.clock)
     
     def create_output_filename(self, data_directory = 'data'):
         """create output file"""
@@ -114,16 +221,23 @@ class Session(object):
             
         self.output_file = os.path.join(data_directory, self.subject_initials + '_' + str(self.index_number) + '_' + opfn )
     
-    def open_input_file(self):
+    def open_input_file(self, columns = None):
         """
-        This method opens a pickle file that has input data in it.
-        we assume the input data consists of two arrays - one for parameters and one for timings. 
-        the two arrays' rows will be trials.
+        This method opens the input data file for this session, index_number with one of 
+        the extensions in design.design_extensions. Columnar design files 
+        (.design directories, .npz, .parquet, .feather, .csv) are loaded lazily as a TrialSchedule, 
+        with only the given parameter columns. 
+        A legacy .pkl file is unpickled with design.load_pickle, which only accepts containers, 
+        arrays and frames; we assume the input data consists of two 
+        arrays - one for parameters and one for timings. the two arrays' rows will be trials.
         """
-        self.input_file_name = self.index_number + '.pkl'
-        ipf = open(self.input_file_name)
-        self.input_data = pkl.load(ipf)
-        ipf.close()
+        self.input_file_name = find_design_file(str(self.index_number))
+        if self.input_file_name is None:
+            raise IOError('no input file found for %s' % self.index_number)
+        if self.input_file_name.endswith('.pkl'):
+            self.input_data = load_pickle(self.input_file_name)
+        else:
+            self.input_data = load_design(self.input_file_name, columns=columns)
     
     def create_input_data(self, save = False):
         """
@@ -135,64 +249,78 @@ class Session(object):
         """
         We assume that the pickle file used as input will be an array, 
         the rows of which will be the requested trials.
+        If the input data is a TrialSchedule, it is kept as self.schedule and 
+        trials can be created from it with Trial.from_schedule.
         """
+        if isinstance(self.input_data, TrialSchedule):
+            self.input_data.validate()
+            self.schedule = self.input_data
         self.nr_trials = len(self.input_data)
     
+    def prepare_trials(self, trials):
+        """build and cache the stimuli of trials ahead of time, e.g. in a preload phase"""
+        for trial in trials:
+            trial.prepare()
+
+    def write_trial(self, trial):
+        """
+        hand a finished trial to the trial writer, which appends it to the output file 
+        in the background. The session's event log is emptied afterwards, so memory 
+        use does not grow with the number of trials.
+        """
+        self.trial_writer.write(trial.ID, trial.parameters, trial.event_rows)
+        self.event_log.clear()
+
     def close(self):
         """close screen and save data"""
-        pygame.mixer.quit()
+        if self.input is not None:
+            self.input.stop()
+        if 'pygame' in sys.modules and pygame.mixer.get_init():
+            # sounds play through the sound engine; pygame's mixer is only open if pygaze or the experiment started it
+            pygame.mixer.quit()
+        if self.sound_engine is not None:
+            self.logging.info('Sound engine latencies: %s' % self.sound_engine.latency_summary())
+            self.sound_engine.close()
         self.screen.close()
-        parsopf = open(self.output_file + '_outputDict.pkl', 'a')
-        pkl.dump(self.outputDict,parsopf)
-        parsopf.close()
-        # also output parameters as tsv
-        opd = pd.DataFrame.from_records(self.outputDict['parameterArray'])
-        opd.to_csv(path_or_buf=self.output_file + '.tsv', sep='\t', encoding='utf-8')
+        self.dispatcher.close()
+        self.logging.info('Message dispatcher latencies: %s' % self.dispatcher.latency_summary())
+        if self.dispatcher.nr_dropped > 0:
+            self.logging.warning('%d tracker messages and triggers were dropped, the dispatcher queue was full' 
+                                 % self.dispatcher.nr_dropped)
+        # trials have been streamed to disk during the session, 
+        # only compact them into the legacy outputDict pickle and tsv here
+        self.trial_writer.close()
+        self.outputDict = compact_trial_records(self.trial_writer.file_name, self.output_file, self.outputDict)
+        if self.bids_events is not None:
+            self.bids_events.close(self.clock.getTime(), fallback_reference_time=self.start_time)
+        if self.frame_timer is not None:
+            self.frame_timer.write(self.output_file)
+        if self.phase_scheduler is not None:
+            self.phase_scheduler.write(self.output_file)
     
-    def play_sound(self, sound_index = '0'):
-        """docstring for play_sound"""
+    def start_sound_engine(self, rate = 44100):
+        """open the session's sound output stream, if it is not open yet"""
+        if self.sound_engine is None:
+            self.sound_engine = SoundEngine(self.clock, rate=rate)
+        return self.sound_engine
+
+    def play_sound(self, sound_index = '0', start_time = None):
+        """play sound sound_index from self.sounds now, or at session clock time start_time"""
         if type(sound_index) == int:
             sound_index = str(sound_index)
         # assuming 44100 Hz, mono channel np.int16 format for the sounds
-        stream_data = self.sounds[sound_index]
-        
-        self.frame_counter = 0
-        def callback(in_data, frame_count, time_info, status):
-            data = stream_data[self.frame_counter:self.frame_counter+frame_count]
-            self.frame_counter += frame_count
-            return (data, pyaudio.paContinue)
-
-        # open stream using callback (3)
-        stream = self.pyaudio.open(format=pyaudio.paInt16,
-                        channels=1,
-                        rate=44100,
-                        output=True,
-                        stream_callback=callback)
-
-        stream.start_stream()
-        # stream.write(stream_data)
-
-    def play_np_sound(self, sound_array):
-        # assuming 44100 Hz, mono channel np.int16 format for the sounds
-        
-        self.frame_counter = 0
-        def callback(in_data, frame_count, time_info, status):
-            data = sound_array[self.frame_counter:self.frame_counter+frame_count]
-            self.frame_counter += frame_count
-            return (data, pyaudio.paContinue)
+        self.start_sound_engine().play(self.sounds[sound_index], start_time=start_time)
 
-        # open stream using callback (3)
-        stream = self.pyaudio.open(format=pyaudio.paInt16,
-                        channels=1,
-                        rate=44100,
-                        output=True,
-                        stream_callback=callback)
-
-        stream.start_stream()
+    def play_np_sound(self, sound_array, start_time = None):
+        # assuming 44100 Hz, mono channel np.int16 format for the sounds
+        self.start_sound_engine().play(sound_array, start_time=start_time)
 
-    def deg2pix(self, deg):
+    def deg2pix(self, deg, exact=None):
+        """degrees to pixels, for scalars or arrays; exact maps eccentricities through their tangent"""
+        return self.geometry.deg2pix(deg, exact)
 
-        return deg * self.pixels_per_degree
+    def pix2deg(self, pix, exact=None):
+        return self.geometry.pix2deg(pix, exact)
             
 class MRISession(Session):
 
@@ -202,6 +330,10 @@ class MRISession(Session):
                  tr=2, 
                  simulate_mri_trigger=True, 
                  mri_trigger_key=None, 
+                 bids_events=True,
+                 bids_task=None,
+                 bids_session=None,
+                 bids_run=None,
                  *args, 
                  **kwargs):
 
@@ -211,7 +343,7 @@ class MRISession(Session):
         self.simulate_mri_trigger = simulate_mri_trigger
 
         if mri_trigger_key is None:
-            self.mri_trigger_key = config.get('mri', 'mri_trigger_key')    
+            self.mri_trigger_key = config.mri.mri_trigger_key
         else:
             self.mri_trigger_key = mri_trigger_key
 
@@ -220,34 +352,87 @@ class MRISession(Session):
         self.tr = tr
         self.current_tr = 0
         self.target_trigger_time = self.start_time + self.tr
-
-    def mri_trigger(self):
-        self.time_of_last_tr = self.clock.getTime()
-        self.current_tr += 1
+        self.triggers = TriggerTimeline(tr)
+        if bids_events:
+            # events.tsv with onsets relative to the first trigger, written as the run progresses, 
+            # named after the subject, bids_session, bids_task (by default the session class) and 
+            # bids_run (by default the index number, if it is a number); a repeated run with the 
+            # same names raises FileExistsError rather than overwrite the earlier events
+            if bids_task is None:
+                bids_task = type(self).__name__.replace('Session', '') or 'mri'
+            if bids_run is None and str(index_number).isdigit():
+                bids_run = index_number
+            file_name = bids_file_name(subject_initials, bids_task, run=bids_run, session=bids_session)
+            self.bids_events = BIDSEventWriter(os.path.join(os.path.dirname(self.output_file), file_name), 
+                                               ignore_keys=[self.mri_trigger_key], writer=self.trial_writer)
+
+    def mri_trigger(self, simulated=False, time=None):
+        """
+        register a trigger, by default at the current time. current_tr counts scanner volumes:
+        double triggers are not counted, and missed triggers are.
+        """
+        if time is None:
+            time = self.clock.getTime()
+        status = self.triggers.add(time, simulated=simulated)
+        if status == TRIGGER_DOUBLE:
+            self.logging.warning('Double MRI trigger at %s' % time)
+            return
+        if status == TRIGGER_AFTER_MISSED:
+            self.logging.warning('Missed MRI trigger(s) before %s' % time)
+
+        self.time_of_last_tr = time
+        self.current_tr = self.triggers.last_volume + 1
+        if self.triggers.n == 1 and self.phase_scheduler is not None:
+            # the scanner run starts: plan the following trials from the first trigger
+            self.phase_scheduler.reset(time)
+        if self.bids_events is not None:
+            self.bids_events.trigger(time)
+        # the simulated scanner runs at the nominal TR
         self.target_trigger_time = self.start_time + (self.current_tr + 1) * self.tr
 
-        logging.critical('Registered MRI trigger')
+        self.logging.critical('Registered MRI trigger')
+
+    def next_trigger_time(self):
+        """predicted time of the next trigger, corrected for the scanner's effective TR"""
+        if self.triggers.n == 0:
+            return self.target_trigger_time
+        return self.triggers.next_trigger_time(self.clock.getTime())
+
+    def tr_time_to_clock(self, tr_time):
+        """session clock time of tr_time, in TRs since the first trigger"""
+        if self.triggers.n == 0:
+            # before the first trigger, expect it at the simulated scanner's first trigger time
+            return self.target_trigger_time + tr_time * self.tr
+        return self.triggers.clock_time(tr_time)
+
+    def close(self):
+        super(MRISession, self).close()
+        if self.triggers.n > 0:
+            self.logging.info('MRI triggers: %s' % self.triggers.summary())
+            self.triggers.write(self.output_file)
 
 class EyelinkSession(Session):
     """docstring for EyelinkSession"""
     def __init__(self, subject_initials, index_number, tracker_on=0, *args, **kwargs):
 
         super(EyelinkSession, self).__init__(subject_initials, index_number, *args, **kwargs)
+        self.gaze_stream = None
 
         for argument in ['n_calib_points', 'sample_rate', 'calib_size', 'x_offset']:
-            value = kwargs.pop(argument, config.get('eyetracker', argument))
+            value = kwargs.pop(argument, getattr(config.eyetracker, argument))
             setattr(self, argument, value)
 
         # set pygaze settings
-        pygaze.settings.full_screen = self.full_screen
-        pygaze.settings.BGC = list(((np.array(self.background_color) + 1.0)/2.0 * 255).astype(int))
-        if hasattr(self, 'foreground_color'):
-            pygaze.settings.FGC = self.foreground_color
-        else:
-            pygaze.settings.FGC = list(((-np.array(self.background_color) + 1.0)/2.0 * 255).astype(int))
-        pygaze.settings.DISPSIZE = self.screen.size
-        pygaze.settings.SCREENSIZE = self.physical_screen_size
-        pygaze.settings.SCREENDIST = self.physical_screen_distance
+        if self.engine != 'headless':
+            pygaze.settings.full_screen = self.full_screen
+            pygaze.settings.BGC = rgb_to_255(self.background_color).tolist()
+            if hasattr(self, 'foreground_color'):
+                pygaze.settings.FGC = self.foreground_color
+            else:
+                pygaze.settings.FGC = rgb_to_255(-np.array(self.background_color)).tolist()
+            pygaze.settings.DISPSIZE = self.screen.size
+            pygaze.settings.SCREENSIZE = self.physical_screen_size
+            pygaze.settings.SCREENDIST = self.physical_screen_distance
 
         if tracker_on == 1:
             self.create_tracker(tracker_on=True, 
@@ -259,19 +444,15 @@ class EyelinkSession(Session):
             # self.create_tracker(auto_trigger_calibration = 1, calibration_type = 'HV9')
             # if self.tracker_on:
             #     self.tracker_setup()
-           # how many points do we want:
-            n_points = self.n_calib_points
             # create tracker
             self.create_tracker(auto_trigger_calibration=0, 
                                 calibration_type='HV%d'%self.n_calib_points, 
                                 sample_rate=self.sample_rate, *args, **kwargs)
 
-            calibration_targets, validation_targets, point_indices = self._setup_custom_calibration_points()
+            calibration, validation = self.calibration_layouts()
 
             # and send these targets to the custom calibration function:
-            self.custom_calibration(calibration_targets=calibration_targets,
-                validation_targets=validation_targets,point_indices=point_indices,
-                n_points=self.n_calib_points,randomize_order=True,repeat_first_target=True)
+            self.calibrate_layouts(calibration, validation, randomize_order=True, repeat_first_target=True)
             # reapply settings:
             self.tracker_setup()
         else:
@@ -293,7 +474,10 @@ class EyelinkSession(Session):
 
         self.eyelink_temp_file = self.subject_initials[:2] + '_' + str(self.index_number) + '_' + str(np.random.randint(99)) + '.edf'
 
-        if tracker_on:
+        if tracker_on and self.engine == 'headless':
+            self.tracker = SimulatedTracker(self.clock, gaze_position=(self.size[0]/2.0, self.size[1]/2.0))
+            self.tracker_on = True
+        elif tracker_on:
             # create actual tracker
             # try:
             self.tracker = eyetracker.EyeTracker(self.display, trackertype='eyelink', resolution=self.display.dispsize, data_file=self.eyelink_temp_file, bgc=self.display.bgc)
@@ -311,6 +495,9 @@ class EyelinkSession(Session):
             self.tracker_on = False
             return
 
+        if self.dispatcher.stamp_offsets:
+            # tells parsers of the recording that the messages after it carry offsets
+            self.dispatcher.put(self.tracker.log, offset_marker)
         self.apply_settings(sensitivity_class=sensitivity_class, 
                             split_screen=split_screen, 
                             screen_half=screen_half, 
@@ -318,6 +505,16 @@ class EyelinkSession(Session):
                             calibration_type=calibration_type, 
                             sample_rate=sample_rate)
 
+    def calibrate_layouts(self,
+                            calibration,
+                            validation=None,
+                            randomize_order=0,
+                            repeat_first_target=1):
+        """calibrate on the points of the CalibrationLayout calibration, validate on those of validation"""
+        send_commands(self.tracker, calibration_commands(calibration, self.size, validation, 
+                                                         randomize_order=randomize_order, 
+                                                         repeat_first_target=repeat_first_target))
+
     def custom_calibration(self,
                             calibration_targets,
                             validation_targets,
@@ -325,56 +522,49 @@ class EyelinkSession(Session):
                             n_points,
                             randomize_order=0,
                             repeat_first_target=1):
-        
-        # send the messages:
-        self.tracker.send_command('calibration_type = HV%d'%n_points  )
-        self.tracker.send_command('generate_default_targets = NO')
-        self.tracker.send_command('randomize_calibration_order %d'%randomize_order)
-        self.tracker.send_command('randomize_validation_order %d'%randomize_order)
-        self.tracker.send_command('cal_repeat_first_target  %d'%repeat_first_target)
-        self.tracker.send_command('val_repeat_first_target  %d'%repeat_first_target)
-
-        if repeat_first_target:
-            n_points+=1
-         
-        self.tracker.send_command('calibration_samples=%d'%n_points)
-        self.tracker.send_command('calibration_sequence=%s'%point_indices)
-        self.tracker.send_command('calibration_targets = %s'%calibration_targets)
-         
-        self.tracker.send_command('validation_samples=%d'%n_points)
-        self.tracker.send_command('validation_sequence=%s'%point_indices)
-        self.tracker.send_command('validation_targets = %s'%validation_targets)
+        """
+        calibrate on calibration_targets and validate on validation_targets, 'x1,y1 x2,y2 ...' pixel
+        coordinates of n_points targets, shown in the order of point_indices, '0, 1, ... n'. The
+        targets are kept in the order given, as custom CalibrationLayouts.
+        """
+        calibration = CalibrationLayout.from_points(parse_points(calibration_targets), self.size)
+        validation = CalibrationLayout.from_points(parse_points(validation_targets), self.size)
+        if len(calibration.unit_points) != n_points:
+            raise ValueError('%d calibration targets for a %d point calibration' % (len(calibration.unit_points), n_points))
+        send_commands(self.tracker, calibration_commands(calibration, self.size, validation, 
+                                                         randomize_order=randomize_order, 
+                                                         repeat_first_target=repeat_first_target, 
+                                                         point_indices=point_indices))
 
-        
     def apply_settings(self, sensitivity_class = 0, split_screen = False, screen_half = 'L', auto_trigger_calibration = True, sample_rate = 1000, calibration_type = 'HV9', margin = 60):
-        
+        commands = []
         # set EDF file contents 
-        self.tracker.send_command("file_event_filter = LEFT,RIGHT,FIXATION,SACCADE,BLINK,MESSAGE,BUTTON")
-        # self.tracker.send_command("file_sample_filter = LEFT,RIGHT,GAZE,SACCADE,BLINK,MESSAGE,AREA")#,GAZERES,STATUS,HTARGET")
-        self.tracker.send_command("file_sample_data = LEFT,RIGHT,GAZE,AREA,GAZERES,STATUS,HTARGET")
+        commands.append("file_event_filter = LEFT,RIGHT,FIXATION,SACCADE,BLINK,MESSAGE,BUTTON")
+        # commands.append("file_sample_filter = LEFT,RIGHT,GAZE,SACCADE,BLINK,MESSAGE,AREA")#,GAZERES,STATUS,HTARGET")
+        commands.append("file_sample_data = LEFT,RIGHT,GAZE,AREA,GAZERES,STATUS,HTARGET")
         # set link da (used for gaze cursor) 
-        self.tracker.send_command("link_event_filter = LEFT,RIGHT,FIXATION,FIXUPDATE,SACCADE,BLINK")
-        self.tracker.send_command("link_sample_data = GAZE,GAZERES,AREA,HREF,PUPIL,STATUS")
-        self.tracker.send_command("link_event_data = GAZE,GAZERES,AREA,HREF,VELOCITY,FIXAVG,STATUS")
+        commands.append("link_event_filter = LEFT,RIGHT,FIXATION,FIXUPDATE,SACCADE,BLINK")
+        commands.append("link_sample_data = GAZE,GAZERES,AREA,HREF,PUPIL,STATUS")
+        commands.append("link_event_data = GAZE,GAZERES,AREA,HREF,VELOCITY,FIXAVG,STATUS")
         # set furtheinfo
-        self.tracker.send_command("screen_pixel_coords =  0 0 %d %d" %(self.screen_pix_size[0], self.screen_pix_size[1]))
-        self.tracker.send_command("pupil_size_diameter = %s"%('YES'));
-        self.tracker.send_command("heuristic_filter %d %d"%([1, 0][sensitivity_class], 1))
-        self.tracker.send_command("sample_rate = %d" % sample_rate)
+        commands.append("screen_pixel_coords =  0 0 %d %d" %(self.screen_pix_size[0], self.screen_pix_size[1]))
+        commands.append("pupil_size_diameter = %s"%('YES'));
+        commands.append("heuristic_filter %d %d"%([1, 0][sensitivity_class], 1))
+        commands.append("sample_rate = %d" % sample_rate)
         
         # settings tt address saccade sensitivity - to be set with sensitivity_class parameter. 0 is cognitive style, 1 is pursuit/neurological style
-        self.tracker.send_command("saccade_velocity_threshold = %d" %[30, 22][sensitivity_class])
-        self.tracker.send_command("saccade_acceleration_threshold = %d" %[9500, 5000][sensitivity_class])
-        self.tracker.send_command("saccade_motion_threshold = %d" %[0.15, 0][sensitivity_class])
+        commands.append("saccade_velocity_threshold = %d" %[30, 22][sensitivity_class])
+        commands.append("saccade_acceleration_threshold = %d" %[9500, 5000][sensitivity_class])
+        commands.append("saccade_motion_threshold = %d" %[0.15, 0][sensitivity_class])
         
-#       self.tracker.send_command("file_sample_control = 1,0,0")
-        self.tracker.send_command("screen_phys_coords = %d %d %d %d" %(-self.physical_screen_size[0] / 2.0, self.physical_screen_size[1] / 2.0, self.physical_screen_size[0] / 2.0, -self.physical_screen_size[1] / 2.0))
-        self.tracker.send_command("simulation_screen_distance = " + str(self.physical_screen_distance))
+#       commands.append("file_sample_control = 1,0,0")
+        commands.append("screen_phys_coords = %d %d %d %d" %(-self.physical_screen_size[0] / 2.0, self.physical_screen_size[1] / 2.0, self.physical_screen_size[0] / 2.0, -self.physical_screen_size[1] / 2.0))
+        commands.append("simulation_screen_distance = " + str(self.physical_screen_distance))
         
         if auto_trigger_calibration:
-            self.tracker.send_command("enable_automatic_calibration = YES")
+            commands.append("enable_automatic_calibration = YES")
         else:
-            self.tracker.send_command("enable_automatic_calibration = NO")
+            commands.append("enable_automatic_calibration = NO")
         
         # for binocular stereo-setup need to adjust the calibration procedure to sample only points on the left/right side of the screen. This allows only HV9 calibration for now.
             # standard would be:
@@ -393,21 +583,11 @@ class EyelinkSession(Session):
         #   ;;   12 13
         #   ;;   8 3 9
         if split_screen:
-            self.tracker.send_command("calibration_type = HV9")
-            self.tracker.send_command("generate_default_targets = NO")
-            
-            sh, nsw = self.screen.size[1], self.screen.size[0]/2
-            points = np.array([[nsw/2, sh/2], [nsw/2, sh-margin], [nsw/2, margin], [margin, sh/2], [nsw-margin, sh/2], [margin, sh - margin], [nsw - margin, sh - margin], [margin, margin], [nsw - margin, margin]])
-            if screen_half == 'R':
-                points[:,0] += nsw
-            points_string = ''
-            for p in points:
-                points_string += "%s,%s " % tuple(p)
-            points_string = points_string[:-1] # delete last space
-            self.tracker.send_command("calibration_targets = " % points_string)
-            self.tracker.send_command("validation_targets = " % points_string)
+            calibration = CalibrationLayout('HV9', margin=margin, screen_half=screen_half)
+            commands.extend(calibration_commands(calibration, self.size))
         else:
-            self.tracker.send_command("calibration_type = " + calibration_type)
+            commands.append("calibration_type = " + calibration_type)
+        send_commands(self.tracker, commands)
             
     def tracker_setup(self, sensitivity_class = 0, split_screen = False, screen_half = 'L', auto_trigger_calibration = True, calibration_type = 'HV9', sample_rate = 1000):
         if self.tracker.connected():
@@ -420,7 +600,7 @@ class EyelinkSession(Session):
             # we'll record the whole session continuously and parse the data afterward using the messages sent to the eyelink.
             self.tracker.start_recording()
             # for that, we'll need the pixel size and the like. 
-            self.tracker.log('degrees per pixel ' + str(self.pixels_per_degree) )
+            self.dispatcher.put(self.tracker.log, 'degrees per pixel %s', self.pixels_per_degree)
             # now, we want to know how fast we're sampling, really
 #           self.eye_measured, self.sample_rate, self.CR_mode, self.file_sample_filter, self.link_sample_filter = self.tracker.getModeData()
             self.sample_rate = sample_rate
@@ -438,7 +618,28 @@ class EyelinkSession(Session):
                 else:
                     self.tracker_setup()
     
+    def start_gaze_stream(self, source=None, buffer_duration=60.0):
+        """
+        start reading all gaze samples into a buffer in the background. By default samples come 
+        from the tracker, or from the mouse if there is no tracker. While the stream runs, 
+        eye_pos and detect_saccade use its samples instead of polling.
+        """
+        if source is None:
+            if self.tracker:
+                source = TrackerSource(self.clock)
+            else:
+                source = MouseSource(self.clock, self.screen.size[1])
+        self.gaze_stream = GazeStream(source, sample_rate=self.sample_rate, buffer_duration=buffer_duration)
+        self.gaze_stream.start()
+
+    def stop_gaze_stream(self):
+        if self.gaze_stream is not None:
+            self.gaze_stream.stop()
+            self.gaze_stream = None
+
     def eye_pos(self):
+        if self.gaze_stream is not None and self.gaze_stream.buffer.nr_samples > 0:
+            return tuple(self.gaze_stream.latest(1)[1][0])
         if self.tracker:
             return self.tracker.sample() # check for new sample update
             # if(dt != None):
@@ -456,48 +657,41 @@ class EyelinkSession(Session):
             y = self.screen.size[1]-y
             return x,y
         
-    def detect_saccade(self, algorithm_type = 'velocity', threshold = 0.25, direction = None, fixation_position = None, max_time = 1.0 ):
+    def detect_saccade(self, algorithm_type = 'velocity', threshold = 0.25, direction = None, fixation_position = None, max_time = 1.0, velocity_threshold = 6.0, min_duration = 0.006 ):
         """
         detect_saccade tries to detect a saccade based on position (needs fixation_position argument) or velocity (perhaps a direction argument?) information. 
         It can be 'primed' with a vector giving the predicted direction of the impending saccade. 
         detect_saccade looks for a saccade between call_time (= now) and max_time+call_time
+        For the velocity algorithm, velocity_threshold is in units of the median-based velocity standard deviation, 
+        see SaccadeDetector; threshold is the position algorithm's threshold in degrees.
         """
+        if self.gaze_stream is not None and algorithm_type in ['velocity', 'position']:
+            return self._detect_saccade_from_stream(algorithm_type, threshold, direction, fixation_position, max_time, velocity_threshold, min_duration)
+
         no_saccade = True
-        start_time = core.getTime()
+        start_time = self.clock.getTime()
         if algorithm_type == 'velocity':
-            sample_array = np.zeros((max_time * self.sample_rate, 2), dtype = np.float32)
-            velocity_array = np.zeros((max_time * self.sample_rate, 2), dtype = np.float32)
-            f = np.array([1,1,2,3], dtype = np.float32)/7.0
-            nr_samples = 1
-            sample_array[0,:] = self.eye_pos()
-            velocity_array[0,:] = 0.001, 0.001
-            if direction != None: # make direction a unit vector if it is an argument to this function
-                direction = direction / np.linalg.norm(direction)
-            
+            detector = SaccadeDetector(sample_rate=self.sample_rate, 
+                                       threshold=velocity_threshold, 
+                                       min_duration=min_duration,
+                                       direction=direction)
+            last_position = None
             while no_saccade:
-                saccade_polling_time = core.getTime()
-                sample_array[nr_samples][:] = self.eye_pos()
-                if (sample_array[nr_samples-1][0] != sample_array[nr_samples][0]) or (sample_array[nr_samples-1][1] != sample_array[nr_samples][1]):
-                    velocity_array[nr_samples][:] = sample_array[nr_samples][:] - sample_array[nr_samples-1][:]
-                    if nr_samples > 3:
-                        # scale velocities according to x and y median-based standard deviations, as in engbert & mergenthaler, 2006
-                        med_scaled_velocity = velocity_array[:nr_samples]/np.mean(np.sqrt(((velocity_array[:nr_samples] - np.median(velocity_array[:nr_samples], axis = 0))**2)), axis = 0)
-                        if direction != None: 
-                            # scale the velocity array according to the direction in the direction argument before thresholding
-                            # assuming direction is a x,y unit vector specifying the expected direction of the impending saccade
-                            if np.inner(med_scaled_velocity[nr_samples], direction) > threshold:
-                                no_saccade = False
-                        if np.linalg.norm(med_scaled_velocity[-1]) > threshold:
-                            no_saccade = False
-                    nr_samples += 1
+                saccade_polling_time = self._saccade_polling_time(1.0 / self.sample_rate)
+                position = tuple(self.eye_pos())
+                # only new samples go into the detector
+                if position != last_position:
+                    if detector.add_sample(saccade_polling_time, position) is not None:
+                        no_saccade = False
+                    last_position = position
                 if ( saccade_polling_time - start_time ) > max_time:
                     no_saccade = False
             
         if algorithm_type == 'position' or not self.tracker:
-            if fixation_position == None:
+            if fixation_position is None:
                 fixation_position = np.array(self.eye_pos())
             while no_saccade:
-                saccade_polling_time = core.getTime()
+                saccade_polling_time = self._saccade_polling_time(1.0 / self.sample_rate)
                 ep = np.array(self.eye_pos())
         #       print ep, fixation_position, threshold, np.linalg.norm(ep - fixation_position) / self.pixels_per_degree
                 if (np.linalg.norm(ep - fixation_position) / self.pixels_per_degree) > threshold:
@@ -510,7 +704,7 @@ class EyelinkSession(Session):
         if algorithm_type == 'eyelink':
             while no_saccade:
                 self.tracker.wait_for_saccade_start()
-                saccade_polling_time = core.getTime()
+                saccade_polling_time = self.clock.getTime()
                 # ev = 
                 # if ev == 5: # start of a saccade
                 #   no_saccade = False
@@ -520,7 +714,43 @@ class EyelinkSession(Session):
         return saccade_polling_time
             
     
+    def _saccade_polling_time(self, interval):
+        """the session time of a poll for saccades; on the virtual clock of a headless session every poll takes interval"""
+        if self.engine == 'headless':
+            return self.clock.advance(interval)
+        return self.clock.getTime()
+
+    def _detect_saccade_from_stream(self, algorithm_type, threshold, direction, fixation_position, max_time, velocity_threshold, min_duration):
+        """detect_saccade on all samples of the gaze stream, waiting for new samples instead of polling"""
+        start_time = last_sample_time = self.clock.getTime()
+        if algorithm_type == 'velocity':
+            detector = SaccadeDetector(sample_rate=self.sample_rate, 
+                                       threshold=velocity_threshold, 
+                                       min_duration=min_duration,
+                                       direction=direction)
+        elif fixation_position is None:
+            fixation_position = np.array(self.eye_pos())
+
+        while True:
+            saccade_polling_time = self._saccade_polling_time(0.01)
+            if ( saccade_polling_time - start_time ) > max_time:
+                break
+            self.gaze_stream.wait_for_samples(last_sample_time, timeout=0.01)
+            times, positions = self.gaze_stream.samples_since(last_sample_time)
+            if times.shape[0] == 0:
+                continue
+            last_sample_time = times[-1]
+            if algorithm_type == 'velocity':
+                if detector.add_samples(times, positions) is not None:
+                    break
+            elif ((np.linalg.norm(positions - fixation_position, axis=1) / self.pixels_per_degree) > threshold).any():
+                break
+        return saccade_polling_time
+
     def close(self):
+        self.stop_gaze_stream()
+        # send all pending messages before the recording stops
+        self.dispatcher.close()
         if self.tracker:
             if self.tracker.connected():
                 self.tracker.stop_recording()
@@ -529,84 +759,33 @@ class EyelinkSession(Session):
             self.tracker.close()
         super(EyelinkSession, self).close()
     
-    def play_sound(self, sound_index = '1'):
+    def play_sound(self, sound_index = '1', start_time = None):
         """docstring for play_sound"""
-        super(EyelinkSession, self).play_sound(sound_index = sound_index)
+        super(EyelinkSession, self).play_sound(sound_index = sound_index, start_time = start_time)
         if self.tracker != None:
-            self.tracker.log('sound ' + str(sound_index) + ' at ' + str(core.getTime()) )
+            self.dispatcher.put(self.tracker.log, 'sound %s at %s', sound_index, self.clock.getTime(), stamp_offset=True)
+
+    def calibration_layouts(self):
+        """
+        the calibration and validation CalibrationLayouts of a custom calibration: n_calib_points
+        (5, 9 or 13) points spanning calib_size times the screen height, shifted by x_offset. The
+        HV9 corners are at half eccentricity; in HV13 the inner points are there already. Validation
+        points span three quarters of that.
+        """
+        layout = 'HV%d' % self.n_calib_points
+        corner_eccentricity = 0.5 if self.n_calib_points == 9 else 1.0
+        calibration = CalibrationLayout(layout, extent=self.calib_size, offset=(self.x_offset, 0), 
+                                        corner_eccentricity=corner_eccentricity)
+        validation = CalibrationLayout(layout, extent=self.calib_size * 0.75, offset=(self.x_offset, 0), 
+                                       corner_eccentricity=corner_eccentricity)
+        return calibration, validation
 
     def _setup_custom_calibration_points(self):
-        # order should be with 5 points: center-up-down-left-right
-        # order should be with 9 points: center-up-down-left-right-leftup-rightup-leftdown-rightdown 
-        # order should be with 13: center-up-down-left-right-leftup-rightup-leftdown-rightdown-midleftmidup-midrightmidup-midleftmiddown-midrightmiddown
-        # so always: up->down or left->right
-        # it is setup to do a 9 or 5 point circular calibration, at reduced ecc
-
-        # create 4 x levels:
-        width = self.calib_size * self.size[1]
-        x_start = (self.size[0]-width)/2
-        x_end = self.size[0]-(self.size[0]-width)/2
-        x_range = np.linspace(x_start,x_end,5) + self.x_offset
-        y_start = (self.size[1]-width)/2
-        y_end = self.size[1]-(self.size[1]-width)/2
-        y_range = np.linspace(y_start,y_end,5) 
-
-        # set calibration targets    
-        cal_center = [x_range[2],y_range[2]]
-        cal_left = [x_range[0],y_range[2]]
-        cal_right = [x_range[4],y_range[2]]
-        cal_up = [x_range[2],y_range[0]]
-        cal_down = [x_range[2],y_range[4]]
-        cal_leftup = [x_range[1],y_range[1]]
-        cal_rightup = [x_range[3],y_range[1]]
-        cal_leftdown = [x_range[1],y_range[3]]
-        cal_rightdown = [x_range[3],y_range[3]]            
-        
-        # create 4 x levels:
-        width = self.eyelink_calib_size*0.75 * self.size[1]
-        x_start = (self.size[0]-width)/2
-        x_end = self.size[0]-(self.size[0]-width)/2
-        x_range = np.linspace(x_start,x_end,5) + self.x_offset
-        y_start = (self.size[1]-width)/2
-        y_end = self.size[1]-(self.size[1]-width)/2
-        y_range = np.linspace(y_start,y_end,5) 
-
-        # set calibration targets    
-        val_center = [x_range[2],y_range[2]]
-        val_left = [x_range[0],y_range[2]]
-        val_right = [x_range[4],y_range[2]]
-        val_up = [x_range[2],y_range[0]]
-        val_down = [x_range[2],y_range[4]]
-        val_leftup = [x_range[1],y_range[1]]
-        val_rightup = [x_range[3],y_range[1]]
-        val_leftdown = [x_range[1],y_range[3]]
-        val_rightdown = [x_range[3],y_range[3]]   
-
-        # get them in the right order
-        if self.n_calib_points == 5:
-            cal_xs = np.round([cal_center[0],cal_up[0],cal_down[0],cal_left[0],cal_right[0]])
-            cal_ys = np.round([cal_center[1],cal_up[1],cal_down[1],cal_left[1],cal_right[1]])
-            val_xs = np.round([val_center[0],val_up[0],val_down[0],val_left[0],val_right[0]])
-            val_ys = np.round([val_center[1],val_up[1],val_down[1],val_left[1],val_right[1]])
-        elif self.n_calib_points == 9:
-            cal_xs = np.round([cal_center[0],cal_up[0],cal_down[0],cal_left[0],cal_right[0],cal_leftup[0],cal_rightup[0],cal_leftdown[0],cal_rightdown[0]])
-            cal_ys = np.round([cal_center[1],cal_up[1],cal_down[1],cal_left[1],cal_right[1],cal_leftup[1],cal_rightup[1],cal_leftdown[1],cal_rightdown[1]])         
-            val_xs = np.round([val_center[0],val_up[0],val_down[0],val_left[0],val_right[0],val_leftup[0],val_rightup[0],val_leftdown[0],val_rightdown[0]])
-            val_ys = np.round([val_center[1],val_up[1],val_down[1],val_left[1],val_right[1],val_leftup[1],val_rightup[1],val_leftdown[1],val_rightdown[1]])                     
-        #xs = np.round(np.linspace(x_edge,self.size[0]-x_edge,self.n_calib_points))
-        #ys = np.round([self.ywidth/3*[1,2][pi%2] for pi in range(self.n_calib_points)])
-
-        # put the points in format that eyelink wants them, which is
-        # calibration_targets / validation_targets: 'x1,y1 x2,y2 ... xz,yz'
-        calibration_targets = ' '.join(['%d,%d'%(cal_xs[pi],cal_ys[pi]) for pi in range(self.n_calib_points)])
-        # just copy calibration targets as validation for now:
-        #validation_targets = calibration_targets
-        validation_targets = ' '.join(['%d,%d'%(val_xs[pi],val_ys[pi]) for pi in range(self.n_calib_points)])
-
-        # point_indices: '0, 1, ... n'
-        point_indices = ', '.join(['%d'%pi for pi in range(self.n_calib_points)])
-
-        return calibration_targets, validation_targets, point_indices
+        """the calibration_layouts as calibration_targets, validation_targets and point_indices strings"""
+        calibration, validation = self.calibration_layouts()
+        point_indices = ', '.join('%d' % pi for pi in range(len(calibration.unit_points)))
+        return (format_points(calibration.points(self.size)), format_points(validation.points(self.size)), 
+                point_indices)
 
 
 class StarStimSession(EyelinkSession):
@@ -614,8 +793,8 @@ class StarStimSession(EyelinkSession):
     It assumes an active recording, using NIC already connected over bluetooth.
     Triggers land in the file that's already set up and recording.
     """
-    def __init__(self, subject_initials, index_number, connect_to_starstim = False, TCP_IP = '10.0.1.201', TCP_PORT = 1234):
-        super(StarStimSession, self).__init__(subject_initials, index_number)
+    def __init__(self, subject_initials, index_number, connect_to_starstim = False, TCP_IP = '10.0.1.201', TCP_PORT = 1234, *args, **kwargs):
+        super(StarStimSession, self).__init__(subject_initials, index_number, *args, **kwargs)
         self.setup_starstim_connection(TCP_IP = TCP_IP, TCP_PORT = TCP_PORT, connect_to_starstim = connect_to_starstim)
 
     def setup_starstim_connection(self, TCP_IP = '10.0.1.201', TCP_PORT = 1234, connect_to_starstim = True):
@@ -624,7 +803,10 @@ class StarStimSession(EyelinkSession):
         more on that later. 
         """
         if connect_to_starstim:
-            self.star_stim_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            if self.engine == 'headless':
+                self.star_stim_socket = SimulatedStarStimSocket(self.clock)
+            else:
+                self.star_stim_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.star_stim_socket.connect((TCP_IP, TCP_PORT))
             self.star_stim_connected = True
         else:
@@ -635,10 +817,15 @@ class StarStimSession(EyelinkSession):
             self.star_stim_socket.close()
 
     def send_starstim_trigger(self, trigger = 1):
+        """queue a trigger, it is sent to the starstim by the message dispatcher"""
         if self.star_stim_connected:
-            self.star_stim_socket.sendall('<TRIGGER>%i</TRIGGER>'%trigger)
+            self.dispatcher.put(self._send_starstim_message, '<TRIGGER>%i</TRIGGER>', trigger)
+
+    def _send_starstim_message(self, message):
+        self.star_stim_socket.sendall(message.encode('ascii'))
 
     def close(self):
+        # EyelinkSession.close sends all queued triggers before the connection is closed
         super(StarStimSession, self).close()
         if self.star_stim_connected:
             self.close_starstim_connection()
@@ -648,33 +835,48 @@ class SoundSession(Session):
 
 
     def __init__(self, *args, **kwargs):
-        self.setup_sound_system()
+        self.setup_sound_system(kwargs.pop('sound_directory', None))
         super(SoundSession, self).__init__(*args, **kwargs)
+        # a single output stream for all sounds of the session
+        self.start_sound_engine()
 
-    def setup_sound_system(self):
-        """initialize pyaudio backend, and create dictionary of sounds."""
-        self.pyaudio = pyaudio.PyAudio()
-        self.sound_files = subprocess.Popen('ls ' + os.path.join(os.environ['EXPERIMENT_HOME'], 'sounds', '*.wav'), shell=True, stdout=subprocess.PIPE).communicate()[0].split('\n')[0:-1]
-        self.sounds = {}
-        for sf in self.sound_files:
-            self.read_sound_file(file_name = sf)
+    def setup_sound_system(self, sound_directory = None):
+        """create dictionary of sounds from the wav files in sound_directory, by default $EXPERIMENT_HOME/sounds."""
+        if sound_directory is None:
+            sound_directory = os.path.join(os.environ['EXPERIMENT_HOME'], 'sounds')
+        library = SoundLibrary(sound_directory)
+        self.sound_files = library.file_names()
+        self.sounds = library.load()
 
     def read_sound_file(self, file_name, sound_name = None):
         """Read sound file from file_name, and append to self.sounds with name as key"""
         if sound_name == None:
             sound_name = os.path.splitext(os.path.split(file_name)[-1])[0]
 
-        rate, data = wavfile.read(file_name)
-        # create stream data assuming 2 channels, i.e. stereo data, and use np.float32 data format
-        stream_data = data.astype(np.int16)
+        # mono, 44100 Hz, np.int16 stream data
+        self.sounds.update({sound_name: read_sound(file_name)})
+
 
-        # check data formats - is this stereo sound? If so, we need to fix it. 
-        wf = wave.open(file_name, 'rb')
-        if wf.getnchannels() == 2:
-            stream_data = stream_data[::2]
+def _in_new_directory(test):
+    """run test in a new temporary directory, so that the sessions' ./data stays out of the working directory"""
+    import functools
+    import shutil
+    import tempfile
 
-        self.sounds.update({sound_name: stream_data})
+    @functools.wraps(test)
+    def run_test():
+        working_directory = os.getcwd()
+        directory = tempfile.mkdtemp()
+        os.chdir(directory)
+        try:
+            return test()
+        finally:
+            os.chdir(working_directory)
+            shutil.rmtree(directory, ignore_errors=True)
+    return run_test
 
+
+@_in_new_directory
 def test_MRISession_simulation():
     from .trial import Trial
 
@@ -692,5 +894,176 @@ def test_MRISession_simulation():
     assert(session.current_tr > 0) 
 
 
+@_in_new_directory
+def test_headless_MRISession():
+    from .trial import MRITrial
+
+    session = MRISession('GdH', 1, engine='headless', tr=2, simulate_mri_trigger=True)
+
+    for i in range(3):
+        trial = MRITrial(parameters={'i': i}, phase_durations=[1.0, 2.0], session=session)
+        trial.ID = i
+        trial.run()
+
+    # 9 seconds on the virtual clock, in as little wall-clock time as the loop takes;
+    # in relative phase timing every phase and trial start can overshoot by a frame
+    assert(0 <= session.clock.getTime() - 9.0 < 3 * 3 / 60.0)
+    assert(session.current_tr == 4)
+    assert(session.triggers.simulated[:session.triggers.n].all())
+    assert(abs(session.next_trigger_time() - 10.0) < 0.1)
+    session.close()
+    assert(os.path.exists(session.output_file + '_triggers.tsv'))
+    assert(os.path.split(session.bids_events.file_name)[-1] == 'sub-GdH_task-MRI_run-1_events.tsv')
+    with open(session.bids_events.file_name) as f:
+        # two phases per trial, the first trial starts before the first trigger
+        lines = f.readlines()[1:]
+    assert(len(lines) == 6 and float(lines[0].split('\t')[0]) < 0)
 
 
+@_in_new_directory
+def test_headless_input_polling_key_times():
+    from .trial import Trial
+    from .events import KEY
+
+    # keys between frames are recorded at their scripted times, with and without input polling
+    key_times = []
+    for input_polling in [False, True]:
+        session = Session('KT', 1, engine='headless', input_polling=input_polling, key_script=[(0.1234, 'b'), (0.5, 'n')])
+        trial = Trial(parameters={}, phase_durations=[1.0], session=session)
+        trial.ID = 0
+        trial.run()
+        session.close()
+        rows = trial.event_rows
+        key_times.append(rows['time'][rows['code'] == KEY].tolist())
+    assert(key_times[0] == key_times[1] == [0.1234, 0.5])
+
+
+@_in_new_directory
+def test_headless_MRITrial_key_event():
+    import warnings
+    from .trial import MRITrial
+
+    class ResponseTrial(MRITrial):
+        # the key_event signature of experiments written before simulated triggers
+        def key_event(self, key):
+            self.keys.append((key, self.simulated_trigger))
+            super(ResponseTrial, self).key_event(key)
+
+    session = MRISession('KE', 1, engine='headless', tr=2, simulate_mri_trigger=True, key_script=[(1.0, 'b')])
+    trial = ResponseTrial(parameters={}, phase_durations=[5.0], session=session, tr_onset=1)
+    trial.ID = 0
+    trial.keys = []
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        trial.run()
+    session.close()
+
+    # tr_onset has no effect in relative timing
+    assert(len(caught) == 1 and 'tr_onset' in str(caught[0].message))
+    assert(trial.keys[0] == ('b', False) and trial.keys[1:] == [('t', True), ('t', True)])
+    assert(session.current_tr == 2 and session.triggers.simulated[:session.triggers.n].all())
+
+
+@_in_new_directory
+def test_headless_absolute_timing_gap():
+    from .trial import Trial
+
+    session = Session('AT', 1, engine='headless', phase_timing='absolute')
+    # instructions before the first trial and a pause between the trials
+    session.clock.advance(3.0)
+    durations = []
+    for i in range(2):
+        trial = Trial(parameters={}, phase_durations=[0.5, 1.0], session=session)
+        trial.ID = i
+        trial.run()
+        durations.append(session.clock.getTime() - trial.start_time)
+        session.clock.advance(2.0)
+    session.close()
+
+    # both trials keep their phases, instead of collapsing to a single flip
+    assert(np.allclose(durations, 1.5, atol=2 / 60.0))
+    report = session.phase_scheduler.report()
+    assert(len(report) == 4 and (report['onset_error'].abs() < 1 / 60.0).all())
+    assert(len(session.phase_scheduler.late_starts) == 2)
+
+
+@_in_new_directory
+def test_headless_trial_events():
+    from .trial import Trial
+    from .output import read_trial_records
+
+    class MessageTrial(Trial):
+        def create_stimuli(self):
+            self.events.append('stimuli created for trial %s' % self.ID)
+
+        def key_event(self, key):
+            super(MessageTrial, self).key_event(key)
+            self.events.append('feedback for a rather long key name %s' % key)
+
+    session = Session('TE', 1, engine='headless', key_script=[(0.5, 'num_multiply_long_key_name')])
+    trial = MessageTrial(parameters={}, phase_durations=[1.0], session=session)
+    trial.ID = 0
+    trial.events.append('logged before the trial runs')
+    trial.run()
+    session.close()
+
+    events = session.outputDict['eventArray'][0]
+    assert(events[0].startswith('trial 0 started at '))
+    assert(events[1:3] == ['logged before the trial runs', 'stimuli created for trial 0'])
+    assert(events[3].startswith('trial 0 event num_multiply_long_key_name at '))
+    assert(events[4] == 'feedback for a rather long key name num_multiply_long_key_name')
+    record = list(read_trial_records(session.trial_writer.file_name))[0]
+    assert(record['events']['key'][3] == 'num_multiply_long_key_name')
+
+
+@_in_new_directory
+def test_headless_EyelinkSession_calibration():
+    session = EyelinkSession('GdH', 1, engine='headless')
+    session.create_tracker(split_screen=True, screen_half='R')
+    session.calibrate_layouts(*session.calibration_layouts())
+    # scripts written against the string form send the same commands
+    session.custom_calibration(*session._setup_custom_calibration_points(), n_points=session.n_calib_points)
+    session.close()
+
+    commands = [command for time, command in session.tracker.commands]
+    targets = [command for command in commands if command.startswith('calibration_targets')]
+    # the split-screen targets on the right half, then the custom targets around the center
+    assert(len(targets) == 3 and targets[0].split()[2] == '%d,%d' % (session.size[0] * 3 / 4, session.size[1] / 2))
+    assert(targets[1].split()[2] == '%d,%d' % (session.size[0] / 2 + session.x_offset, session.size[1] / 2))
+    n_commands = len(calibration_commands(session.calibration_layouts()[0], session.size))
+    assert(commands[-n_commands:] == commands[-2 * n_commands:-n_commands])
+
+    # old scripts give their own sequence, repeating the first target, and keep their targets in order
+    calibration_targets, validation_targets, point_indices = session._setup_custom_calibration_points()
+    sequence = '4, 4, 0, 2, 1, 3, 5, 6, 7, 8'
+    session.custom_calibration(calibration_targets, validation_targets, sequence, 9, repeat_first_target=1)
+    commands = [command for time, command in session.tracker.commands][-n_commands:]
+    assert('calibration_samples=10' in commands and 'calibration_sequence=%s' % sequence in commands)
+    assert('calibration_targets = %s' % calibration_targets in commands)
+    assert('validation_targets = %s' % validation_targets in commands)
+
+    for n_calib_points in [5, 9, 13]:
+        session.n_calib_points = n_calib_points
+        for layout in session.calibration_layouts():
+            points = [tuple(point) for point in layout.points(session.size)]
+            assert(len(set(points)) == n_calib_points)
+
+
+@_in_new_directory
+def test_headless_detect_saccade():
+    session = EyelinkSession('DS', 1, engine='headless')
+    session.create_tracker()
+    poll_interval = 1.0 / session.sample_rate
+
+    # without a saccade, detect_saccade gives up after max_time on the virtual clock
+    start_time = session.clock.getTime()
+    saccade_time = session.detect_saccade(algorithm_type='position', threshold=1.0, max_time=0.2)
+    assert(0.2 < saccade_time - start_time <= 0.2 + 2 * poll_interval)
+
+    # a gaze position far from fixation is a saccade on the first poll
+    fixation_position = np.array(session.eye_pos())
+    session.tracker.gaze_position = tuple(fixation_position + 5 * session.pixels_per_degree)
+    start_time = session.clock.getTime()
+    saccade_time = session.detect_saccade(algorithm_type='position', threshold=1.0, fixation_position=fixation_position)
+    assert(np.isclose(saccade_time - start_time, poll_interval))
+    session.close()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+simulation.py
+
+Simulated hardware for headless sessions. A NullScreen does not draw anything;
+its flip() advances a VirtualClock by one refresh interval, so the trial loop
+runs as fast as the CPU allows while all timing logic sees a regular display.
+Responses come from a ScriptedKeyboard, and SimulatedTracker and
+SimulatedStarStimSocket stand in for the eyelink and the starstim.
+"""
+
+import numpy as np
+
+
+class VirtualClock(object):
+    """a clock with the interface of psychopy.core.Clock that only moves when it is advanced"""
+    def __init__(self, start_time=0.0):
+        self._time = start_time
+
+    def getTime(self):
+        return self._time
+
+    def reset(self, newT=0.0):
+        self._time = newT
+
+    def add(self, t):
+        self._time += t
+
+    def advance(self, t):
+        self._time += t
+        return self._time
+
+
+class NullScreen(object):
+    """a window that draws nothing, and whose flip() advances clock by one refresh interval"""
+    def __init__(self, clock, size=(1920, 1080), refresh_rate=60.0, background_color=(-1, -1, -1)):
+        self.clock = clock
+        self.size = np.array(size)
+        self.refresh_rate = float(refresh_rate)
+        self.frame_interval = 1.0 / self.refresh_rate
+        self.background_color = background_color
+        self.waitBlanking = True
+        self.nr_flips = 0
+
+    def flip(self, clearBuffer=True):
+        self.nr_flips += 1
+        return self.clock.advance(self.frame_interval)
+
+    def setColor(self, color, colorSpace=None):
+        self.background_color = color
+
+    def setMouseVisible(self, visibility):
+        pass
+
+    def getActualFrameRate(self, *args, **kwargs):
+        return self.refresh_rate
+
+    def close(self):
+        pass
+
+
+class ScriptedKeyboard(object):
+    """
+    returns the keys of a script of (time, key) pairs once clock has passed their time,
+    with the interface of psychopy.event.getKeys.
+    """
+    def __init__(self, clock, script=()):
+        self.clock = clock
+        script = sorted(script)
+        self.times = np.array([t for t, key in script], dtype=np.float64)
+        self.keys = [key for t, key in script]
+        self._next = 0
+
+    def add(self, time, key):
+        """add a key press to the script, after the keys already in it"""
+        self.times = np.append(self.times, time)
+        self.keys.append(key)
+
+    def getKeys(self, keyList=None, timeStamped=False):
+        end = self._next + np.searchsorted(self.times[self._next:], self.clock.getTime(), side='right')
+        keys = [(self.keys[i], self.times[i]) for i in range(self._next, end)]
+        self._next = end
+        if keyList is not None:
+            keys = [k for k in keys if k[0] in keyList]
+        if timeStamped:
+            return [list(k) for k in keys]
+        return [k[0] for k in keys]
+
+
+class SimulatedTracker(object):
+    """
+    stands in for the pygaze eyetracker: messages and commands are stored with their clock time,
+    and on close the messages are written as eyelink ASC-style MSG lines to local_data_file.
+    Samples are a fixed gaze position.
+    """
+    def __init__(self, clock, gaze_position=(0, 0)):
+        self.clock = clock
+        self.gaze_position = gaze_position
+        self.messages = []
+        self.commands = []
+        self.recording = False
+        self.local_data_file = None
+
+    def connected(self):
+        return True
+
+    def log(self, message):
+        self.messages.append((self.clock.getTime(), message))
+
+    def send_command(self, command):
+        self.commands.append((self.clock.getTime(), command))
+
+    def calibrate(self):
+        pass
+
+    def doDriftCorrect(self, x, y, draw, allow_setup):
+        return 0
+
+    def start_recording(self):
+        self.recording = True
+
+    def stop_recording(self):
+        self.recording = False
+
+    def sample(self):
+        return self.gaze_position
+
+    def wait_for_saccade_start(self):
+        return self.clock.getTime()
+
+    def close(self):
+        if self.local_data_file is not None:
+            with open(self.local_data_file, 'w') as f:
+                for time, message in self.messages:
+                    f.write('MSG\t%d %s\n' % (int(round(time * 1000)), message))
+
+
+class SimulatedStarStimSocket(object):
+    """stands in for the starstim trigger socket, storing what is sent with its clock time"""
+    def __init__(self, clock):
+        self.clock = clock
+        self.sent = []
+
+    def connect(self, address):
+        pass
+
+    def sendall(self, data):
+        self.sent.append((self.clock.getTime(), data))
+
+    def close(self):
+        pass
+
+
+def test_headless_hardware():
+    clock = VirtualClock()
+    screen = NullScreen(clock, refresh_rate=100.0)
+    keyboard = ScriptedKeyboard(clock, [(0.025, 'space'), (0.011, 'b'), (0.03, 't')])
+    keys = []
+    for frame in range(3):
+        screen.flip()
+        keys.append(keyboard.getKeys())
+    assert(np.isclose(clock.getTime(), 0.03))
+    assert(keys == [[], ['b'], ['space', 't']])
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+sound.py
+
+A persistent sound engine: one pyaudio output stream is opened for the whole
+session, and its callback mixes all playing sounds (voices) with NumPy.
+Sounds can be started as soon as possible or at a given session clock time.
+
+SoundLibrary loads a directory of wav files in parallel, converted to the
+engine's format, and keeps the decoded arrays in a content-hashed on-disk cache
+in the user's home directory, that is memory-mapped on later startups.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# decoded sounds are cached by content, so one cache serves all experiments of a user
+default_cache_dir = os.path.join(os.path.expanduser('~/.exptools'), 'sound_cache')
+
+
+class SoundEngine(object):
+    """
+    SoundEngine plays mono int16 sounds at rate Hz on a single output stream.
+    Every play() call adds a voice; overlapping voices are summed and clipped.
+    For each voice the start latency, from the play() call to the time its first
+    sample reaches the output, is recorded. With output=False no stream is opened,
+    and buffers are mixed by calling mix() directly.
+    """
+    def __init__(self, clock, rate=44100, frames_per_buffer=256, latency_capacity=1024, output=True):
+        self.clock = clock
+        self.rate = rate
+        self._new_voices = deque()
+        self._voices = []
+        self.start_latencies = deque(maxlen=latency_capacity)
+        self.stream = None
+        if not output:
+            return
+
+        import pyaudio
+
+        self._pyaudio = pyaudio.PyAudio()
+        self._continue = pyaudio.paContinue
+        self.stream = self._pyaudio.open(format=pyaudio.paInt16,
+                                         channels=1,
+                                         rate=rate,
+                                         output=True,
+                                         frames_per_buffer=frames_per_buffer,
+                                         stream_callback=self._callback)
+        self.stream.start_stream()
+
+    def play(self, sound_array, start_time=None):
+        """
+        play sound_array (mono, int16) now, or at session clock time start_time.
+        This only queues the sound; deque appends are atomic, so no lock is needed with the callback.
+        """
+        self._new_voices.append((np.asarray(sound_array, dtype=np.int16).ravel(), start_time, self.clock.getTime()))
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        # session clock time at which the first sample of this buffer will be played
+        buffer_time = self.clock.getTime() + time_info['output_buffer_dac_time'] - time_info['current_time']
+        return (self.mix(frame_count, buffer_time).tobytes(), self._continue)
+
+    def mix(self, frame_count, buffer_time):
+        """the next frame_count int16 samples of all voices, of which the first is played at session clock time buffer_time"""
+        while self._new_voices:
+            data, start_time, play_time = self._new_voices.popleft()
+            if start_time is None:
+                delay = 0
+            else:
+                delay = max(0, int(round((start_time - buffer_time) * self.rate)))
+            # a voice is [data, position in data, samples to wait before starting, time of play()]
+            self._voices.append([data, 0, delay, play_time])
+
+        mix = np.zeros(frame_count, dtype=np.int32)
+        remaining = []
+        for voice in self._voices:
+            data, position, delay, play_time = voice
+            if delay >= frame_count:
+                voice[2] -= frame_count
+                remaining.append(voice)
+                continue
+            if position == 0:
+                self.start_latencies.append(buffer_time + delay / float(self.rate) - play_time)
+            chunk = data[position:position + frame_count - delay]
+            mix[delay:delay + chunk.shape[0]] += chunk
+            voice[1] = position + chunk.shape[0]
+            voice[2] = 0
+            if voice[1] < data.shape[0]:
+                remaining.append(voice)
+        self._voices = remaining
+
+        return np.clip(mix, -32768, 32767).astype(np.int16)
+
+    @property
+    def nr_playing(self):
+        return len(self._voices) + len(self._new_voices)
+
+    def output_latency(self):
+        """the output latency of the stream as reported by portaudio, in seconds"""
+        if self.stream is None:
+            return 0.0
+        return self.stream.get_output_latency()
+
+    def latency_summary(self):
+        latencies = np.array(self.start_latencies)
+        if latencies.shape[0] == 0:
+            return {'output_latency': self.output_latency()}
+        return {'output_latency': self.output_latency(),
+                'start_latency_mean': latencies.mean(),
+                'start_latency_max': latencies.max(),
+                'start_latency_sd': latencies.std()}
+
+    def close(self):
+        if self.stream is None:
+            return
+        self.stream.stop_stream()
+        self.stream.close()
+        self._pyaudio.terminate()
+
+
+def to_int16(data):
+    """convert wav data of any sample format to int16"""
+    if data.dtype == np.int16:
+        return data
+    if data.dtype == np.uint8:
+        return ((data.astype(np.int16) - 128) * 256).astype(np.int16)
+    if data.dtype == np.int32:
+        return (data >> 16).astype(np.int16)
+    # floating point wav data is in [-1, 1]
+    return np.round(np.clip(data, -1.0, 1.0) * 32767).astype(np.int16)
+
+
+def read_sound(file_name, rate=44100):
+    """read a wav file as a mono int16 array at rate Hz, averaging channels and resampling if needed"""
+    from scipy.io import wavfile
+
+    file_rate, data = wavfile.read(file_name)
+    data = to_int16(data)
+    if data.ndim == 2:
+        data = np.round(data.mean(axis=1)).astype(np.int16)
+    if file_rate != rate:
+        from scipy.signal import resample_poly
+        divisor = np.gcd(int(rate), int(file_rate))
+        data = resample_poly(data.astype(np.float64), int(rate) // divisor, int(file_rate) // divisor)
+        data = np.round(np.clip(data, -32768, 32767)).astype(np.int16)
+    return data
+
+
+def _file_hash(file_name):
+    sha1 = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _replace_file(file_name, write):
+    """
+    write file_name with write(f), into a temporary file first, so that an interrupted write never
+    leaves a broken file and concurrent writers never write into the same file
+    """
+    handle, temporary_file = tempfile.mkstemp(dir=os.path.dirname(file_name), suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            write(f)
+        os.replace(temporary_file, file_name)
+    except BaseException:
+        os.remove(temporary_file)
+        raise
+
+
+class SoundLibrary(object):
+    """
+    SoundLibrary loads all wav files in directory as mono int16 arrays at rate Hz, keyed by file name
+    without extension. Files are decoded in a thread pool, and the decoded arrays are cached in
+    cache_dir, by default default_cache_dir, under the hash of the file contents. A manifest of 
+    the file sizes and modification times in directory avoids re-hashing files that did not change.
+    """
+    def __init__(self, directory, rate=44100, cache_dir=None, max_workers=None):
+        self.directory = directory
+        self.rate = rate
+        if cache_dir is None:
+            cache_dir = default_cache_dir
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        # one manifest per sound directory, so that libraries that share the cache keep their own
+        directory_hash = hashlib.sha1(os.path.abspath(directory).encode('utf-8')).hexdigest()[:16]
+        self._manifest_file = os.path.join(self.cache_dir, 'manifest_%s.json' % directory_hash)
+
+    def file_names(self):
+        return sorted(os.path.join(self.directory, f) for f in os.listdir(self.directory) if f.lower().endswith('.wav'))
+
+    def _read_manifest(self):
+        try:
+            with open(self._manifest_file) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _load(self, file_name, manifest):
+        stat = os.stat(file_name)
+        entry = manifest.get(file_name)
+        if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+            content_hash = entry[2]
+        else:
+            content_hash = _file_hash(file_name)
+        cache_file = os.path.join(self.cache_dir, '%s_%d.npy' % (content_hash, self.rate))
+        if os.path.exists(cache_file):
+            data = np.load(cache_file, mmap_mode='r')
+        else:
+            data = read_sound(file_name, self.rate)
+            _replace_file(cache_file, lambda f: np.save(f, data))
+        return file_name, [stat.st_size, stat.st_mtime, content_hash], data
+
+    def load(self):
+        """load all sounds, returns a dict of sound name: int16 array"""
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        manifest = self._read_manifest()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(lambda file_name: self._load(file_name, manifest), self.file_names()))
+
+        sounds = {}
+        new_manifest = {}
+        for file_name, entry, data in results:
+            sounds[os.path.splitext(os.path.split(file_name)[-1])[0]] = data
+            new_manifest[file_name] = entry
+        if new_manifest != manifest:
+            _replace_file(self._manifest_file, lambda f: f.write(json.dumps(new_manifest).encode('utf-8')))
+        return sounds
+
+
+def test_sound_engine_mixing():
+    class Clock(object):
+        def getTime(self):
+            return 1.0
+
+    engine = SoundEngine(Clock(), rate=1000, output=False)
+    engine.play(np.full(150, 1000, dtype=np.int16))
+    # overlaps the first sound from its 50th sample on, at time 1.05
+    engine.play(np.full(100, 2000, dtype=np.int16), start_time=1.05)
+    # starts in the second buffer, and clips where it overlaps both
+    engine.play(np.full(30, 32000, dtype=np.int16), start_time=1.12)
+    assert(engine.nr_playing == 3)
+
+    first = engine.mix(100, 1.0)
+    assert((first[:50] == 1000).all() and (first[50:] == 3000).all())
+    assert(engine.nr_playing == 3)
+    second = engine.mix(100, 1.1)
+    assert((second[:20] == 3000).all() and (second[20:50] == 32767).all())
+    assert((second[50:] == 0).all() and engine.nr_playing == 0)
+    # play() was called at 1.0 for all sounds
+    assert(np.allclose(list(engine.start_latencies), [0.0, 0.05, 0.12]))
+    assert(np.isclose(engine.latency_summary()['start_latency_max'], 0.12))
+    engine.close()
+
+
+def test_sound_library():
+    import shutil
+    import tempfile
+    from scipy.io import wavfile
+
+    directory = tempfile.mkdtemp()
+    cache_dir = os.path.join(directory, 'cache')
+    try:
+        tone = np.round(10000 * np.sin(np.linspace(0, 200 * np.pi, 4410))).astype(np.int16)
+        wavfile.write(os.path.join(directory, 'tone.wav'), 44100, tone)
+        # decoded at the same time, to the same cache file
+        wavfile.write(os.path.join(directory, 'tone_copy.wav'), 44100, tone)
+        # stereo floating point at another rate is converted to mono int16 at 44100 Hz
+        wavfile.write(os.path.join(directory, 'noise.wav'), 22050, np.full((2205, 2), 0.5, dtype=np.float32))
+        with open(os.path.join(directory, 'notes.txt'), 'w') as f:
+            f.write('not a sound')
+
+        library = SoundLibrary(directory, cache_dir=cache_dir, max_workers=2)
+        assert([os.path.split(f)[-1] for f in library.file_names()] == ['noise.wav', 'tone.wav', 'tone_copy.wav'])
+        sounds = library.load()
+        assert(sorted(sounds) == ['noise', 'tone', 'tone_copy'] and (sounds['tone_copy'] == tone).all())
+        assert(sounds['noise'].dtype == np.int16 and sounds['noise'].shape[0] == 4410)
+        assert(abs(int(sounds['noise'][2000]) - 16384) < 100)
+        assert(len([f for f in os.listdir(cache_dir) if f.endswith('.npy')]) == 2 and len(os.listdir(cache_dir)) == 3)
+
+        # the next library memory-maps the cached arrays, and decodes files that changed
+        wavfile.write(os.path.join(directory, 'tone.wav'), 44100, tone[:100])
+        sounds = SoundLibrary(directory, cache_dir=cache_dir).load()
+        assert(isinstance(sounds['noise'], np.memmap) and (sounds['tone'] == tone[:100]).all())
+    finally:
+        shutil.rmtree(directory)
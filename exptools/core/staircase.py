@@ -192,3 +192,177 @@ class YesNoStaircase(object):
 				continue_after_this_trial = False
 		
 		return continue_after_this_trial
+
+
+class StaircaseBank(object):
+	"""
+	StaircaseBank runs many interleaved up-down staircases at once, e.g. one per condition.
+	The state of all tracks is kept in numpy arrays. A single answer updates one track with scalar 
+	operations (a few microseconds, several times a single staircase's answer). The vectorized update 
+	that simulate uses costs about 50 us per call however many tracks it updates, so it only beats 
+	separate staircases from about 100 tracks answered at once, e.g. thousands of simulated observers.
+	
+	nr_up is the number of consecutive correct answers after which a track gets more difficult
+	(1 for OneUpOneDown, 2 for TwoUpOneDown, 3 for ThreeUpOneDown behaviour); an incorrect answer
+	always makes it easier. As in the single staircases, a reversal is a change from correct to 
+	incorrect or back, and the stepsize is multiplied on every second reversal.
+	All parameters can be scalars or one value per track.
+	"""
+	def __init__(self, initial_values, initial_stepsizes, nr_up = 1, nr_reversals = 10, stepsize_multiplication_on_reversal = 0.75, max_nr_trials = 40, min_test_val = None, max_test_val = None, seed = None):
+		self.values = np.array(initial_values, dtype = np.float64, ndmin = 1)
+		nr_tracks = self.values.shape[0]
+		
+		self.stepsizes = np.ones(nr_tracks) * initial_stepsizes
+		self.nr_up = np.ones(nr_tracks, dtype = int) * nr_up
+		self.nr_reversals = nr_reversals
+		self.stepsize_multiplication_on_reversal = np.ones(nr_tracks) * stepsize_multiplication_on_reversal
+		self.max_nr_trials = np.ones(nr_tracks, dtype = int) * max_nr_trials
+		self.min_test_val = -np.inf if min_test_val is None else min_test_val
+		self.max_test_val = np.inf if max_test_val is None else max_test_val
+		
+		# set up filler variables
+		self.nr_trials = np.zeros(nr_tracks, dtype = int)
+		self.nr_correct = np.zeros(nr_tracks, dtype = int)
+		self.last_answers = np.full(nr_tracks, -1, dtype = np.int8)	# -1: no answer yet
+		self.present_nr_reversals = np.zeros(nr_tracks, dtype = int)
+		self.reversal_values = np.full((nr_tracks, nr_reversals), np.nan)
+		self.active = np.ones(nr_tracks, dtype = bool)
+		
+		self.rng = np.random.RandomState(seed)
+	
+	def __len__(self):
+		return self.values.shape[0]
+	
+	def next_track(self):
+		"""pick one of the tracks that have not finished yet at random, None if all have finished"""
+		active = np.flatnonzero(self.active)
+		if active.shape[0] == 0:
+			return None
+		return active[self.rng.randint(active.shape[0])]
+	
+	def get_intensity(self, track):
+		return self.values[track]
+	
+	def answer(self, track, correct):
+		"""register the answer on track, returns whether this track should continue"""
+		# the same update as _update, on python scalars; numpy calls on arrays of one track cost more than the update itself
+		track = int(track)
+		correct = bool(correct)
+		nr_trials = int(self.nr_trials[track]) + 1
+		self.nr_trials[track] = nr_trials
+		
+		stepsize = float(self.stepsizes[track])
+		value = float(self.values[track])
+		if correct:
+			nr_correct = int(self.nr_correct[track]) + 1
+			if nr_correct >= self.nr_up[track]:
+				value -= stepsize
+				nr_correct = 0
+			self.nr_correct[track] = nr_correct
+		else:
+			value += stepsize
+			self.nr_correct[track] = 0
+		value = min(max(value, self.min_test_val), self.max_test_val)
+		self.values[track] = value
+		
+		last_answer = self.last_answers[track]
+		self.last_answers[track] = correct
+		nr_reversals = int(self.present_nr_reversals[track])
+		if last_answer >= 0 and bool(last_answer) != correct:
+			if nr_reversals < self.nr_reversals:
+				self.reversal_values[track, nr_reversals] = value
+			nr_reversals += 1
+			self.present_nr_reversals[track] = nr_reversals
+			if nr_reversals % 2 == 0:
+				self.stepsizes[track] = stepsize * self.stepsize_multiplication_on_reversal[track]
+		
+		active = nr_reversals < self.nr_reversals and nr_trials < self.max_nr_trials[track]
+		self.active[track] = active
+		return active
+	
+	def _update(self, tracks, correct):
+		"""update tracks (an index array) with boolean array correct"""
+		self.nr_trials[tracks] += 1
+		
+		nr_correct = np.where(correct, self.nr_correct[tracks] + 1, 0)
+		harder = correct & (nr_correct >= self.nr_up[tracks])
+		nr_correct[harder] = 0
+		self.nr_correct[tracks] = nr_correct
+		
+		step = self.stepsizes[tracks] * np.where(harder, -1.0, np.where(correct, 0.0, 1.0))
+		self.values[tracks] = np.clip(self.values[tracks] + step, self.min_test_val, self.max_test_val)
+		
+		# we have a reversal when the answer differs from the previous answer on the track
+		reversal = (self.last_answers[tracks] >= 0) & (self.last_answers[tracks] != correct)
+		self.last_answers[tracks] = correct
+		reversed_tracks = tracks[reversal]
+		count = self.present_nr_reversals[reversed_tracks]
+		stored = count < self.nr_reversals
+		self.reversal_values[reversed_tracks[stored], count[stored]] = self.values[reversed_tracks[stored]]
+		count += 1
+		self.present_nr_reversals[reversed_tracks] = count
+		multiply = reversed_tracks[count % 2 == 0]
+		self.stepsizes[multiply] *= self.stepsize_multiplication_on_reversal[multiply]
+		
+		self.active[tracks] = (self.present_nr_reversals[tracks] < self.nr_reversals) & (self.nr_trials[tracks] < self.max_nr_trials[tracks])
+	
+	def thresholds(self, nr_discard = 2):
+		"""threshold estimate per track: the mean value at the reversals, without the first nr_discard"""
+		reversal_values = self.reversal_values[:, nr_discard:]
+		counts = np.isfinite(reversal_values).sum(axis = 1)
+		sums = np.where(np.isfinite(reversal_values), reversal_values, 0.0).sum(axis = 1)
+		return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+	
+	@classmethod
+	def simulate(cls, p_correct, nr_observers, initial_values, initial_stepsizes, seed = None, **kwargs):
+		"""
+		run the staircases for nr_observers simulated observers at once. p_correct(values, tracks) 
+		gives the probability of a correct answer at test values for the given track indices.
+		returns the bank of nr_observers * nr_tracks tracks, observer-major, until all tracks have finished.
+		"""
+		initial_values = np.array(initial_values, dtype = np.float64, ndmin = 1)
+		nr_tracks = initial_values.shape[0]
+		tile = lambda v: np.tile(np.ones(nr_tracks) * v, nr_observers)
+		for name in ['nr_up', 'stepsize_multiplication_on_reversal', 'max_nr_trials']:
+			if name in kwargs:
+				kwargs[name] = tile(kwargs[name])
+		bank = cls(tile(initial_values), tile(initial_stepsizes), seed = seed, **kwargs)
+		
+		track_conditions = np.tile(np.arange(nr_tracks), nr_observers)
+		while bank.active.any():
+			tracks = np.flatnonzero(bank.active)
+			correct = bank.rng.rand(tracks.shape[0]) < p_correct(bank.values[tracks], track_conditions[tracks])
+			bank._update(tracks, correct)
+		return bank
+
+
+def test_staircase_bank():
+	bank = StaircaseBank([1.0, 2.0], 0.1, nr_up = [1, 2], nr_reversals = 4, seed = 0)
+	assert(bank.answer(0, True))
+	assert(np.isclose(bank.get_intensity(0), 0.9))
+	bank.answer(1, True)
+	assert(np.isclose(bank.get_intensity(1), 2.0))
+	bank.answer(1, True)
+	assert(np.isclose(bank.get_intensity(1), 1.9))
+	bank.answer(0, False)
+	assert(bank.present_nr_reversals[0] == 1)
+	
+	# single answers and the vectorized update agree
+	rng = np.random.RandomState(1)
+	single = StaircaseBank([1.0, 2.0, 3.0], [0.1, 0.2, 0.3], nr_up = [1, 2, 3], nr_reversals = 6, min_test_val = 0.5, seed = 0)
+	vectorized = StaircaseBank([1.0, 2.0, 3.0], [0.1, 0.2, 0.3], nr_up = [1, 2, 3], nr_reversals = 6, min_test_val = 0.5, seed = 0)
+	for i in range(60):
+		track, correct = rng.randint(3), rng.rand() < 0.7
+		continues = single.answer(track, correct)
+		vectorized._update(np.array([track]), np.array([correct]))
+		assert(continues == vectorized.active[track])
+	for name in ['values', 'stepsizes', 'nr_trials', 'nr_correct', 'last_answers', 'present_nr_reversals', 'active']:
+		assert(np.allclose(getattr(single, name), getattr(vectorized, name)))
+	assert(np.allclose(single.reversal_values, vectorized.reversal_values, equal_nan = True))
+	
+	# a 2-up-1-down staircase converges on the 70.7% correct point
+	threshold = 0.5
+	p_correct = lambda values, tracks: 1.0 / (1.0 + np.exp(-(values - threshold) / 0.05))
+	bank = StaircaseBank.simulate(p_correct, 2000, [1.0], 0.1, nr_up = 2, nr_reversals = 20, max_nr_trials = 200, seed = 0)
+	estimate = np.nanmean(bank.thresholds(nr_discard = 4))
+	assert(abs(estimate - (threshold + 0.05 * np.log(0.707 / 0.293))) < 0.05)
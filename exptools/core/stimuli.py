@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+stimuli.py
+
+Cache for prebuilt stimuli. Trials that declare their stimuli through
+Trial.build_stimuli get them from the session's StimulusCache, keyed by the
+parameters that affect them, so that stimuli are built once, during the
+inter-trial interval or a preload phase, and not at the start of the timed part
+of the trial. Cached stimuli are shared: all trials with the same key get the
+same objects, so a trial that changes its stimuli (position, opacity, ...)
+changes them for the next trial with that key as well.
+
+The cache is bounded by a number of entries and by an estimate of the memory
+the stimuli take. Most of that memory is in textures on the GPU, which are
+estimated from their dimensions.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+
+def make_key(*parts):
+    """turn (nested) dicts, lists and arrays into a hashable key"""
+    key = []
+    for part in parts:
+        if isinstance(part, dict):
+            key.append(tuple(sorted((k, make_key(v)) for k, v in part.items())))
+        elif isinstance(part, (list, tuple)):
+            key.append(tuple(make_key(p) for p in part))
+        elif isinstance(part, np.ndarray):
+            key.append((part.shape, part.dtype.str, part.tobytes()))
+        elif isinstance(part, np.generic):
+            key.append(part.item())
+        else:
+            key.append(part)
+    if len(key) == 1:
+        return key[0]
+    return tuple(key)
+
+
+# bytes per texel of psychopy's float RGBA textures
+texel_size = 16
+
+
+def texture_size(stimulus):
+    """
+    estimate of the GPU memory of a psychopy stimulus' texture, from its dimensions: the 
+    pixel size of a loaded image, or the resolution of a grating or mask texture.
+    """
+    size = 0
+    image_size = getattr(stimulus, '_origSize', None)
+    if image_size is not None:
+        size += int(np.prod(image_size)) * texel_size
+    tex_resolution = getattr(stimulus, 'texRes', None)
+    if image_size is None and tex_resolution is not None:
+        size += int(tex_resolution) ** 2 * texel_size
+    if getattr(stimulus, 'mask', None) is not None and tex_resolution is not None:
+        size += int(tex_resolution) ** 2 * texel_size
+    return size
+
+
+def estimate_size(stimuli, _seen=None):
+    """
+    rough estimate of the memory used by stimuli in bytes: the size of all numpy arrays
+    in (lists, tuples or dicts of) stimuli and their attributes, the estimated size of
+    their textures, plus 1 kB per object.
+    """
+    if _seen is None:
+        _seen = set()
+    if id(stimuli) in _seen:
+        return 0
+    _seen.add(id(stimuli))
+
+    if isinstance(stimuli, np.ndarray):
+        return stimuli.nbytes
+    if isinstance(stimuli, dict):
+        return sum(estimate_size(s, _seen) for s in stimuli.values())
+    if isinstance(stimuli, (list, tuple)):
+        return sum(estimate_size(s, _seen) for s in stimuli)
+    size = 1024 + texture_size(stimuli)
+    for value in getattr(stimuli, '__dict__', {}).values():
+        if isinstance(value, np.ndarray):
+            size += value.nbytes
+    return size
+
+
+class StimulusCache(object):
+    """
+    StimulusCache is a least-recently-used cache of stimuli, bounded by memory_budget bytes
+    and, if given, by max_entries entries. Sizes are estimated with estimate_size unless they
+    are passed explicitly to put.
+    """
+    def __init__(self, memory_budget=256 * 1024 ** 2, max_entries=None):
+        self.memory_budget = memory_budget
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key][0]
+        self.misses += 1
+        return default
+
+    def put(self, key, stimuli, size=None):
+        if size is None:
+            size = estimate_size(stimuli)
+        if key in self._entries:
+            self.memory -= self._entries.pop(key)[1]
+        self._entries[key] = (stimuli, size)
+        self.memory += size
+        self._evict()
+
+    def get_or_create(self, key, factory):
+        """return the stimuli for key, building them with factory() if they are not cached"""
+        stimuli = self.get(key)
+        if stimuli is None:
+            stimuli = factory()
+            if stimuli is not None:
+                self.put(key, stimuli)
+        return stimuli
+
+    def _evict(self):
+        # the most recently added entry is kept, even if it alone exceeds the budget
+        while len(self._entries) > 1 and (self.memory > self.memory_budget or 
+                                          (self.max_entries is not None and len(self._entries) > self.max_entries)):
+            self.memory -= self._entries.popitem(last=False)[1][1]
+
+    def clear(self):
+        self._entries.clear()
+        self.memory = 0
+
+
+def test_stimulus_cache():
+    cache = StimulusCache(memory_budget=2500)
+    built = []
+    def factory(name):
+        def build():
+            built.append(name)
+            return {'texture': np.zeros(1000, dtype=np.uint8)}
+        return build
+
+    for name in ['a', 'b', 'a', 'c', 'a', 'b']:
+        cache.get_or_create(make_key({'name': name}), factory(name))
+    # a stays cached as the most recently used entry, b is evicted when c comes in
+    assert(built == ['a', 'b', 'c', 'b'])
+    assert(cache.memory <= 2500)
+
+    # textures count by their dimensions, and the number of entries can be bounded
+    class Grating(object):
+        texRes = 128
+        mask = 'gauss'
+    assert(estimate_size(Grating()) == 1024 + 2 * 128 ** 2 * texel_size)
+    cache = StimulusCache(max_entries=2)
+    for name in ['a', 'b', 'c']:
+        cache.put(name, Grating())
+    assert(len(cache) == 2 and 'a' not in cache)
+
+    # trials that differ only in parameters their stimuli do not depend on share them
+    from .trial import Trial
+
+    class OrientationTrial(Trial):
+        stimulus_parameters = ['orientation']
+    keys = [OrientationTrial(parameters={'orientation': 45, 'correct_answer': answer}, screen=object()).stimulus_key()
+            for answer in [0, 1]]
+    assert(keys[0] == keys[1])
+    assert(Trial(parameters={'a': 1}, screen=object()).stimulus_key() != Trial(parameters={'a': 2}, screen=object()).stimulus_key())
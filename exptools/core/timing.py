@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+timing.py
+
+Low-overhead per-frame timing of the trial loop. Every frame stores four clock
+readings in preallocated NumPy arrays; all statistics are computed at the end of
+a trial, outside the frame loop.
+"""
+
+import numpy as np
+
+
+class FrameTimer(object):
+    """
+    FrameTimer records, for every frame of Trial.run, the duration of the check_phase_time,
+    draw and event steps and the time at which draw (which ends with the screen flip) returned.
+    Frames whose flip interval exceeds drop_threshold refresh intervals are counted as dropped.
+    """
+    def __init__(self, refresh_rate=60.0, capacity=2048, drop_threshold=1.5):
+        self.refresh_rate = float(refresh_rate)
+        self.frame_interval = 1.0 / self.refresh_rate
+        self.drop_threshold = drop_threshold
+
+        self.capacity = int(capacity)
+        self._times = np.zeros((self.capacity, 4), dtype=np.float64)
+        self.n = 0
+
+        # flip intervals of the whole session, for the session summary
+        self._session_intervals = np.zeros(self.capacity, dtype=np.float32)
+        self._nr_session_intervals = 0
+
+        self.trial_summaries = []
+
+    def start_trial(self):
+        self.n = 0
+
+    def record(self, start_time, phase_checked_time, drawn_time, event_time):
+        """store the clock readings of a single frame"""
+        if self.n == self.capacity:
+            self.capacity *= 2
+            times = np.zeros((self.capacity, 4), dtype=np.float64)
+            times[:self.n] = self._times[:self.n]
+            self._times = times
+        t = self._times[self.n]
+        t[0] = start_time
+        t[1] = phase_checked_time
+        t[2] = drawn_time
+        t[3] = event_time
+        self.n += 1
+
+    def flip_times(self):
+        return self._times[:self.n, 2]
+
+    def flip_intervals(self):
+        return np.diff(self.flip_times())
+
+    def deviations(self):
+        """deviation of each flip interval from the expected refresh interval"""
+        return self.flip_intervals() - self.frame_interval
+
+    def dropped(self):
+        """boolean array flagging the flip intervals in which at least one frame was dropped"""
+        return self.flip_intervals() > self.drop_threshold * self.frame_interval
+
+    def _summarize(self, intervals):
+        summary = {'nr_frames': intervals.shape[0] + 1,
+                   'nr_dropped': int((intervals > self.drop_threshold * self.frame_interval).sum())}
+        if intervals.shape[0] > 0:
+            p = np.percentile(intervals, [50, 95, 99])
+            summary.update({'interval_mean': intervals.mean(),
+                            'interval_p50': p[0],
+                            'interval_p95': p[1],
+                            'interval_p99': p[2],
+                            'interval_max': intervals.max(),
+                            'max_deviation': np.abs(intervals - self.frame_interval).max()})
+        return summary
+
+    def end_trial(self, trial_id=None):
+        """summarize the frames of the current trial and add its intervals to the session record"""
+        intervals = self.flip_intervals()
+        summary = {'trial': trial_id}
+        summary.update(self._summarize(intervals))
+        if self.n > 0:
+            times = self._times[:self.n]
+            for i, step in enumerate(['phase_check', 'draw', 'event']):
+                durations = times[:, i + 1] - times[:, i]
+                summary[step + '_mean'] = durations.mean()
+                summary[step + '_max'] = durations.max()
+        self.trial_summaries.append(summary)
+
+        needed = self._nr_session_intervals + intervals.shape[0]
+        if needed > self._session_intervals.shape[0]:
+            session_intervals = np.zeros(max(needed, 2 * self._session_intervals.shape[0]), dtype=np.float32)
+            session_intervals[:self._nr_session_intervals] = self._session_intervals[:self._nr_session_intervals]
+            self._session_intervals = session_intervals
+        self._session_intervals[self._nr_session_intervals:needed] = intervals
+        self._nr_session_intervals = needed
+        return summary
+
+    def session_summary(self):
+        summary = {'trial': 'session'}
+        summary.update(self._summarize(self._session_intervals[:self._nr_session_intervals].astype(np.float64)))
+        summary['nr_frames'] = self._nr_session_intervals + len(self.trial_summaries)
+        return summary
+
+    def write(self, output_file):
+        """write the per-trial summaries and a session summary row to output_file + '_frametiming.tsv'"""
+        import pandas as pd
+
+        opd = pd.DataFrame.from_records(self.trial_summaries + [self.session_summary()])
+        opd.to_csv(path_or_buf=output_file + '_frametiming.tsv', sep='\t', encoding='utf-8')
+
+
+def test_frame_timer():
+    timer = FrameTimer(refresh_rate=100.0, capacity=2)
+    timer.start_trial()
+    for flip in [0.01, 0.02, 0.03, 0.06, 0.07]:
+        timer.record(flip - 0.008, flip - 0.007, flip, flip + 0.0005)
+    summary = timer.end_trial(1)
+    assert(summary['nr_frames'] == 5)
+    assert(summary['nr_dropped'] == 1)
+    assert(timer.session_summary()['nr_dropped'] == 1)
@@ -1,10 +1,38 @@
+import warnings
+
 import numpy as np
-from .session import MRISession
-from psychopy import logging, event
-import time as time_module 
+from .events import TRIAL_START, PHASE_START, KEY, TRIAL_STOP, MESSAGE, render_events
+from .stimuli import make_key
+
+
+class TrialEvents(list):
+    """
+    the events of a trial in the legacy string format. Strings that are appended to it, as 
+    subclasses did with the events list of old, are logged as message events in the session's 
+    event log, in order with the trial's own events, and written to the output with them.
+    """
+    def __init__(self, trial, events=()):
+        super(TrialEvents, self).__init__(events)
+        self.trial = trial
+
+    def append(self, event):
+        self.trial.log_message(event)
+        super(TrialEvents, self).append(event)
+
+    def extend(self, events):
+        for event in events:
+            self.append(event)
+
+    def __iadd__(self, events):
+        self.extend(events)
+        return self
+
 
 class Trial(object):
-    def __init__(self, parameters = {}, phase_durations = [], session = None, screen = None, tracker = None):
+    # names of the parameters that stimulus_key keys cached stimuli on, None for all parameters
+    stimulus_parameters = None
+
+    def __init__(self, parameters = {}, phase_durations = [], session = None, screen = None, tracker = None, phase_times = None):
 
         self.parameters = parameters.copy()
         self.phase_durations = phase_durations
@@ -17,27 +45,130 @@ class Trial(object):
         else:
             self.screen = screen
 
-        self.events = []
         self.phase = 0
-        self.phase_times = np.cumsum(np.array(self.phase_durations))
+        if phase_times is None:
+            self.phase_times = np.cumsum(np.array(self.phase_durations))
+        else:
+            # precomputed, e.g. by a TrialSchedule; copied because check_phase_time overwrites it
+            self.phase_times = np.array(phase_times, dtype=np.float64)
         self.stopped = False
+        self.prepared = False
+        # planned session clock time of the start of the trial, used by absolute phase timing
+        self.onset = None
+        # time of the key press being handled by key_event
+        self.key_time = None
+        # events logged with log_message before the trial started
+        self._pending_messages = []
+
+    @classmethod
+    def from_schedule(cls, schedule, index, **kwargs):
+        """create the trial at index of a TrialSchedule, other arguments are passed to the constructor"""
+        view = schedule[index]
+        return cls(parameters=view.parameters, 
+                   phase_durations=view.phase_durations, 
+                   phase_times=view.phase_onsets, 
+                   **kwargs)
+
+    @property
+    def events(self):
+        """events of this trial, rendered in the legacy string format; strings appended to it are logged"""
+        if hasattr(self, 'event_rows'):
+            return TrialEvents(self, render_events(self.event_rows))
+        if not hasattr(self, 'event_start'):
+            return TrialEvents(self, self._pending_messages)
+        return TrialEvents(self, self.session.event_log.render(self.event_start))
+
+    @events.setter
+    def events(self, events):
+        # the events already logged cannot be replaced, new ones are logged
+        for event in events:
+            self.log_message(event)
+
+    def log_message(self, message):
+        """log message, a string, as an event of this trial. Messages logged before the trial runs are kept until it does."""
+        if hasattr(self, 'event_rows'):
+            raise RuntimeError('trial %s has stopped and has been written, events can no longer be added' % self.ID)
+        if not hasattr(self, 'event_start'):
+            self._pending_messages.append(message)
+            return
+        self.session.event_log.append(self.ID, self.phase, MESSAGE, self.session.clock.getTime(), key=str(message))
 
     def create_stimuli(self):
         pass
 
+    def stimulus_key(self):
+        """
+        key under which this trial's stimuli are cached, trials with equal keys share their stimuli.
+        The key holds the parameters named in stimulus_parameters, or all parameters if it is None;
+        subclasses should name only the parameters their stimuli depend on, so that trials that 
+        differ in other parameters share them.
+        """
+        if self.stimulus_parameters is None:
+            return make_key(type(self).__name__, self.parameters)
+        return make_key(type(self).__name__, [self.parameters.get(name) for name in self.stimulus_parameters])
+
+    def build_stimuli(self):
+        """
+        subclasses can override build_stimuli to return their stimuli instead of creating 
+        them in create_stimuli. They are cached by the session under stimulus_key and 
+        set as self.stimuli by prepare. Cached stimuli are shared with all trials with 
+        the same key, so set everything that changes per trial in create_stimuli or draw.
+        """
+        return None
+
+    def prepare(self):
+        """get this trial's stimuli from the session's stimulus cache, building them if needed.
+        call this during the inter-trial interval, otherwise it happens at the start of run."""
+        stimuli = self.session.stimulus_cache.get_or_create(self.stimulus_key(), self.build_stimuli)
+        if stimuli is not None:
+            self.stimuli = stimuli
+        self.prepared = True
+
     def run(self):
+        if not self.prepared:
+            self.prepare()
         self.start_time = self.session.clock.getTime()
         if self.tracker:
-            self.tracker.log('trial ' + str(self.ID) + ' started at ' + str(self.start_time) )
-            self.tracker.send_command('record_status_message "Trial ' + str(self.ID) + '"')
-        self.events.append('trial ' + str(self.ID) + ' started at ' + str(self.start_time))
+            self.tracker_log('trial %s started at %s', self.ID, self.start_time)
+            self.session.dispatcher.put(self.tracker.send_command, 'record_status_message "Trial %s"', self.ID)
+        self.event_start = len(self.session.event_log)
+        self.session.event_log.append(self.ID, self.phase, TRIAL_START, self.start_time)
+        for message in self._pending_messages:
+            self.log_message(message)
+        self._pending_messages = []
+        if self.session.bids_events is not None:
+            self.session.bids_events.phase_started(self.ID, self.phase, self.start_time, self.bids_trial_type())
+
+        scheduler = self.session.phase_scheduler
+        if scheduler is not None:
+            # plan this trial's phases on the session timeline
+            self.planned_onsets = scheduler.start_trial(self.phase_durations, onset=self.onset, start_time=self.start_time)
+            scheduler.phase_started(self.ID, self.phase, self.planned_onsets[0])
 
         self.create_stimuli()
 
-        while not self.stopped:
-            self.check_phase_time()
-            self.draw()
-            self.event()
+        frame_timer = self.session.frame_timer
+        if frame_timer is None:
+            while not self.stopped:
+                self.check_phase_time()
+                self.draw()
+                if scheduler is not None:
+                    scheduler.flip(self.session.clock.getTime())
+                self.event()
+        else:
+            clock = self.session.clock
+            frame_timer.start_trial()
+            while not self.stopped:
+                frame_start = clock.getTime()
+                self.check_phase_time()
+                phase_checked = clock.getTime()
+                self.draw()
+                drawn = clock.getTime()
+                if scheduler is not None:
+                    scheduler.flip(drawn)
+                self.event()
+                frame_timer.record(frame_start, phase_checked, drawn, clock.getTime())
+            frame_timer.end_trial(self.ID)
 
         self.stop()
 
@@ -46,19 +177,36 @@ class Trial(object):
         self.stop_time = self.session.clock.getTime()
         self.stopped = True
         if self.tracker:
-            # pipe parameters to the eyelink data file in a for loop so as to limit the risk of flooding the buffer
+            # pipe parameters to the eyelink data file one by one, the dispatcher 
+            # rate-limits them so as to limit the risk of flooding the buffer
             for k in self.parameters.keys():
-                self.tracker.log('trial ' + str(self.ID) + ' parameter\t' + k + ' : ' + str(self.parameters[k]) )
-                time_module.sleep(0.0001)
-            self.tracker.log('trial ' + str(self.ID) + ' stopped at ' + str(self.stop_time) )
-        self.session.outputDict['eventArray'].append(self.events)
-        self.session.outputDict['parameterArray'].append(self.parameters)
+                self.tracker_log('trial %s parameter\t%s : %s', self.ID, k, self.parameters[k])
+            self.tracker_log('trial %s stopped at %s', self.ID, self.stop_time)
+        self.session.event_log.append(self.ID, self.phase, TRIAL_STOP, self.stop_time)
+        if self.session.bids_events is not None:
+            self.session.bids_events.trial_stopped(self.stop_time)
+        self.event_rows = self.session.event_log.rows(self.event_start)
+        # stream this trial to the session output file
+        self.session.write_trial(self)
 
-    def key_event(self, key):
+    def key_event(self, key, key_time=None):
+        """handle key, pressed at key_time; by default the time at which event() received it"""
+        if key_time is None:
+            key_time = self.key_time if self.key_time is not None else self.session.clock.getTime()
         if self.tracker:
-            self.tracker.log('trial ' + str(self.ID) + ' event ' + str(key) + ' at ' + str(self.session.clock.getTime()) )
-        self.events.append('trial ' + str(self.ID) + ' event ' + str(key) + ' at ' + str(self.session.clock.getTime()))
+            self.tracker_log('trial %s event %s at %s', self.ID, key, key_time)
+        self.session.event_log.append(self.ID, self.phase, KEY, key_time, key=key)
+        if self.session.bids_events is not None:
+            self.session.bids_events.response(self.ID, self.phase, key, key_time)
+
+
+    def bids_trial_type(self):
+        """trial_type of the present phase in the BIDS events file, subclasses can name their phases"""
+        return 'phase_%d' % self.phase
 
+    def tracker_log(self, message, *args):
+        """send message % args to the tracker through the session's message dispatcher"""
+        self.session.dispatcher.put(self.tracker.log, message, *args, stamp_offset=True)
 
     def feedback(self, answer, setting):
         """feedback give the subject feedback on performance"""
@@ -75,22 +223,30 @@ class Trial(object):
     def phase_forward(self):
         """go one phase forward"""
         self.phase += 1
-        phase_time = str(self.session.clock.getTime())
-        self.events.append('trial ' + str(self.ID) + ' phase ' + str(self.phase) + ' started at ' + phase_time)
+        phase_time = self.session.clock.getTime()
+        self.session.event_log.append(self.ID, self.phase, PHASE_START, phase_time)
+        if self.session.bids_events is not None:
+            self.session.bids_events.phase_started(self.ID, self.phase, phase_time, self.bids_trial_type())
         if self.tracker:
-            self.tracker.log('trial ' + str(self.ID) + ' phase ' + str(self.phase) + ' started at ' + phase_time )
-            time_module.sleep(0.00001)
+            self.tracker_log('trial %s phase %s started at %s', self.ID, self.phase, phase_time)
 
     def event(self):
-        for ev in event.getKeys():
-            self.key_event(ev)
+        for key, key_time in self.session.get_keys():
+            # subclasses override key_event(key), so the time of the press is passed on the trial
+            self.key_time = key_time
+            self.key_event(key)
+        self.key_time = None
 
     def check_phase_time(self):
         """
         check_phase_time checks the phase time of the present phase
         and implements alarms based on time. The transgression of an alarm time
         prompts the trial to either phase forward or stop, depending on the present phase.
+        With a session phase scheduler, phases end at their planned onsets on the session timeline instead.
         """
+        if self.session.phase_scheduler is not None:
+            self.check_phase_time_absolute()
+            return
         # object variable to record all trial phase times in past and present
         self.phase_times[self.phase] = self.session.clock.getTime()
         # the first phase has no previous phase
@@ -111,19 +267,50 @@ class Trial(object):
                 # the phase duration is below 0, this function calls itself when phasing forward.
                 self.check_phase_time()
 
+
+    def check_phase_time_absolute(self):
+        """
+        check_phase_time for absolute timing: the next phase starts on the frame whose flip 
+        is closest to its planned onset, so timing errors do not accumulate over phases and trials.
+        """
+        scheduler = self.session.phase_scheduler
+        now = self.session.clock.getTime()
+        self.phase_times[self.phase] = now
+        self.this_phase_time = now - self.planned_onsets[self.phase]
+        if scheduler.due(self.planned_onsets[self.phase + 1], now):
+            # last trial stops, others phase forward
+            if self.phase == (len(self.phase_durations) - 1):
+                self.stopped = True
+            else:
+                self.phase_forward()
+                scheduler.phase_started(self.ID, self.phase, self.planned_onsets[self.phase])
+                self.check_phase_time_absolute()
+
             
 class MRITrial(Trial):
 
 
     def __init__(self, *args, **kwargs):
+        # onset in TR-time (scanner volumes since the first trigger, e.g. 10.5), 
+        # converted to clock time with the session's fitted trigger timeline when the trial runs
+        self.tr_onset = kwargs.pop('tr_onset', None)
+        # whether the trigger that key_event handles was simulated, as key_time is the time of the key
+        self.simulated_trigger = False
         super(MRITrial, self).__init__(*args, **kwargs)
     
     def draw(self):
         super(MRITrial, self).draw()
 
+    def run(self):
+        if self.tr_onset is not None:
+            if self.session.phase_scheduler is None:
+                warnings.warn('tr_onset is only used with phase_timing=\'absolute\', trial %s starts when the previous trial ends' % self.ID)
+            self.onset = self.session.tr_time_to_clock(self.tr_onset)
+        super(MRITrial, self).run()
+
     def key_event(self, key):
         if key == self.session.mri_trigger_key:
-            self.session.mri_trigger()
+            self.session.mri_trigger(simulated=self.simulated_trigger, time=self.key_time)
 
         super(MRITrial, self).key_event(key)
 
@@ -131,7 +318,11 @@ class MRITrial(Trial):
         if self.session.simulate_mri_trigger:
             current_time = self.session.clock.getTime()
             if current_time - self.session.target_trigger_time > 0:
-                self.key_event(key=self.session.mri_trigger_key)
-                logging.critical('Simulated trigger at %s' % current_time)
+                self.simulated_trigger = True
+                try:
+                    self.key_event(self.session.mri_trigger_key)
+                finally:
+                    self.simulated_trigger = False
+                self.session.logging.critical('Simulated trigger at %s' % current_time)
 
         super(MRITrial, self).event()
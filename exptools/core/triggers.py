@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+triggers.py
+
+The MRI trigger timeline. Every trigger, real or simulated, is stored with its
+clock time and the scanner volume it belongs to. The effective TR and the time
+of the first volume are fitted robustly (Theil-Sen) to the recent triggers, so
+that predictions of upcoming triggers follow the scanner rather than the nominal
+TR, and so that missed and double triggers can be recognized.
+"""
+
+import numpy as np
+
+# trigger status codes
+TRIGGER_OK = 0
+TRIGGER_DOUBLE = 1
+TRIGGER_AFTER_MISSED = 2
+
+status_names = {TRIGGER_OK: 'ok', TRIGGER_DOUBLE: 'double', TRIGGER_AFTER_MISSED: 'after_missed'}
+
+
+def theil_sen(x, y):
+    """robust line fit: the median of all pairwise slopes, and the median intercept for that slope"""
+    i, j = np.triu_indices(x.shape[0], 1)
+    dx = x[j] - x[i]
+    valid = dx != 0
+    slope = np.median((y[j] - y[i])[valid] / dx[valid])
+    return slope, np.median(y - slope * x)
+
+
+class TriggerTimeline(object):
+    """
+    TriggerTimeline collects triggers of a scanner with nominal repetition time tr.
+    A trigger that follows the previous one within double_fraction TR is a double trigger,
+    and is not counted as a volume; an interval of n TRs (rounded) means n - 1 triggers were missed.
+    The fit uses the last fit_window real triggers, or simulated triggers if there are no real ones.
+    """
+    def __init__(self, tr, capacity=1024, double_fraction=0.5, fit_window=64):
+        self.tr = float(tr)
+        self.double_fraction = double_fraction
+        self.fit_window = fit_window
+
+        self.capacity = int(capacity)
+        self.times = np.zeros(self.capacity, dtype=np.float64)
+        self.volumes = np.zeros(self.capacity, dtype=np.int64)
+        self.simulated = np.zeros(self.capacity, dtype=bool)
+        self.status = np.zeros(self.capacity, dtype=np.int8)
+        self.n = 0
+
+        self.nr_missed = 0
+        self.nr_double = 0
+        self.effective_tr = self.tr
+        self.offset = None
+
+    def _grow(self):
+        self.capacity *= 2
+        for name in ['times', 'volumes', 'simulated', 'status']:
+            array = getattr(self, name)
+            grown = np.zeros(self.capacity, dtype=array.dtype)
+            grown[:self.n] = array[:self.n]
+            setattr(self, name, grown)
+
+    @property
+    def last_volume(self):
+        """the volume of the last trigger, -1 before the first"""
+        if self.n == 0:
+            return -1
+        return self.volumes[self.n - 1]
+
+    def add(self, time, simulated=False):
+        """register a trigger at clock time time, returns its status code"""
+        if self.n == self.capacity:
+            self._grow()
+
+        status = TRIGGER_OK
+        if self.n == 0:
+            volume = 0
+        else:
+            interval = time - self.times[self.n - 1]
+            if interval < self.double_fraction * self.effective_tr:
+                status = TRIGGER_DOUBLE
+                volume = self.last_volume
+                self.nr_double += 1
+            else:
+                nr_volumes = max(int(round(interval / self.effective_tr)), 1)
+                if nr_volumes > 1:
+                    status = TRIGGER_AFTER_MISSED
+                    self.nr_missed += nr_volumes - 1
+                volume = self.last_volume + nr_volumes
+
+        self.times[self.n] = time
+        self.volumes[self.n] = volume
+        self.simulated[self.n] = simulated
+        self.status[self.n] = status
+        self.n += 1
+        if status != TRIGGER_DOUBLE:
+            self.fit()
+        return status
+
+    def _fit_selection(self):
+        counted = self.status[:self.n] != TRIGGER_DOUBLE
+        real = counted & ~self.simulated[:self.n]
+        if real.any():
+            counted = real
+        return np.flatnonzero(counted)[-self.fit_window:]
+
+    def fit(self):
+        """refit the effective TR and the time of volume 0"""
+        selection = self._fit_selection()
+        volumes = self.volumes[selection].astype(np.float64)
+        times = self.times[selection]
+        if selection.shape[0] < 2:
+            self.effective_tr = self.tr
+            self.offset = times[0] - self.tr * volumes[0]
+        else:
+            self.effective_tr, self.offset = theil_sen(volumes, times)
+        return self.effective_tr, self.offset
+
+    def predict(self, volume):
+        """predicted clock time of the trigger of volume"""
+        return self.offset + self.effective_tr * volume
+
+    def next_trigger_time(self, time):
+        """predicted clock time of the first trigger after time"""
+        return self.predict(np.floor(self.tr_time(time)) + 1)
+
+    def tr_time(self, time):
+        """clock time time in TR-time: the number of (effective) TRs since volume 0"""
+        return (time - self.offset) / self.effective_tr
+
+    def clock_time(self, tr_time):
+        """the clock time of a moment in TR-time, e.g. 10.5 for halfway volumes 10 and 11"""
+        return self.offset + self.effective_tr * tr_time
+
+    def residuals(self):
+        """deviations of all triggers from the fitted timeline (the trigger jitter)"""
+        return self.times[:self.n] - self.predict(self.volumes[:self.n])
+
+    def summary(self):
+        residuals = self.residuals()[self.status[:self.n] != TRIGGER_DOUBLE]
+        return {'nr_triggers': self.n,
+                'nr_missed': self.nr_missed,
+                'nr_double': self.nr_double,
+                'nominal_tr': self.tr,
+                'effective_tr': self.effective_tr,
+                'jitter_sd': residuals.std() if residuals.shape[0] > 0 else np.nan}
+
+    def to_dataframe(self):
+        import pandas as pd
+
+        return pd.DataFrame({'volume': self.volumes[:self.n],
+                             'time': self.times[:self.n],
+                             'simulated': self.simulated[:self.n],
+                             'status': [status_names[s] for s in self.status[:self.n]],
+                             'predicted_time': self.predict(self.volumes[:self.n]),
+                             'residual': self.residuals()},
+                            columns=['volume', 'time', 'simulated', 'status', 'predicted_time', 'residual'])
+
+    def write(self, output_file):
+        self.to_dataframe().to_csv(path_or_buf=output_file + '_triggers.tsv', sep='\t', encoding='utf-8')
+
+
+def test_trigger_timeline():
+    rng = np.random.RandomState(0)
+    # a scanner whose TR is slightly longer than nominal, with jittered triggers
+    true_times = 3.0 + 2.001 * np.arange(50) + rng.normal(0, 0.002, 50)
+    timeline = TriggerTimeline(tr=2.0)
+    for volume, time in enumerate(true_times):
+        if volume == 20:
+            continue
+        timeline.add(time)
+        if volume == 30:
+            assert(timeline.add(time + 0.01) == TRIGGER_DOUBLE)
+    assert(timeline.nr_missed == 1 and timeline.nr_double == 1)
+    assert(timeline.last_volume == 49)
+    assert(abs(timeline.effective_tr - 2.001) < 0.001)
+    assert(abs(timeline.predict(60) - (3.0 + 2.001 * 60)) < 0.01)
+    assert(np.isclose(timeline.clock_time(timeline.tr_time(50.0)), 50.0))
@@ -5,59 +5,204 @@
 Created on 16 Aug 2017
 Based on Nipype Configuration file
 logging options : INFO, DEBUG
-@author: Gilles de Hollander '''
+@author: Gilles de Hollander
+
+Settings are read from, in increasing order of precedence:
+the default_config.cfg in the package, the user file ~/.exptools/exptools.cfg,
+exp_config.cfg in the current directory, environment variables named
+EXPTOOLS_<SECTION>_<OPTION> and keyword arguments. All values are parsed and
+checked against the schema once; lookups are attribute accesses,
+e.g. config.screen.size, that return the types of the schema, with lists as
+tuples. config.get(section, option) returns values as it always did: lists
+as lists, and numbers and options that are not in the schema as floats. '''
 
 import configparser
 import os
-import exptools 
 import json
 
 
-list_vars = [('screen', 'physical_screen_size'),
-             ('screen', 'gamma_scale'),
-             ('screen', 'background_color'),
-             ('screen', 'size'),
-             ('screen', 'max_lums')]
-
-boolean_vars = [('screen', 'wait_blanking'),
-                ('screen', 'full_screen'),
-                ('screen', 'mouse_visible')]
+default_file = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'default_config.cfg')
+user_file = os.path.join(os.path.expanduser('~/.exptools'), 'exptools.cfg')
+exp_config_name = 'exp_config.cfg'
+environment_prefix = 'EXPTOOLS_'
+
+# the type of every known option, options that are not in the schema are parsed as json, or kept as strings
+schema = {'screen': {'physical_screen_size': list,
+                     'gamma_scale': list,
+                     'physical_screen_distance': float,
+                     'screen_nr': int,
+                     'background_color': list,
+                     'size': list,
+                     'max_lums': list,
+                     'wait_blanking': bool,
+                     'full_screen': bool,
+                     'mouse_visible': bool},
+          'mri': {'mri_trigger_key': str},
+          'eyetracker': {'n_calib_points': int,
+                         'sample_rate': int,
+                         'calib_size': float,
+                         'x_offset': float}}
+
+_booleans = {'1': True, 'yes': True, 'true': True, 'on': True,
+             '0': False, 'no': False, 'false': False, 'off': False}
+
+
+def parse_value(section, option, value):
+    """convert value (a string from a config file or the environment, or a python value) to the type in schema"""
+    value_type = schema.get(section, {}).get(option)
+    if not isinstance(value, str):
+        if value_type is list:
+            return tuple(value)
+        if value_type in (float, int) and not isinstance(value, bool):
+            return value_type(value)
+        if value_type is None or isinstance(value, value_type):
+            return tuple(value) if isinstance(value, list) else value
+        raise ValueError('[%s] %s should be of type %s, not %r' % (section, option, value_type.__name__, value))
+
+    value = value.strip()
+    if value_type is str:
+        return value
+    if value_type is bool:
+        if value.lower() not in _booleans:
+            raise ValueError('[%s] %s should be a boolean, not %r' % (section, option, value))
+        return _booleans[value.lower()]
+    if value_type is list:
+        try:
+            parsed = json.loads(value)
+        except ValueError:
+            parsed = None
+        if not isinstance(parsed, list):
+            raise ValueError('[%s] %s should be a list, not %r' % (section, option, value))
+        return tuple(parsed)
+    if value_type in (float, int):
+        try:
+            return value_type(float(value)) if value_type is int else float(value)
+        except ValueError:
+            raise ValueError('[%s] %s should be a number, not %r' % (section, option, value))
+    try:
+        parsed = json.loads(value)
+    except ValueError:
+        return value
+    return tuple(parsed) if isinstance(parsed, list) else parsed
+
+
+class ConfigSection(object):
+    """the parsed, read-only options of one config section, as attributes"""
+    def __init__(self, name, values):
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_values', dict(values))
+        self.__dict__.update(values)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('config section %s is read-only, use ExpToolsConfig.set' % self._name)
+
+    def __contains__(self, option):
+        return option in self._values
+
+    def __iter__(self):
+        return iter(sorted(self._values))
+
+    def as_dict(self):
+        return dict(self._values)
+
+    def __repr__(self):
+        return 'ConfigSection(%s, %s)' % (self._name, self._values)
 
-str_vars = [('mri', 'mri_trigger_key'),]
 
 class ExpToolsConfig(object):
 
-    def __init__(self):
+    def __init__(self, exp_config_file=None, environ=None, **overrides):
+        """
+        overrides are dicts of option values per section, e.g. screen={'full_screen': True};
+        they take precedence over the files and the environment.
+        """
+        if exp_config_file is None:
+            exp_config_file = os.path.join(os.path.abspath(os.getcwd()), exp_config_name)
+        if environ is None:
+            environ = os.environ
 
         self._config = configparser.ConfigParser()
-        
-        # config_dir = os.path.expanduser('~/.exptools')
-        # config_file = os.path.join(config_dir, 'exptools.cfg')
-
-        # default_file = os.path.join(exptools.__path__[0], 'default_config.cfg')
-        exp_config_file = os.path.join(os.path.abspath(os.getcwd()), 'exp_config.cfg')
-        print(exp_config_file)
-
-        self._config.read(exp_config_file)
-
-        # if os.path.exists(config_dir):
-        #     self._config.read(config_file)
+        self._python_values = {}
+        self.sources = {}
+        for source in [default_file, user_file, exp_config_file]:
+            layer = configparser.ConfigParser()
+            if not layer.read(source):
+                continue
+            for section in layer.sections():
+                if not self._config.has_section(section):
+                    self._config.add_section(section)
+                for option, value in layer.items(section):
+                    self._config.set(section, option, value)
+                    self.sources[(section, option)] = source
+
+        sections = set(schema) | set(self._config.sections())
+        for name, value in environ.items():
+            if not name.startswith(environment_prefix):
+                continue
+            for section in sections:
+                prefix = environment_prefix + section.upper() + '_'
+                if name.startswith(prefix):
+                    self._set(section, name[len(prefix):].lower(), value, 'environment %s' % name)
+
+        for section, values in overrides.items():
+            for option, value in values.items():
+                self._set(section, option, value, 'keyword argument')
+
+        self._build()
+
+    def _set(self, section, option, value, source):
+        if not self._config.has_section(section):
+            self._config.add_section(section)
+        if not isinstance(value, str):
+            # keep python values as they are, the config parser only holds strings
+            self._python_values[(section, option)] = value
+            value = json.dumps(list(value)) if isinstance(value, (list, tuple)) else str(value)
+        else:
+            self._python_values.pop((section, option), None)
+        self._config.set(section, option, value)
+        self.sources[(section, option)] = source
+
+    def _build(self):
+        """parse and validate all options, and make the sections available as attributes"""
+        parsed = {}
+        for section in self._config.sections():
+            values = {}
+            for option, value in self._config.items(section):
+                values[option] = parse_value(section, option, self._python_values.get((section, option), value))
+            parsed[section] = ConfigSection(section, values)
+        self._values = parsed
+
+    def __getattr__(self, section):
+        values = self.__dict__.get('_values', {})
+        if section in values:
+            return values[section]
+        raise AttributeError('no config section %s' % section)
+
+    def sections(self):
+        return sorted(self._values)
+
+    def source(self, section, option):
+        """the file, environment variable or keyword argument the value of option came from"""
+        return self.sources[(section, option)]
 
     def get(self, section, option):
-        if (section, option) in list_vars:
-            return json.loads(self._config.get(section, option))
-        elif (section, option) in boolean_vars:
-            return self._config.getboolean(section, option)
-        elif (section, option) in str_vars:
-            return self._config.get(section, option)
-        else:
+        """
+        the value of option, with lists as lists, booleans and strings as they are, and 
+        everything else as a float, if the value is a number
+        """
+        value = getattr(self._values[section], option)
+        if isinstance(value, tuple):
+            return list(value)
+        if isinstance(value, (bool, str)) and schema.get(section, {}).get(option) is not None:
+            return value
+        try:
             return float(self._config.get(section, option))
+        except ValueError:
+            return value
 
     def set(self, section, option, value):
-        if isinstance(value, bool) or isinstance(value, list):
-            value = str(value)
-
-        return self._config.set(section, option, value)
+        self._set(section, option, value, 'set')
+        self._build()
 
 
 
@@ -65,3 +210,31 @@ def test_exptools_config():
     config = ExpToolsConfig()
     assert('screen' in config._config.sections())
 
+
+def test_config_precedence():
+    import tempfile
+
+    exp_file = os.path.join(tempfile.mkdtemp(), exp_config_name)
+    with open(exp_file, 'w') as f:
+        f.write('[screen]\nfull_screen = True\nsize = [800, 600]\n')
+    config = ExpToolsConfig(exp_config_file=exp_file,
+                            environ={'EXPTOOLS_SCREEN_SIZE': '[1024, 768]', 'EXPTOOLS_MRI_MRI_TRIGGER_KEY': '5'},
+                            screen={'screen_nr': 1})
+    assert(config.screen.full_screen is True)
+    assert(config.screen.size == (1024, 768))
+    assert(config.mri.mri_trigger_key == '5')
+    assert(config.screen.screen_nr == 1)
+    assert(config.get('eyetracker', 'n_calib_points') == 9)
+    # get returns lists and floats, as before the schema; attributes are typed
+    assert(config.get('screen', 'size') == [1024, 768] and isinstance(config.get('screen', 'size'), list))
+    assert(isinstance(config.get('eyetracker', 'n_calib_points'), float))
+    assert(isinstance(config.eyetracker.n_calib_points, int))
+    config.set('screen', 'refresh_rate', '120')
+    assert(config.get('screen', 'refresh_rate') == 120.0 and isinstance(config.get('screen', 'refresh_rate'), float))
+    assert(config.get('mri', 'mri_trigger_key') == '5' and config.get('screen', 'full_screen') is True)
+    assert(config.source('screen', 'full_screen') == exp_file)
+    assert(config.source('screen', 'screen_nr') == 'keyword argument')
+    assert(config.source('screen', 'gamma_scale') == default_file)
+
+    config.set('screen', 'full_screen', False)
+    assert(config.screen.full_screen is False)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+geometry.py
+
+Screen geometry and photometry. ScreenGeometry converts between degrees of
+visual angle, pixels and centimeters for scalars and whole coordinate arrays at
+once, either with a single pixels per degree factor, as Session always did, or
+exactly, with the tangent of the eccentricity, which matters on wide screens
+and at short viewing distances. LuminanceTable holds the luminance of every
+gun level, built once from the gamma_scale and max_lums of the screen, to
+convert between luminance in cd/m2 and psychopy rgb colors.
+"""
+
+import numpy as np
+
+
+def rgb_to_255(rgb):
+    """psychopy rgb colors, -1 to 1, as 0 to 255 integers, as pygaze and the EyeLink use them"""
+    return ((np.asarray(rgb, dtype=float) + 1.0) / 2.0 * 255).astype(int)
+
+
+class ScreenGeometry(object):
+    """
+    ScreenGeometry of a screen of size (width, height) pixels and physical_size (width, height)
+    cm, viewed from distance cm. The linear conversions use the pixels per degree of the screen
+    height; with exact=True, eccentricities are mapped through distance * tan(eccentricity).
+    Positions are relative to the screen center.
+    """
+    def __init__(self, size, physical_size, distance, exact=False):
+        self.size = np.asarray(size, dtype=float)
+        self.physical_size = np.asarray(physical_size, dtype=float)
+        self.distance = float(distance)
+        self.exact = exact
+
+        self.screen_height_degrees = 2.0 * np.degrees(np.arctan((self.physical_size[1] / 2.0) / self.distance))
+        self.pixels_per_degree = self.size[1] / self.screen_height_degrees
+        self.centimeters_per_degree = self.physical_size[1] / self.screen_height_degrees
+        self.pixels_per_centimeter = self.pixels_per_degree / self.centimeters_per_degree
+
+    def _exact(self, exact):
+        return self.exact if exact is None else exact
+
+    def deg2cm(self, deg, exact=None):
+        """degrees, sizes or eccentricities along one axis, to centimeters"""
+        if self._exact(exact):
+            return self.distance * np.tan(np.radians(deg))
+        return np.asarray(deg) * self.centimeters_per_degree
+
+    def cm2deg(self, cm, exact=None):
+        if self._exact(exact):
+            return np.degrees(np.arctan(np.asarray(cm) / self.distance))
+        return np.asarray(cm) / self.centimeters_per_degree
+
+    def cm2pix(self, cm):
+        return np.asarray(cm) * self.pixels_per_centimeter
+
+    def pix2cm(self, pix):
+        return np.asarray(pix) / self.pixels_per_centimeter
+
+    def deg2pix(self, deg, exact=None):
+        """degrees, sizes or eccentricities along one axis, to pixels"""
+        return self.cm2pix(self.deg2cm(deg, exact))
+
+    def pix2deg(self, pix, exact=None):
+        return self.cm2deg(self.pix2cm(pix), exact)
+
+    def _radial(self, positions, convert):
+        # convert the eccentricities of (..., 2) positions, keeping their directions
+        positions = np.asarray(positions, dtype=float)
+        eccentricities = np.sqrt((positions ** 2).sum(axis=-1, keepdims=True))
+        converted = convert(eccentricities)
+        scale = np.divide(converted, eccentricities, out=np.zeros_like(converted), where=eccentricities > 0)
+        return positions * scale
+
+    def positions_deg2pix(self, positions, exact=None):
+        """(..., 2) positions in degrees to pixels, both relative to the screen center"""
+        if not self._exact(exact):
+            return np.asarray(positions) * self.pixels_per_degree
+        return self._radial(positions, lambda deg: self.deg2pix(deg, True))
+
+    def positions_pix2deg(self, positions, exact=None):
+        """(..., 2) positions in pixels to degrees, both relative to the screen center"""
+        if not self._exact(exact):
+            return np.asarray(positions) / self.pixels_per_degree
+        return self._radial(positions, lambda pix: self.pix2deg(pix, True))
+
+
+class LuminanceTable(object):
+    """
+    LuminanceTable holds the luminance in cd/m2 of nr_levels levels of every gun, max_lums *
+    level ** gamma_scale, and the luminance of grays, their sum. Conversions look up or
+    interpolate in these tables, and take and return psychopy rgb values from -1 to 1.
+    """
+    def __init__(self, gamma_scale, max_lums, nr_levels=256):
+        self.gamma_scale = np.asarray(gamma_scale, dtype=float)
+        self.max_lums = np.asarray(max_lums, dtype=float)
+        self.nr_levels = nr_levels
+        self.levels = np.linspace(0.0, 1.0, nr_levels)
+        # (nr_levels, 3)
+        self.table = self.max_lums * self.levels[:, np.newaxis] ** self.gamma_scale
+        self.gray_table = self.table.sum(axis=1)
+
+    def _indices(self, rgb):
+        indices = np.round((np.asarray(rgb, dtype=float) + 1.0) / 2.0 * (self.nr_levels - 1)).astype(int)
+        return np.clip(indices, 0, self.nr_levels - 1)
+
+    def luminance(self, rgb):
+        """the luminance of (..., 3) rgb colors"""
+        indices = self._indices(rgb)
+        return self.table[indices, np.arange(3)].sum(axis=-1)
+
+    def channel_luminance(self, value, channel):
+        """the luminance of one gun at value"""
+        return self.table[self._indices(value), channel]
+
+    def gray(self, luminance):
+        """the gray value that has luminance, clipped to the luminance range of the screen"""
+        return np.interp(luminance, self.gray_table, self.levels) * 2.0 - 1.0
+
+    def gray_rgb(self, luminance):
+        """(..., 3) rgb colors of the grays that have luminance"""
+        return np.repeat(np.asarray(self.gray(luminance))[..., np.newaxis], 3, axis=-1)
+
+    def channel(self, luminance, channel):
+        """the value of one gun that has luminance"""
+        return np.interp(luminance, self.table[:, channel], self.levels) * 2.0 - 1.0
+
+
+def test_screen_geometry():
+    geometry = ScreenGeometry((2880, 1800), (33, 19), 50)
+    assert(np.isclose(geometry.deg2pix(geometry.screen_height_degrees), 1800))
+    assert(np.allclose(geometry.pix2deg(geometry.deg2pix(np.arange(5.0))), np.arange(5.0)))
+    assert(np.isclose(geometry.pixels_per_centimeter, 1800 / 19.0))
+    # half the screen height is exact in both modes, larger eccentricities are larger when exact
+    half_height = geometry.screen_height_degrees / 2.0
+    assert(np.isclose(geometry.deg2pix(half_height, exact=True), 900))
+    assert(geometry.deg2pix(20.0, exact=True) > geometry.deg2pix(20.0))
+    assert(np.isclose(geometry.pix2deg(geometry.deg2pix(20.0, exact=True), exact=True), 20.0))
+
+    positions = np.array([[0.0, 0.0], [3.0, 4.0], [-20.0, 0.0]])
+    pixels = geometry.positions_deg2pix(positions, exact=True)
+    assert((pixels[0] == 0).all() and np.isclose(pixels[1, 0] / pixels[1, 1], 0.75))
+    assert(np.isclose(np.linalg.norm(pixels[1]), geometry.deg2pix(5.0, exact=True)))
+    assert(np.allclose(geometry.positions_pix2deg(pixels, exact=True), positions))
+    assert(np.allclose(geometry.positions_deg2pix(positions), positions * geometry.pixels_per_degree))
+
+
+def test_luminance_table():
+    table = LuminanceTable([2.475, 2.25, 2.15], [24.52, 78.8, 10.19])
+    assert(np.isclose(table.luminance([1, 1, 1]), 24.52 + 78.8 + 10.19) and table.luminance([-1, -1, -1]) == 0)
+    assert(np.isclose(table.channel_luminance(0.0, 1), 78.8 * 0.5 ** 2.25, rtol=0.01))
+    grays = table.gray(np.array([0.0, 20.0, 1000.0]))
+    assert(grays[0] == -1 and -1 < grays[1] < 1 and grays[2] == 1)
+    assert(np.isclose(table.luminance(table.gray_rgb(20.0)), 20.0, rtol=0.02))
+    assert(np.isclose(table.channel_luminance(table.channel(5.0, 0), 0), 5.0, rtol=0.02))
+    assert((rgb_to_255([-1, 0, 1]) == [0, 127, 255]).all())
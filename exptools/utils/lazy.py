@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+lazy.py
+
+Deferred imports of the heavy backends (psychopy, pygame, pygaze). A module
+imported with lazy_import is only imported on first attribute access, so
+experiments and analysis code that never touch a backend never pay for it.
+"""
+
+import importlib
+
+
+class LazyModule(object):
+    """stands in for module name, and imports it when one of its attributes is first used"""
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            module = importlib.import_module(self.__dict__['_name'])
+            self.__dict__['_module'] = module
+        return module
+
+    @property
+    def loaded(self):
+        return self.__dict__['_module'] is not None
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self._load(), attribute, value)
+
+    def __repr__(self):
+        return '<lazy module %s%s>' % (self.__dict__['_name'], '' if self.loaded else ' (not imported)')
+
+
+def lazy_import(name):
+    """a LazyModule for name, e.g. visual = lazy_import('psychopy.visual')"""
+    return LazyModule(name)
+
+
+def test_lazy_import():
+    import sys
+
+    sys.modules.pop('colorsys', None)
+    colorsys = lazy_import('colorsys')
+    assert(not colorsys.loaded and 'colorsys' not in sys.modules)
+    assert(colorsys.rgb_to_hsv(1, 0, 0) == (0, 1, 1))
+    assert(colorsys.loaded)
@@ -33,6 +33,7 @@ setup(name='exptools',
     url='https://github.com/Gilles86/exp_tools',
     license='MIT',
     packages=find_packages(),
+    package_data={'exptools': ['default_config.cfg']},
     zip_safe=False,
     install_requires=install_requires, 
 )